@@ -0,0 +1,228 @@
+import numpy as np
+
+import sys, argparse, pickle, json, time, itertools
+from collections import OrderedDict
+
+import keras
+
+from datasets import get_data_generator
+from datasets.common import StageTimer
+
+
+
+def onehot_transform(X, y, num_classes):
+
+    return X, keras.utils.to_categorical(y, num_classes)
+
+
+def embedding_transform(X, y, embedding):
+
+    return X, embedding[y]
+
+
+def warm_file_cache(sequence, num_batches):
+    """ Reads the image files of the first `num_batches` batches of a sequence once, so that they reside in the page cache of the OS.
+
+    Returns: the number of bytes read.
+    """
+
+    num_bytes = 0
+    for idx in range(min(num_batches, len(sequence))):
+        for i in sequence.batch_indices(idx):
+            if isinstance(sequence.ids[i], str):
+                with open(sequence.ids[i], 'rb') as f:
+                    num_bytes += len(f.read())
+    return num_bytes
+
+
+def profile_stages(data_generator, sequence, num_batches):
+    """ Loads batches from a sequence in the current process and measures the time spent in each stage of the pipeline.
+
+    # Arguments:
+
+    - data_generator: The data generator that created the sequence.
+
+    - sequence: The `DataSequence` to load batches from.
+
+    - num_batches: Number of batches to be loaded.
+
+    # Returns:
+        a tuple with the `StageTimer`, the total time in seconds, and the number of images loaded.
+    """
+
+    timer = StageTimer()
+    data_generator.stage_timer = timer
+    num_images = 0
+    try:
+        start_time = time.perf_counter()
+        for idx in range(min(num_batches, len(sequence))):
+            sequence[idx]
+            num_images += len(sequence.batch_indices(idx))
+        total_time = time.perf_counter() - start_time
+    finally:
+        data_generator.stage_timer = None
+    return timer, total_time, num_images
+
+
+def measure_throughput(sequence, num_batches, workers = 0, use_multiprocessing = True, max_queue_size = 10):
+    """ Measures throughput and latency of loading batches from a sequence in the same way as during training.
+
+    # Arguments:
+
+    - sequence: The `DataSequence` to load batches from.
+
+    - num_batches: Number of batches to be loaded.
+
+    - workers: Number of workers. If set to 0, batches will be loaded sequentially in the main process.
+
+    - use_multiprocessing: Whether to use processes instead of threads as workers.
+
+    - max_queue_size: Maximum number of batches loaded in advance.
+
+    # Returns:
+        a tuple of two numpy arrays with the number of images in each batch and the time the consumer had to
+        wait for each batch in seconds.
+    """
+
+    if workers > 0:
+        enqueuer = keras.utils.OrderedEnqueuer(sequence, use_multiprocessing = use_multiprocessing)
+        enqueuer.start(workers = workers, max_queue_size = max_queue_size)
+        batches = enqueuer.get()
+    else:
+        enqueuer = None
+        batches = (sequence[i % len(sequence)] for i in itertools.count())
+
+    batch_sizes, latencies = [], []
+    try:
+        last_time = time.perf_counter()
+        for _ in range(num_batches):
+            X = next(batches)[0]
+            cur_time = time.perf_counter()
+            batch_sizes.append(len(X[0] if isinstance(X, list) else X))
+            latencies.append(cur_time - last_time)
+            last_time = cur_time
+    finally:
+        if enqueuer is not None:
+            enqueuer.stop()
+
+    return np.array(batch_sizes), np.array(latencies)
+
+
+def print_stage_breakdown(timer, total_time, num_images):
+
+    print()
+    print('Stage breakdown ({} images, {:.2f} s, {:.1f} images/s in a single process):'.format(num_images, total_time, num_images / max(total_time, 1e-12)))
+    print()
+    max_name_len = max([len(stage) for stage in timer.times.keys()] + [len('(other)')])
+    print('{:{}s} | {:>10s} | {:>12s} | {:>7s}'.format('Stage', max_name_len, 'Total [s]', 'ms per image', 'Share'))
+    print('-' * (max_name_len + 40))
+    for stage, stage_time in timer.times.items():
+        print('{:{}s} | {:>10.3f} | {:>12.3f} | {:>6.1%}'.format(stage, max_name_len, stage_time, 1000 * stage_time / max(num_images, 1), stage_time / max(total_time, 1e-12)))
+    other_time = max(0.0, total_time - timer.total_time)
+    print('{:{}s} | {:>10.3f} | {:>12.3f} | {:>6.1%}'.format('(other)', max_name_len, other_time, 1000 * other_time / max(num_images, 1), other_time / max(total_time, 1e-12)))
+    print()
+
+
+def print_throughput(results):
+
+    print()
+    max_name_len = max(len(name) for name in results.keys())
+    columns = ['images/s', 'startup [s]', 'p50 [ms]', 'p90 [ms]', 'p99 [ms]', 'max [ms]']
+    print(' | '.join(['{:{}s}'.format('Configuration', max_name_len)] + ['{:>11s}'.format(col) for col in columns]))
+    print('-' * (max_name_len + 14 * len(columns)))
+    for name, res in results.items():
+        print(' | '.join(['{:{}s}'.format(name, max_name_len)] + ['{:>11.2f}'.format(res[col]) for col in columns]))
+    print()
+
+
+
+if __name__ == '__main__':
+
+    parser = argparse.ArgumentParser(description = 'Measures the throughput of the data pipeline independently of the model.', formatter_class = argparse.ArgumentDefaultsHelpFormatter)
+    arggroup = parser.add_argument_group('Data parameters')
+    arggroup.add_argument('--dataset', type = str, required = True, help = 'Training dataset. See README.md for a list of available datasets.')
+    arggroup.add_argument('--data_root', type = str, required = True, help = 'Root directory of the dataset.')
+    arggroup.add_argument('--classes_from', type = str, default = None, help = 'Optionally, a path to a pickle dump containing a dictionary with item "ind2label" specifying the classes to be considered.')
+    arggroup.add_argument('--split', type = str, default = 'train', choices = ['train', 'test'], help = 'Whether to benchmark the training or the test sequence.')
+    arggroup.add_argument('--batch_size', type = int, default = 100, help = 'Batch size.')
+    arggroup.add_argument('--target_size', type = int, default = None, help = 'Size of the smaller image side after resizing. Defaults to the setting of the dataset.')
+    arggroup.add_argument('--no_augment', action = 'store_true', default = False, help = 'Disable data augmentation.')
+    arggroup.add_argument('--batch_transform', type = str, default = 'none', choices = ['none', 'onehot', 'embedding'], help = 'Batch transformation applied to the targets, as done by the training scripts.')
+    arggroup.add_argument('--embedding', type = str, default = None, help = 'Path to a pickle dump of class embeddings, required for --batch_transform=embedding.')
+    arggroup = parser.add_argument_group('Benchmark parameters')
+    arggroup.add_argument('--batches', type = int, default = 50, help = 'Number of batches to be loaded for measuring throughput.')
+    arggroup.add_argument('--profile_batches', type = int, default = 10, help = 'Number of batches to be loaded in a single process for measuring the time spent in each stage of the pipeline. Set this to 0 to skip profiling.')
+    arggroup.add_argument('--workers', type = int, nargs = '+', default = [0], help = 'Numbers of worker processes to benchmark. 0 means loading batches sequentially in the main process.')
+    arggroup.add_argument('--threads', type = int, nargs = '+', default = [], help = 'Numbers of worker threads to benchmark.')
+    arggroup.add_argument('--queue_size', type = int, default = 100, help = 'Maximum size of data queue.')
+    arggroup.add_argument('--cache', type = str, nargs = '+', default = ['none'], choices = ['none', 'warm'],
+                          help = 'Cache modes to benchmark. "warm" reads all images once before measuring, so that they are served from the page cache of the OS. '
+                                 '"none" does not read images in advance, but does not evict images already residing in the page cache either.')
+    arggroup.add_argument('--json', type = str, default = None, help = 'Optionally, path to a JSON file where the results will be written to.')
+    args = parser.parse_args()
+
+    # Load dataset
+    if args.classes_from:
+        with open(args.classes_from, 'rb') as f:
+            embed_labels = pickle.load(f)['ind2label']
+    else:
+        embed_labels = None
+    data_generator = get_data_generator(args.dataset, args.data_root, classes = embed_labels)
+
+    # Create sequence
+    if args.batch_transform == 'onehot':
+        batch_transform, batch_transform_kwargs = onehot_transform, { 'num_classes' : data_generator.num_classes }
+    elif args.batch_transform == 'embedding':
+        if args.embedding is None:
+            parser.error('--batch_transform=embedding requires --embedding.')
+        with open(args.embedding, 'rb') as pf:
+            batch_transform, batch_transform_kwargs = embedding_transform, { 'embedding' : pickle.load(pf)['embedding'] }
+    else:
+        batch_transform, batch_transform_kwargs = None, {}
+    sequence_kwargs = { 'augment' : not args.no_augment, 'batch_transform' : batch_transform, 'batch_transform_kwargs' : batch_transform_kwargs }
+    if args.target_size is not None:
+        sequence_kwargs['target_size'] = args.target_size
+    sequence_factory = data_generator.train_sequence if args.split == 'train' else data_generator.test_sequence
+    sequence = sequence_factory(args.batch_size, **sequence_kwargs)
+
+    results = OrderedDict()
+
+    # Measure time spent in each stage of the pipeline
+    if args.profile_batches > 0:
+        sys.stderr.write('Profiling pipeline stages...\n')
+        timer, total_time, num_images = profile_stages(data_generator, sequence, args.profile_batches)
+        print_stage_breakdown(timer, total_time, num_images)
+        results['stages'] = {
+            'images' : num_images,
+            'total_time' : total_time,
+            'times' : dict(timer.times),
+            'counts' : dict(timer.counts)
+        }
+
+    # Measure throughput for all configurations
+    configs = [('processes', w) for w in args.workers] + [('threads', t) for t in args.threads if t > 0]
+    throughput = OrderedDict()
+    for cache_mode in args.cache:
+        if cache_mode == 'warm':
+            sys.stderr.write('Warming up file cache...\n')
+            warm_file_cache(sequence, args.batches + args.profile_batches)
+        for worker_type, num_workers in configs:
+            name = '{}, {}'.format('sequential' if num_workers == 0 else '{} {}'.format(num_workers, worker_type), '{} cache'.format(cache_mode))
+            sys.stderr.write('Benchmarking {}...\n'.format(name))
+            batch_sizes, latencies = measure_throughput(sequence, max(args.batches, 2), num_workers, worker_type == 'processes', args.queue_size)
+            # The first batch includes the start-up time of the workers and is excluded from throughput and latency statistics
+            steady_latencies = latencies[1:]
+            throughput[name] = {
+                'images/s'    : batch_sizes[1:].sum() / max(steady_latencies.sum(), 1e-12),
+                'startup [s]' : latencies[0],
+                'p50 [ms]'    : 1000 * np.percentile(steady_latencies, 50),
+                'p90 [ms]'    : 1000 * np.percentile(steady_latencies, 90),
+                'p99 [ms]'    : 1000 * np.percentile(steady_latencies, 99),
+                'max [ms]'    : 1000 * steady_latencies.max()
+            }
+    print_throughput(throughput)
+    results['throughput'] = throughput
+
+    if args.json:
+        with open(args.json, 'w') as f:
+            json.dump(results, f, indent = 4, default = float)
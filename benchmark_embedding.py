@@ -0,0 +1,91 @@
+import numpy as np
+
+import sys, argparse, time
+
+from class_hierarchy import ClassHierarchy
+from compute_class_embedding import unitsphere_embedding
+
+
+
+def synthetic_class_sim(num_classes, branching = 10):
+    """ Computes class similarities for a balanced synthetic hierarchy.
+
+    The leaves of the hierarchy are the classes and each inner node has `branching` children (except for the
+    rightmost ones). The similarity of two classes is the fraction of the tree depth covered by their common
+    ancestors, which is the same as `1 - lcs_height / max_height` for a `ClassHierarchy`.
+
+    # Returns:
+        `num_classes-by-num_classes` similarity matrix.
+    """
+
+    depth = max(1, int(np.ceil(np.log(num_classes) / np.log(branching))))
+    paths = np.stack([(np.arange(num_classes) // branching ** (depth - d - 1)) for d in range(depth)], axis = 1)
+    class_sim = np.zeros((num_classes, num_classes))
+    common = np.ones((num_classes, num_classes), dtype = bool)
+    for d in range(depth):
+        common &= (paths[:,d][:,None] == paths[:,d][None,:])
+        class_sim += common
+    return class_sim / depth
+
+
+def hierarchy_class_sim(hierarchy):
+    """ Computes class similarities for all leaf nodes of a given `ClassHierarchy`. """
+
+    labels = sorted(lbl for lbl in hierarchy.nodes if (lbl not in hierarchy.children) or (len(hierarchy.children[lbl]) == 0))
+    class_sim = np.ones((len(labels), len(labels)))
+    for i in range(len(labels)):
+        for j in range(i + 1, len(labels)):
+            class_sim[i,j] = class_sim[j,i] = 1. - hierarchy.lcs_height(labels[i], labels[j])
+    return class_sim
+
+
+def max_deviation(embedding, class_sim, max_rows = 1000):
+    """ Computes the maximum deviation of the dot products of embeddings from the target similarities for a subset of rows. """
+
+    rows = np.linspace(0, len(class_sim) - 1, min(max_rows, len(class_sim))).astype(int)
+    return np.abs(np.dot(embedding[rows], embedding.T) - class_sim[rows]).max()
+
+
+
+if __name__ == '__main__':
+
+    parser = argparse.ArgumentParser(description = 'Compares the run-time of different methods for computing unitsphere class embeddings.', formatter_class = argparse.ArgumentDefaultsHelpFormatter)
+    parser.add_argument('--hierarchy', type = str, default = None, help = 'Path to a file containing parent-child or is-a relationships (one per line). If not given, synthetic hierarchies will be used.')
+    parser.add_argument('--is_a', action = 'store_true', default = False, help = 'If given, --hierarchy is assumed to contain is-a instead of parent-child relationships.')
+    parser.add_argument('--str_ids', action = 'store_true', default = False, help = 'If given, class IDs are treated as strings instead of integers.')
+    parser.add_argument('--num_classes', type = int, nargs = '+', default = [100, 500, 1000, 5000, 10000], help = 'Numbers of classes of the synthetic hierarchies.')
+    parser.add_argument('--branching', type = int, default = 10, help = 'Branching factor of the synthetic hierarchies.')
+    parser.add_argument('--methods', type = str, nargs = '+', default = ['cholesky', 'iterative'], choices = ['cholesky', 'iterative'], help = 'Methods to be compared.')
+    parser.add_argument('--dtypes', type = str, nargs = '+', default = ['float64', 'float32'], choices = ['float32', 'float64'], help = 'Floating point types to be compared.')
+    parser.add_argument('--max_iterative', type = int, default = 1000, help = 'Maximum number of classes for which the iterative method will be run.')
+    parser.add_argument('--repeats', type = int, default = 1, help = 'Number of runs per configuration. The minimum run-time will be reported.')
+    args = parser.parse_args()
+
+    # Set up similarity matrices
+    if args.hierarchy:
+        hierarchy = ClassHierarchy.from_file(args.hierarchy, is_a_relations = args.is_a, id_type = str if args.str_ids else int)
+        problems = [hierarchy_class_sim(hierarchy)]
+    else:
+        problems = (synthetic_class_sim(n, args.branching) for n in args.num_classes)
+
+    # Benchmark
+    print('{:>8s} | {:>10s} | {:>7s} | {:>10s} | {:>13s} | {:>16s}'.format('Classes', 'Method', 'Type', 'Time [s]', 'Max deviation', 'Diff. to first'))
+    print('-' * 80)
+    for class_sim in problems:
+        reference = None
+        for dtype in args.dtypes:
+            for method in args.methods:
+                if (method == 'iterative') and (len(class_sim) > args.max_iterative):
+                    continue
+                times = []
+                for _ in range(args.repeats):
+                    start_time = time.perf_counter()
+                    embedding = unitsphere_embedding(class_sim, method = method, dtype = np.dtype(dtype))
+                    times.append(time.perf_counter() - start_time)
+                if reference is None:
+                    reference = embedding
+                print('{:>8d} | {:>10s} | {:>7s} | {:>10.3f} | {:>13.2e} | {:>16.2e}'.format(
+                    len(class_sim), method, dtype, min(times),
+                    max_deviation(embedding, class_sim), np.abs(embedding - reference).max()
+                ))
+                sys.stdout.flush()
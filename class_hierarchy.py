@@ -1,46 +1,247 @@
 import numpy as np
-import types
-from sklearn.metrics import average_precision_score
+import sys, os.path, types, itertools, hashlib, argparse
+from collections import OrderedDict
+
+from retrieval_metrics import average_precision
+
+
+
+# Maximum number of classes for which subset() computes dense tables of class similarities automatically
+MAX_DENSE_CLASSES = 5000
+
+# Version of the binary hierarchy format written by ClassHierarchy.save_npz()
+NPZ_FORMAT_VERSION = 1
 
 
 
 class ClassHierarchy(object):
-    """ Represents a class taxonomy and can be used to find Lowest Common Subsumers or to compute class similarities. """
+    """ Represents a class taxonomy and can be used to find Lowest Common Subsumers or to compute class similarities.
     
-    def __init__(self, parents, children):
+    Internally, nodes are identified by consecutive integer indices and the hierarchy is stored in compact CSR adjacency arrays.
+    Results of queries for pairs of classes are kept in bounded LRU caches. For a fixed set of target classes, dense tables
+    of lowest common subsumers and similarities can be loaded using `set_target_classes()` or `load_pair_tables()`.
+    """
+    
+    def __init__(self, parents, children, cache_size = 1000000):
         """ Initializes a new ClassHierarchy.
         
         parents - Dictionary mapping class labels to lists of parent class labels in the hierarchy.
         children - Dictionary mapping class labels to lists of children class labels in the hierarchy.
+        cache_size - Maximum number of items in each of the caches for pairs of classes and hypernyms of classes.
+                     `None` means unbounded.
         """
         
         object.__init__(self)
-        self.parents = parents
-        self.children = children
-        self.nodes = set(self.parents.keys()) | set(self.children.keys())
+        self._init_caches(cache_size)
+        self._build_index(parents, children)
+        self._compute_topology()
+        self.max_height = int(self._heights.max())
+    
+    
+    def _init_caches(self, cache_size):
+        """ Initializes all caches and lazily computed data structures. """
         
-        self._depths = { False : {}, True : {} }
-        self._hyp_depth_cache = { False : {}, True : {} }
-        self._hyp_dist_cache = {}
-        self._lcs_cache = {}
-        self._wup_cache = {}
+        self._hyp_depth_cache = { False : LRUCache(cache_size), True : LRUCache(cache_size) }
+        self._hyp_dist_cache = LRUCache(cache_size)
+        self._lcs_cache = LRUCache(cache_size)
+        self._wup_cache = LRUCache(cache_size)
+        self._pair_index = {}
+        self._pair_lcs = np.zeros((0, 0), dtype = np.int32)
+        self._pair_wup = np.zeros((0, 0))
+        self._parents_dict = self._children_dict = self._heights_dict = None
+        self._lca_tables = None
+        self._path_counts = None
+        self._subsets = LRUCache(8)
+    
+    
+    def _build_index(self, parents, children):
+        """ Assigns consecutive integer indices to all nodes and stores parent and child relations as CSR adjacency arrays. """
+        
+        self._node_ids = list(OrderedDict.fromkeys(itertools.chain(parents.keys(), children.keys())).keys())
+        self._node_index = { id : i for i, id in enumerate(self._node_ids) }
         
-        self._compute_heights()
-        self.max_height = max(self.heights.values())
+        def edges(adjacency):
+            sources = np.repeat(np.array([self._node_index[id] for id in adjacency.keys()], dtype = np.int32), [len(neighbors) for neighbors in adjacency.values()])
+            targets = np.array([self._node_index[id] for neighbors in adjacency.values() for id in neighbors], dtype = np.int32)
+            return sources, targets
+        
+        self._parent_ptr, self._parent_ind = _csr(*edges(parents), len(self._node_ids))
+        self._child_ptr, self._child_ind = _csr(*edges(children), len(self._node_ids))
     
     
-    def _compute_heights(self):
-        """ Computes the heights of all nodes in the hierarchy. """
+    def _compute_topology(self):
+        """ Computes the heights and the minimum and maximum depths of all nodes in a single pass over the hierarchy in topological order.
+        
+        The topological order is determined using Kahn's algorithm, i.e., a node is visited as soon as all its parents have been visited.
+        Raises a `ValueError` if the hierarchy contains cycles.
+        """
+        
+        num_nodes = len(self._node_ids)
+        child_ptr, child_ind = self._child_ptr.tolist(), self._child_ind.tolist()
+        num_parents = np.diff(self._parent_ptr).tolist()
+        min_depths = [1 if k == 0 else num_nodes + 1 for k in num_parents]
+        max_depths = [1] * num_nodes
+        
+        # Traverse hierarchy from the roots to the leaves (the list of visited nodes grows during iteration)
+        order = [node for node in range(num_nodes) if num_parents[node] == 0]
+        for node in order:
+            min_depth, max_depth = min_depths[node] + 1, max_depths[node] + 1
+            for child in child_ind[child_ptr[node]:child_ptr[node+1]]:
+                if min_depth < min_depths[child]:
+                    min_depths[child] = min_depth
+                if max_depth > max_depths[child]:
+                    max_depths[child] = max_depth
+                num_parents[child] -= 1
+                if num_parents[child] == 0:
+                    order.append(child)
+        if len(order) < num_nodes:
+            raise ValueError('The hierarchy contains cycles.')
+        
+        # Traverse hierarchy from the leaves to the roots
+        heights = [0] * num_nodes
+        for node in reversed(order):
+            if child_ptr[node] < child_ptr[node+1]:
+                heights[node] = 1 + max(heights[child] for child in child_ind[child_ptr[node]:child_ptr[node+1]])
         
-        def height(id):
+        self._topological_order = np.array(order, dtype = np.int32)
+        self._min_depths = np.array(min_depths, dtype = np.int32)
+        self._max_depths = np.array(max_depths, dtype = np.int32)
+        self._heights = np.array(heights, dtype = np.int32)
+    
+    
+    def _compute_lca_tables(self):
+        """ Computes tables for finding lowest common ancestors in constant time if the hierarchy is a tree (or a forest).
+        
+        The nodes are visited in an Euler tour starting at a virtual root node connecting all roots. The lowest common ancestor
+        of two nodes is the node with minimum depth between their first occurrences in the tour, which is found using a sparse
+        table of range minima.
+        
+        Returns: tuple of three numpy arrays (first occurrence of each node in the Euler tour, sparse table, depths including the virtual root)
+                 or `None` if the hierarchy is not a tree.
+        """
+        
+        if self._lca_tables is None:
             
-            if id not in self.heights:
-                self.heights[id] = 1 + max((height(child) for child in self.children[id]), default = -1) if id in self.children else 0
-            return self.heights[id]
+            if not self.is_tree():
+                self._lca_tables = False
+            else:
+                
+                num_nodes = len(self._node_ids)
+                child_ptr, child_ind = self._child_ptr.tolist(), self._child_ind.tolist()
+                roots = np.flatnonzero(np.diff(self._parent_ptr) == 0).tolist()
+                
+                # Iterative Euler tour starting at the virtual root with index `num_nodes`
+                cursor = child_ptr[:-1] + [0]
+                adjacency_end = child_ptr[1:] + [len(roots)]
+                first = [0] * num_nodes
+                euler = [num_nodes]
+                stack = [num_nodes]
+                while len(stack) > 0:
+                    node = stack[-1]
+                    if cursor[node] < adjacency_end[node]:
+                        child = roots[cursor[node]] if node == num_nodes else child_ind[cursor[node]]
+                        cursor[node] += 1
+                        first[child] = len(euler)
+                        euler.append(child)
+                        stack.append(child)
+                    else:
+                        stack.pop()
+                        if len(stack) > 0:
+                            euler.append(stack[-1])
+                
+                # Sparse table: level k contains the node with minimum depth among 2^k consecutive positions of the tour
+                depths = np.append(self._max_depths, np.int32(0))
+                levels = [np.array(euler, dtype = np.int32)]
+                while (2 << (len(levels) - 1)) <= len(euler):
+                    prev, half = levels[-1], 1 << (len(levels) - 1)
+                    a, b = prev[:-half], prev[half:]
+                    levels.append(np.where(depths[a] <= depths[b], a, b))
+                sparse = np.zeros((len(levels), len(euler)), dtype = np.int32)
+                for k, level in enumerate(levels):
+                    sparse[k,:len(level)] = level
+                
+                self._lca_tables = (np.array(first, dtype = np.int32), sparse, depths)
         
-        self.heights = {}
-        for node in self.nodes:
-            height(node)
+        return self._lca_tables if self._lca_tables is not False else None
+    
+    
+    def _tree_lca(self, a, b):
+        """ Finds the lowest common ancestors of pairs of nodes in a tree using the tables computed by `_compute_lca_tables()`.
+        
+        a - Array with indices of the first nodes.
+        b - Array with indices of the second nodes.
+        
+        Returns: array with node indices of the lowest common ancestors, -1 for nodes in different trees of a forest.
+        """
+        
+        first, sparse, depths = self._compute_lca_tables()
+        left, right = np.minimum(first[a], first[b]), np.maximum(first[a], first[b])
+        k = np.floor(np.log2(right - left + 1)).astype(np.int32)
+        x, y = sparse[k, left], sparse[k, right - (1 << k) + 1]
+        lca = np.where(depths[x] <= depths[y], x, y)
+        return np.where(lca == len(self._node_ids), -1, lca)
+    
+    
+    def _neighbor_dict(self, ptr, ind):
+        """ Converts a CSR adjacency matrix to a dictionary mapping the IDs of all nodes with at least one neighbor to lists of neighbor IDs. """
+        
+        ptr, ind = ptr.tolist(), ind.tolist()
+        return { self._node_ids[node] : [self._node_ids[neighbor] for neighbor in ind[ptr[node]:ptr[node+1]]] for node in range(len(self._node_ids)) if ptr[node] < ptr[node+1] }
+    
+    
+    @property
+    def parents(self):
+        """ Dictionary mapping class labels to lists of parent class labels, built from the internal representation on first access. """
+        
+        if self._parents_dict is None:
+            self._parents_dict = self._neighbor_dict(self._parent_ptr, self._parent_ind)
+        return self._parents_dict
+    
+    
+    @property
+    def children(self):
+        """ Dictionary mapping class labels to lists of children class labels, built from the internal representation on first access. """
+        
+        if self._children_dict is None:
+            self._children_dict = self._neighbor_dict(self._child_ptr, self._child_ind)
+        return self._children_dict
+    
+    
+    @property
+    def nodes(self):
+        """ Set-like view of the IDs of all nodes in the hierarchy. """
+        
+        return self._node_index.keys()
+    
+    
+    @property
+    def heights(self):
+        """ Dictionary mapping the IDs of all nodes to their height in the hierarchy, built on first access. """
+        
+        if self._heights_dict is None:
+            self._heights_dict = dict(zip(self._node_ids, self._heights.tolist()))
+        return self._heights_dict
+    
+    
+    def _ancestor_distances(self, id):
+        """ Determines all hypernyms of a given element (including the element itself) by breadth-first search.
+        
+        Returns: dictionary mapping node indices to their minimum distance from the given element, measured in the number of edges.
+        """
+        
+        distances = { self._node_index[id] : 0 }
+        frontier = list(distances.keys())
+        dist = 0
+        while len(frontier) > 0:
+            dist += 1
+            next_frontier = []
+            for node in frontier:
+                for parent in self._parent_ind[self._parent_ptr[node]:self._parent_ptr[node+1]].tolist():
+                    if parent not in distances:
+                        distances[parent] = dist
+                        next_frontier.append(parent)
+            frontier = next_frontier
+        return distances
     
     
     def is_tree(self):
@@ -49,7 +250,7 @@ class ClassHierarchy(object):
         Note that some popular hierarchies such as WordNet are not trees, but allow nodes to have multiple parents.
         """
         
-        return all(len(parents) <= 1 for parents in self.parents.values())
+        return bool(np.all(np.diff(self._parent_ptr) <= 1))
     
     
     def all_hypernym_depths(self, id, use_min_depth = False):
@@ -63,17 +264,11 @@ class ClassHierarchy(object):
         
         if id not in self._hyp_depth_cache[use_min_depth]:
             
-            depths = {}
-            if (id not in self.parents) or (len(self.parents[id]) == 0):
-                depths[id] = 1 # root nodes have depth 1
+            if id in self._node_index:
+                node_depths = self._min_depths if use_min_depth else self._max_depths
+                self._hyp_depth_cache[use_min_depth][id] = { self._node_ids[node] : int(node_depths[node]) for node in self._ancestor_distances(id).keys() }
             else:
-                for parent in self.parents[id]:
-                    for hyp, depth in self.all_hypernym_depths(parent, use_min_depth).items():
-                        depths[hyp] = depth
-                depths[id] = 1 + min(depths[p] for p in self.parents[id]) if use_min_depth else 1 + max(depths[p] for p in self.parents[id])
-            
-            self._hyp_depth_cache[use_min_depth][id] = depths
-            self._depths[use_min_depth][id] = depths[id]
+                self._hyp_depth_cache[use_min_depth][id] = { id : 1 } # nodes not contained in the hierarchy are treated as isolated roots
         
         return self._hyp_depth_cache[use_min_depth][id]
     
@@ -87,15 +282,11 @@ class ClassHierarchy(object):
         """
         
         if id not in self._hyp_dist_cache:
-        
-            distances = { id : 0 }
-            if id in self.parents:
-                for parent in self.parents[id]:
-                    for hyp, dist in self.all_hypernym_distances(parent).items():
-                        if (hyp not in distances) or (dist + 1 < distances[hyp]):
-                            distances[hyp] = dist + 1
-
-            self._hyp_dist_cache[id] = distances
+            
+            if id in self._node_index:
+                self._hyp_dist_cache[id] = { self._node_ids[node] : dist for node, dist in self._ancestor_distances(id).items() }
+            else:
+                self._hyp_dist_cache[id] = { id : 0 }
         
         return self._hyp_dist_cache[id]
     
@@ -103,21 +294,95 @@ class ClassHierarchy(object):
     def root_paths(self, id):
         """ Determines all paths from a given element (excluding the element itself) to a root node in the hierarchy.
         
+        Note that the number of paths can grow exponentially with the depth of hierarchies with multiple inheritance such as WordNet.
+        Consider using `num_root_paths()`, `iter_root_paths()`, or `root_path_graph()` instead.
+        
         id - ID of the element.
         
         Returns: list of lists of node ids, each list beginning with a direct hypernym of the given element and ending with a root node
         """
         
-        paths = []
-        if id in self.parents:
-            for parent in self.parents[id]:
-                parent_paths = self.root_paths(parent)
-                if len(parent_paths) == 0:
-                    paths.append([parent])
-                else:
-                    for parent_path in parent_paths:
-                        paths.append([parent] + parent_path)
-        return paths
+        return list(self.iter_root_paths(id))
+    
+    
+    def iter_root_paths(self, id):
+        """ Generator yielding all paths from a given element (excluding the element itself) to a root node in the hierarchy.
+        
+        Paths are generated lazily in the same order as returned by `root_paths()`, using memory proportional to the depth
+        of the hierarchy times its maximum number of parents.
+        
+        id - ID of the element.
+        
+        Yields: lists of node ids, each list beginning with a direct hypernym of the given element and ending with a root node
+        """
+        
+        if id not in self._node_index:
+            return
+        
+        # Depth-first search with an explicit stack, yielding paths in the same order as a recursive traversal.
+        # Partial paths are stored as linked lists of (node, prefix) tuples to avoid copying them at every step.
+        ptr, ind = self._parent_ptr, self._parent_ind
+        node = self._node_index[id]
+        stack = [(parent, None) for parent in reversed(ind[ptr[node]:ptr[node+1]].tolist())]
+        while len(stack) > 0:
+            node, prefix = stack.pop()
+            parents = ind[ptr[node]:ptr[node+1]].tolist()
+            if len(parents) == 0:
+                path, link = [], (node, prefix)
+                while link is not None:
+                    path.append(self._node_ids[link[0]])
+                    link = link[1]
+                yield path[::-1]
+            else:
+                stack.extend((parent, (node, prefix)) for parent in reversed(parents))
+    
+    
+    def num_root_paths(self, id):
+        """ Counts the paths from a given element to a root node without enumerating them.
+        
+        The counts for all nodes are computed by dynamic programming in a single pass over the hierarchy in topological order
+        on first use.
+        
+        id - ID of the element.
+        
+        Returns: the number of paths returned by `root_paths()` as (arbitrarily large) integer.
+        """
+        
+        if id not in self._node_index:
+            return 0
+        
+        if self._path_counts is None:
+            ptr, ind = self._parent_ptr.tolist(), self._parent_ind.tolist()
+            counts = [0] * len(self._node_ids)
+            for node in self._topological_order.tolist():
+                counts[node] = sum(counts[parent] for parent in ind[ptr[node]:ptr[node+1]]) if ptr[node] < ptr[node+1] else 1
+            self._path_counts = counts
+        
+        node = self._node_index[id]
+        return self._path_counts[node] if self._parent_ptr[node] < self._parent_ptr[node+1] else 0
+    
+    
+    def root_path_graph(self, id):
+        """ Determines a compact representation of all paths from a given element to a root node.
+        
+        All paths share their common prefixes and suffixes in the sub-graph of the hierarchy spanned by the hypernyms of the element.
+        Its size is bounded by the number of edges in the hierarchy, while the number of paths may be exponential.
+        The paths returned by `root_paths()` correspond to all paths in this graph from the given element to a node without parents.
+        
+        id - ID of the element.
+        
+        Returns: ordered dictionary mapping the given element and all its hypernyms to lists of their parents,
+                 in breadth-first order starting with the given element.
+        """
+        
+        if id not in self._node_index:
+            return OrderedDict([(id, [])])
+        
+        ptr, ind = self._parent_ptr, self._parent_ind
+        graph = OrderedDict()
+        for node in self._ancestor_distances(id).keys():
+            graph[self._node_ids[node]] = [self._node_ids[parent] for parent in ind[ptr[node]:ptr[node+1]].tolist()]
+        return graph
     
     
     def lcs(self, a, b, use_min_depth = False):
@@ -130,14 +395,27 @@ class ClassHierarchy(object):
         Returns: the id of the LCS or `None` if the two terms do not share any hypernyms.
         """
         
-        if (a,b) not in self._lcs_cache:
+        if (not use_min_depth) and (a in self._pair_index) and (b in self._pair_index):
+            lcs = self._pair_lcs[self._pair_index[a], self._pair_index[b]]
+            return self._node_ids[lcs] if lcs >= 0 else None
+        
+        if (a in self._node_index) and (b in self._node_index) and (self._compute_lca_tables() is not None):
+            # Range minimum query in the Euler tour (see _compute_lca_tables())
+            first, sparse, depths = self._lca_tables
+            left, right = sorted((int(first[self._node_index[a]]), int(first[self._node_index[b]])))
+            k = (right - left + 1).bit_length() - 1
+            x, y = sparse[k, left], sparse[k, right - (1 << k) + 1]
+            lcs = x if depths[x] <= depths[y] else y
+            return self._node_ids[lcs] if lcs < len(self._node_ids) else None
+        
+        if (a, b, use_min_depth) not in self._lcs_cache:
         
             hypernym_depths = self.all_hypernym_depths(a, use_min_depth)
             common_hypernyms = set(hypernym_depths.keys()) & set(self.all_hypernym_depths(b, use_min_depth).keys())
 
-            self._lcs_cache[(a,b)] = self._lcs_cache[(b,a)] = max(common_hypernyms, key = lambda hyp: hypernym_depths[hyp], default = None)
+            self._lcs_cache[(a, b, use_min_depth)] = self._lcs_cache[(b, a, use_min_depth)] = max(common_hypernyms, key = lambda hyp: hypernym_depths[hyp], default = None)
         
-        return self._lcs_cache[(a,b)]
+        return self._lcs_cache[(a, b, use_min_depth)]
     
     
     def shortest_path_length(self, a, b):
@@ -156,6 +434,33 @@ class ClassHierarchy(object):
         return min((dist1[hyp] + dist2[hyp] for hyp in common_hypernyms), default = None)
     
     
+    def path_similarity(self, a, b):
+        """ Computes the path similarity of two elements, i.e., the inverse of the length of the shortest path between them plus one.
+        
+        a - The ID of the first term.
+        b - The ID of the second term.
+        
+        Returns: similarity score in the range (0,1] or `None` if there is no path between the two elements.
+        """
+        
+        dist = self.shortest_path_length(a, b)
+        return 1.0 / (dist + 1) if dist is not None else None
+    
+    
+    def lch_similarity(self, a, b):
+        """ Computes the Leacock-Chodorow similarity of two elements, i.e., `-log((p + 1) / (2 * d))`, where `p` is the length of the shortest path
+        between the two elements and `d` is the maximum depth of the hierarchy.
+        
+        a - The ID of the first term.
+        b - The ID of the second term.
+        
+        Returns: similarity score or `None` if there is no path between the two elements.
+        """
+        
+        dist = self.shortest_path_length(a, b)
+        return -np.log((dist + 1) / (2.0 * int(self._max_depths.max()))) if dist is not None else None
+    
+    
     def depth(self, id, use_min_depth = False):
         """ Determines the depth of a certain element in the hierarchy.
         
@@ -165,15 +470,9 @@ class ClassHierarchy(object):
         Returns: the depth of the given element. Root nodes have depth 1.
         """
         
-        if id not in self._depths[use_min_depth]:
-            
-            if (not id in self.parents) or (len(self.parents[id]) == 0):
-                self._depths[use_min_depth][id] = 1 # root nodes have depth 1
-            else:
-                parent_depths = (self.depth(p, use_min_depth) for p in self.parents[id])
-                self._depths[use_min_depth][id] = 1 + min(parent_depths) if use_min_depth else 1 + max(parent_depths)
-        
-        return self._depths[use_min_depth][id]
+        if id not in self._node_index:
+            return 1 # nodes not contained in the hierarchy are treated as isolated roots
+        return int(self._min_depths[self._node_index[id]] if use_min_depth else self._max_depths[self._node_index[id]])
     
     
     def wup_similarity(self, a, b):
@@ -185,6 +484,14 @@ class ClassHierarchy(object):
         Returns: similarity score in the range (0,1].
         """
         
+        if (a in self._pair_index) and (b in self._pair_index):
+            return float(self._pair_wup[self._pair_index[a], self._pair_index[b]])
+        
+        if (a in self._node_index) and (b in self._node_index) and (self._compute_lca_tables() is not None):
+            # In a tree, the path from a node to any of its ancestors is unique
+            ds = int(self._max_depths[self._node_index[self.lcs(a, b)]])
+            return (2.0 * ds) / (self.depth(a) + self.depth(b))
+        
         if (a,b) not in self._wup_cache:
         
             lcs = self.lcs(a, b)
@@ -205,10 +512,197 @@ class ClassHierarchy(object):
         Returns: dissimilarity score in the range [0,1].
         """
         
-        return self.heights[self.lcs(a, b)] / self.max_height
+        return int(self._heights[self._node_index[self.lcs(a, b)]]) / self.max_height
+    
+    
+    def _pair_similarities(self, a, bs):
+        """ Computes the Wu-Palmer similarity and the LCS height based similarity (`1 - lcs_height`) of a class to a list of classes.
+        
+        Dense pair tables will be used if they contain all classes.
+        
+        Returns: tuple of two lists with similarities
+        """
+        
+        if a in self._pair_index:
+            try:
+                row, cols = self._pair_index[a], [self._pair_index[b] for b in bs]
+            except KeyError:
+                pass
+            else:
+                return self._pair_wup[row, cols].tolist(), (1.0 - self._heights[self._pair_lcs[row, cols]] / self.max_height).tolist()
+        
+        return [self.wup_similarity(a, b) for b in bs], [1.0 - self.lcs_height(a, b) for b in bs]
+    
+    
+    def pair_tables(self, labels):
+        """ Computes the lowest common subsumers and Wu-Palmer similarities of all pairs of given classes.
+        
+        labels - List of class IDs.
+        
+        Returns: dictionary with the following items:
+            - 'labels': the given list of class IDs.
+            - 'lcs_nodes': list of IDs of all nodes being the LCS of at least one pair.
+            - 'lcs': `n-by-n` matrix with indices into 'lcs_nodes', where `n` is the number of classes.
+            - 'wup': `n-by-n` matrix with Wu-Palmer similarities.
+            The result can be passed to `load_pair_tables()` of another instance of the same hierarchy.
+        """
+        
+        labels = list(labels)
+        
+        if all(lbl in self._node_index for lbl in labels) and (self._compute_lca_tables() is not None):
+            ind = np.array([self._node_index[lbl] for lbl in labels], dtype = np.int32)
+            lca = self._tree_lca(ind[:,None], ind[None,:])
+            lcs_nodes, lcs = np.unique(lca, return_inverse = True)
+            depths = self._max_depths.astype(np.float64)
+            wup = np.where(lca >= 0, 2.0 * depths[lca], 0.0) / (depths[ind][:,None] + depths[ind][None,:])
+            return {
+                'labels' : labels,
+                'lcs_nodes' : [self._node_ids[node] if node >= 0 else None for node in lcs_nodes.tolist()],
+                'lcs' : lcs.reshape(lca.shape).astype(np.int32),
+                'wup' : wup
+            }
+        
+        node_ind = {}
+        lcs = np.zeros((len(labels), len(labels)), dtype = np.int32)
+        wup = np.ones((len(labels), len(labels)))
+        for i, a in enumerate(labels):
+            for j in range(i, len(labels)):
+                wup[i,j] = wup[j,i] = self.wup_similarity(a, labels[j])
+                lcs[i,j] = lcs[j,i] = node_ind.setdefault(self.lcs(a, labels[j]), len(node_ind))
+        lcs_nodes = [node for node, ind in sorted(node_ind.items(), key = lambda t: t[1])]
+        return { 'labels' : labels, 'lcs_nodes' : lcs_nodes, 'lcs' : lcs, 'wup' : wup }
     
     
-    def hierarchical_precision(self, retrieved, labels, ks = [1, 10, 50, 100], compute_ahp = False, compute_ap = False, ignore_qids = True, all_ids = None):
+    def similarity_matrix(self, labels, metric = 'lcs'):
+        """ Computes a dense matrix of similarities between all pairs of given classes.
+        
+        Dense pair tables will be used if they contain all classes. Otherwise, they will be computed, but not stored.
+        
+        labels - List of class IDs.
+        metric - Either 'lcs' for the LCS height based similarity (`1 - lcs_height`) or 'wup' for the Wu-Palmer similarity.
+                 Pairs of classes without a common subsumer have an 'lcs' similarity of 0.
+        
+        Returns: `n-by-n` numpy array, where `n` is the number of classes.
+        """
+        
+        if metric not in ('lcs', 'wup'):
+            raise ValueError('Unknown similarity metric: {}'.format(metric))
+        
+        labels = list(labels)
+        if all(lbl in self._pair_index for lbl in labels):
+            ind = np.array([self._pair_index[lbl] for lbl in labels], dtype = np.int64)
+            if metric == 'wup':
+                return self._pair_wup[np.ix_(ind, ind)]
+            lcs = self._pair_lcs[np.ix_(ind, ind)]
+        else:
+            tables = self.pair_tables(labels)
+            if metric == 'wup':
+                return tables['wup']
+            lcs_nodes = np.array([self._node_index[node] if node is not None else -1 for node in tables['lcs_nodes']] + [-1], dtype = np.int64)
+            lcs = lcs_nodes[tables['lcs']]
+        
+        return np.where(lcs >= 0, 1.0 - self._heights[lcs] / self.max_height, 0.0)
+    
+    
+    def load_pair_tables(self, tables):
+        """ Loads dense tables of pre-computed values used by `lcs()`, `lcs_height()`, `wup_similarity()`, and `hierarchical_precision()`.
+        
+        Previously loaded tables will be replaced.
+        
+        tables - Dictionary of pair tables as returned by `pair_tables()` for the same hierarchy.
+        """
+        
+        lcs_nodes = np.array([self._node_index[node] if node is not None else -1 for node in tables['lcs_nodes']], dtype = np.int32)
+        self._pair_index = { lbl : i for i, lbl in enumerate(tables['labels']) }
+        self._pair_lcs = lcs_nodes[tables['lcs']] if len(lcs_nodes) > 0 else np.asarray(tables['lcs'], dtype = np.int32)
+        self._pair_wup = np.asarray(tables['wup'])
+    
+    
+    def set_target_classes(self, labels):
+        """ Computes dense tables of lowest common subsumers and similarities for all pairs of a given set of classes.
+        
+        Queries for pairs of these classes will then be answered from these tables instead of the bounded caches.
+        Memory consumption grows quadratically with the number of target classes.
+        
+        labels - List of class IDs.
+        """
+        
+        self.load_pair_tables(self.pair_tables(labels))
+    
+    
+    def clear_caches(self):
+        """ Empties all caches for pairs of classes, hypernyms of classes, and sub-hierarchies. Dense pair tables are kept. """
+        
+        for cache in (self._hyp_depth_cache[False], self._hyp_depth_cache[True], self._hyp_dist_cache, self._lcs_cache, self._wup_cache, self._subsets):
+            cache.clear()
+    
+    
+    def memory_usage(self):
+        """ Estimates the memory consumed by the internal data structures.
+        
+        Returns: ordered dictionary mapping the names of data structures to their (approximate) size in bytes, including the total size.
+        """
+        
+        usage = OrderedDict()
+        usage['node_ids'] = sys.getsizeof(self._node_ids) + sys.getsizeof(self._node_index) + sum(sys.getsizeof(id) for id in self._node_ids)
+        usage['graph'] = sum(arr.nbytes for arr in (self._parent_ptr, self._parent_ind, self._child_ptr, self._child_ind))
+        usage['depths_heights'] = sum(arr.nbytes for arr in (self._topological_order, self._min_depths, self._max_depths, self._heights))
+        usage['dicts'] = sum(_dict_size(d) for d in (self._parents_dict, self._children_dict, self._heights_dict) if d is not None)
+        usage['path_counts'] = sys.getsizeof(self._path_counts) + sum(sys.getsizeof(c) for c in self._path_counts) if self._path_counts is not None else 0
+        usage['pair_tables'] = sys.getsizeof(self._pair_index) + self._pair_lcs.nbytes + self._pair_wup.nbytes
+        usage['hypernym_caches'] = self._hyp_depth_cache[False].memory_usage() + self._hyp_depth_cache[True].memory_usage() + self._hyp_dist_cache.memory_usage()
+        usage['pair_caches'] = self._lcs_cache.memory_usage() + self._wup_cache.memory_usage()
+        usage['total'] = sum(usage.values())
+        return usage
+    
+    
+    def precision_reference(self, labels, kmax = None, query_classes = None):
+        """ Pre-computes class similarities and optimal rankings for computing hierarchical precision on a given set of images.
+        
+        The result only depends on the labels of the images and can be passed to `hierarchical_precision()` for evaluating
+        any number of rankings of these images without repeating this computation.
+        
+        labels - Dictionary mapping image IDs to class labels or list of class labels, whose indices are used as image IDs.
+        kmax - Optionally, the largest cut-off point that will be evaluated. Optimal rankings will then only be stored up to
+               position `kmax + 1`, which is not sufficient for computing AHP over entire rankings.
+        query_classes - Optionally, a list of classes of query images that are not part of the database given by `labels`.
+        
+        Returns: dictionary with the following items:
+            - 'index': dictionary mapping image IDs to row indices or None if `labels` is a list.
+            - 'classes': list of all distinct class labels, including `query_classes`.
+            - 'label_ind': vector with the index of the class of each image in 'classes'.
+            - 'wup' and 'lcs': `c-by-c` matrices with Wu-Palmer and LCS height based similarities between all classes.
+            - 'best_wup_cum' and 'best_lcs_cum': `c-by-m` matrices with the cumulative sums of similarities over the optimal
+              ranking of all images for a query of each class.
+        """
+        
+        if isinstance(labels, dict):
+            index = { id : i for i, id in enumerate(labels.keys()) }
+            labels = list(labels.values())
+        else:
+            index = None
+        classes, label_ind = np.unique(labels, return_inverse = True)
+        classes = classes.tolist()
+        if query_classes is not None:
+            class_set = set(classes)
+            classes += sorted(set(lbl for lbl in query_classes if lbl not in class_set), key = str)
+        
+        num_images = len(label_ind)
+        length = num_images if kmax is None else min(num_images, kmax + 1)
+        counts = np.bincount(label_ind, minlength = len(classes))
+        reference = { 'index' : index, 'classes' : classes, 'label_ind' : label_ind.astype(np.int32) }
+        for metric in ('wup', 'lcs'):
+            sim = self.similarity_matrix(classes, metric)
+            order = np.argsort(-sim, axis = -1, kind = 'stable')
+            best_cum = np.empty((len(classes), length))
+            for c in range(len(classes)):
+                best_cum[c] = np.cumsum(np.repeat(sim[c, order[c]], counts[order[c]])[:length])
+            reference[metric] = sim
+            reference['best_{}_cum'.format(metric)] = best_cum
+        return reference
+    
+    
+    def hierarchical_precision(self, retrieved, labels, ks = [1, 10, 50, 100], compute_ahp = False, compute_ap = False, ignore_qids = True, all_ids = None, reference = None, query_labels = None):
         """ Computes average hierarchical precision for lists of retrieved images at several cut-off points.
         
         Hierarchical precision is a generalization of Precision@K which takes class similarities into account and is defined as the sum
@@ -230,6 +724,12 @@ class ClassHierarchy(object):
                      correct one are considered to be equally wrong.
         ignore_qids - If set to `True`, query ids appearing in the retrieved ranking will be ignored.
         all_ids - Optionally, a list with the IDs of all images in the database. IDs missing in retrieval results will be appended to the end in arbitrary order.
+        reference - Optionally, class similarities and optimal rankings for `labels` as returned by `precision_reference()`.
+                    If not given, they will be computed by this method. Passing them saves this computation when several
+                    rankings of the same images are evaluated.
+        query_labels - Optionally, a dictionary mapping query image IDs to class labels if the queries are not part of the database of
+                       retrieved images given by `labels`. In that case, `reference` must have been computed with the classes of
+                       the queries as `query_classes` and `ignore_qids` has no effect.
         
         Returns: tuple with 2 items:
             1. dictionary with averages of hierarchical precisions over all queries
@@ -251,71 +751,144 @@ class ClassHierarchy(object):
         if compute_ap:
             prec['AP'] = {}
         
-        best_wup_cum = {}
-        best_lcs_cum = {}
+        # Determine optimal rankings for all classes
+        if reference is None:
+            reference = self.precision_reference(
+                labels, None if compute_ahp is True else kmax,
+                (query_labels.values() if isinstance(query_labels, dict) else query_labels) if query_labels is not None else None
+            )
+        elif (compute_ahp is True) and (reference['best_wup_cum'].shape[1] < len(reference['label_ind'])):
+            raise ValueError('The given reference is too short for computing AHP over entire rankings.')
+        index, label_ind = reference['index'], reference['label_ind']
+        if query_labels is not None:
+            class_index = { lbl : i for i, lbl in enumerate(reference['classes']) }
         
         for qid, ret in (retrieved if isinstance(retrieved, types.GeneratorType) else retrieved.items()):
             
-            lbl = labels[qid]
-            
             # Append missing images to the end of the ranking for proper determination of the optimal ranking
             if all_ids and (len(ret) < len(all_ids)):
                 sret = set(ret)
                 ret = ret + [id for id in all_ids if id not in sret]
             
-            # Compute WUP similarity and determine optimal ranking for this label
-            if (lbl not in best_wup_cum) or (compute_ahp is True):
-                # We inlined the cache lookup from self.wup_similarity() here to reduce unnecessary function calls.
-                wup = [self._wup_cache[(lbl, labels[r])] if (lbl, labels[r]) in self._wup_cache else self.wup_similarity(lbl, labels[r]) for r in ret]
-                if lbl not in best_wup_cum:
-                    best_wup_cum[lbl] = np.cumsum(sorted(wup, reverse = True))
+            if query_labels is not None:
+                qind, lbl = -1, class_index[query_labels[qid]]
             else:
-                wup = [self._wup_cache[(lbl, labels[r])] if (lbl, labels[r]) in self._wup_cache else self.wup_similarity(lbl, labels[r]) for r in ret[:kmax+1]]
+                qind = index[qid] if index is not None else qid
+                lbl = label_ind[qind]
+            ret = np.asarray([index[r] for r in ret] if index is not None else ret, dtype = np.int64)
+            ret_labels = label_ind[ret] if compute_ahp is True else label_ind[ret[:kmax+1]]
             
-            # Compute LCS height based similarity and determine optimal ranking for this label
-            if (lbl not in best_lcs_cum) or (compute_ahp is True):
-                # We inline self.lcs_height() here to reduce function calls.
-                # We also don't need to check whether the class pair is cached in self._lcs_cache, since we computed the WUP before which does that implicitly.
-                lcs = (1.0 - np.array([self.heights[self._lcs_cache[(lbl, labels[r])]] for r in ret]) / self.max_height).tolist()
-                if lbl not in best_lcs_cum:
-                    best_lcs_cum[lbl] = np.cumsum(sorted(lcs, reverse = True))
-            else:
-                lcs = (1.0 - np.array([self.heights[self._lcs_cache[(lbl, labels[r])]] for r in ret[:kmax+1]]) / self.max_height).tolist()
+            # Look up WUP and LCS height based similarities
+            wup = reference['wup'][lbl, ret_labels]
+            lcs = reference['lcs'][lbl, ret_labels]
+            cum_best_wup = reference['best_wup_cum'][lbl, :len(ret)]
+            cum_best_lcs = reference['best_lcs_cum'][lbl, :len(ret)]
             
             # Remove query from retrieval list
-            cum_best_wup = best_wup_cum[lbl]
-            cum_best_lcs = best_lcs_cum[lbl]
             if ignore_qids:
-                try:
-                    qid_ind = ret.index(qid)
-                    if qid_ind < len(wup):
-                        del wup[qid_ind]
-                        del lcs[qid_ind]
-                        cum_best_wup = np.concatenate((cum_best_wup[:qid_ind], cum_best_wup[qid_ind+1:] - 1.0))
-                        cum_best_lcs = np.concatenate((cum_best_lcs[:qid_ind], cum_best_lcs[qid_ind+1:] - 1.0))
-                except ValueError:
-                    pass
+                qid_ind = np.flatnonzero(ret[:len(wup)] == qind)
+                if len(qid_ind) > 0:
+                    qid_ind = qid_ind[0]
+                    wup = np.delete(wup, qid_ind)
+                    lcs = np.delete(lcs, qid_ind)
+                    cum_best_wup = np.concatenate((cum_best_wup[:qid_ind], cum_best_wup[qid_ind+1:] - 1.0))
+                    cum_best_lcs = np.concatenate((cum_best_lcs[:qid_ind], cum_best_lcs[qid_ind+1:] - 1.0))
             
             # Compute hierarchical precision for several cut-off points
+            cum_wup = np.cumsum(wup)
+            cum_lcs = np.cumsum(lcs)
             for k in ks:
-                prec['P@{} (WUP)'.format(k)][qid]        = sum(wup[:k]) / cum_best_wup[k-1]
-                prec['P@{} (LCS_HEIGHT)'.format(k)][qid] = sum(lcs[:k]) / cum_best_lcs[k-1]
+                prec['P@{} (WUP)'.format(k)][qid]        = cum_wup[min(k, len(cum_wup)) - 1] / cum_best_wup[k-1]
+                prec['P@{} (LCS_HEIGHT)'.format(k)][qid] = cum_lcs[min(k, len(cum_lcs)) - 1] / cum_best_lcs[k-1]
             if compute_ahp:
                 if isinstance(compute_ahp, bool):
-                    prec['AHP (WUP)'][qid]        = np.trapz(np.cumsum(wup) / cum_best_wup, dx=1./len(wup))
-                    prec['AHP (LCS_HEIGHT)'][qid] = np.trapz(np.cumsum(lcs) / cum_best_lcs, dx=1./len(lcs))
+                    prec['AHP (WUP)'][qid]        = np.trapz(cum_wup / cum_best_wup, dx=1./len(wup))
+                    prec['AHP (LCS_HEIGHT)'][qid] = np.trapz(cum_lcs / cum_best_lcs, dx=1./len(lcs))
                 else:
-                    prec['AHP{} (WUP)'.format(ahp_suffix)][qid] = np.trapz(np.cumsum(wup[:compute_ahp]) / cum_best_wup[:compute_ahp], dx=1./compute_ahp)
-                    prec['AHP{} (LCS_HEIGHT)'.format(ahp_suffix)][qid] = np.trapz(np.cumsum(lcs[:compute_ahp]) / cum_best_lcs[:compute_ahp], dx=1./compute_ahp)
+                    prec['AHP{} (WUP)'.format(ahp_suffix)][qid] = np.trapz(cum_wup[:compute_ahp] / cum_best_wup[:compute_ahp], dx=1./compute_ahp)
+                    prec['AHP{} (LCS_HEIGHT)'.format(ahp_suffix)][qid] = np.trapz(cum_lcs[:compute_ahp] / cum_best_lcs[:compute_ahp], dx=1./compute_ahp)
             if compute_ap:
-                prec['AP'][qid] = average_precision_score(
-                    [labels[r] == lbl for r in ret if (not ignore_qids) or (r != qid)],
-                    [-i for i, r in enumerate(ret) if (not ignore_qids) or (r != qid)]
-                )
+                prec['AP'][qid] = average_precision(ret[None,:], label_ind, [lbl], [qind] if ignore_qids and (qind >= 0) else None)[0]
         
         return { metric : sum(values.values()) / len(values) for metric, values in prec.items() }, prec
     
     
+    def subset(self, labels, collapse_unary = True, precompute_tables = True):
+        """ Extracts the minimal hierarchy induced by a subset of classes.
+        
+        The induced hierarchy contains the given classes and all their hypernyms, but no descendants of the given classes
+        and no other nodes. Thus, the given classes become leaves, heights are measured with respect to the subset, and
+        queries only touch relevant nodes. Results are memoized for the most recently used subsets.
+        
+        labels - List of class IDs.
+        collapse_unary - If set to `True`, hypernyms which are not in `labels` and have only a single child in the induced
+                         hierarchy will be removed and their child will be connected to their parents directly.
+                         This is similar to the way the pruned WordNet hierarchy for ILSVRC has been created.
+        precompute_tables - If set to `True`, dense tables of lowest common subsumers and similarities will be computed for all pairs
+                            of the given classes (see `set_target_classes()`), unless there are more than `MAX_DENSE_CLASSES` classes.
+        
+        Returns: a new ClassHierarchy instance
+        """
+        
+        labels = list(OrderedDict.fromkeys(labels).keys())
+        key = (frozenset(labels), bool(collapse_unary))
+        if key in self._subsets:
+            return self._subsets[key]
+        
+        unknown = [lbl for lbl in labels if lbl not in self._node_index]
+        if len(unknown) > 0:
+            raise KeyError('Classes not contained in the hierarchy: {}'.format(unknown[:10]))
+        
+        # Determine all hypernyms of the given classes
+        keep = np.zeros(len(self._node_ids), dtype = bool)
+        frontier = np.array([self._node_index[lbl] for lbl in labels], dtype = np.int32)
+        keep[frontier] = True
+        while frontier.size > 0:
+            parents = np.concatenate([self._parent_ind[self._parent_ptr[node]:self._parent_ptr[node+1]] for node in frontier.tolist()] + [np.zeros(0, dtype = np.int32)])
+            frontier = np.unique(parents[~keep[parents]])
+            keep[frontier] = True
+        
+        # Build induced hierarchy, keeping the original order of nodes and edges
+        ptr, ind = self._parent_ptr.tolist(), self._parent_ind.tolist()
+        kept_nodes = np.flatnonzero(keep).tolist()
+        parents = OrderedDict((self._node_ids[node], [self._node_ids[parent] for parent in ind[ptr[node]:ptr[node+1]]]) for node in kept_nodes)
+        children = OrderedDict((self._node_ids[node], []) for node in kept_nodes)
+        for child, child_parents in parents.items():
+            for parent in child_parents:
+                children[parent].append(child)
+        
+        # Remove nodes with a single child which are not among the given classes
+        if collapse_unary:
+            label_set = set(labels)
+            queue = [id for id in reversed(list(parents.keys())) if id not in label_set]
+            while len(queue) > 0:
+                id = queue.pop()
+                if (id not in children) or (len(children[id]) != 1):
+                    continue
+                child = children.pop(id)[0]
+                id_parents = parents.pop(id)
+                child_parents = parents[child]
+                pos = child_parents.index(id)
+                child_parents[pos:pos+1] = [parent for parent in id_parents if parent not in child_parents]
+                for parent in id_parents:
+                    siblings = children[parent]
+                    if child in siblings:
+                        siblings.remove(id)
+                        queue.append(parent) # parent might have become unary
+                    else:
+                        siblings[siblings.index(id)] = child
+        
+        subset = type(self)(
+            OrderedDict((id, p) for id, p in parents.items() if len(p) > 0),
+            OrderedDict((id, c) for id, c in children.items() if len(c) > 0),
+            self._lcs_cache.max_size
+        )
+        if precompute_tables and (len(labels) <= MAX_DENSE_CLASSES):
+            subset.set_target_classes(labels)
+        self._subsets[key] = subset
+        return subset
+    
+    
     def save(self, filename, is_a_relations = False):
         """ Writes the hierarchy structure to a text file as lines of parent-child or child-parent tuples.
         
@@ -334,17 +907,127 @@ class ClassHierarchy(object):
                         f.write('{} {}\n'.format(parent, child))
     
     
+    def save_npz(self, filename, metadata = {}):
+        """ Writes the hierarchy to a binary file in numpy's `.npz` format, which can be loaded much faster than text files using `from_npz()`.
+        
+        The file contains the table of node IDs, the parent and child relations in CSR format, the depths and heights of all nodes,
+        and, if the hierarchy is a tree, the tables for finding lowest common ancestors. The file is not compressed, so that
+        loading it does not require more than reading it.
+        
+        filename - Path to the file to be written.
+        metadata - Dictionary with additional items to be stored in the file.
+        """
+        
+        node_ids = np.array(self._node_ids)
+        if node_ids.dtype.kind not in 'iU':
+            raise ValueError('Only integer and string IDs can be stored in binary format.')
+        
+        arrays = {
+            'format_version' : np.int32(NPZ_FORMAT_VERSION),
+            'node_ids' : node_ids,
+            'parent_ptr' : self._parent_ptr,
+            'parent_ind' : self._parent_ind,
+            'child_ptr' : self._child_ptr,
+            'child_ind' : self._child_ind,
+            'topological_order' : self._topological_order,
+            'min_depths' : self._min_depths,
+            'max_depths' : self._max_depths,
+            'heights' : self._heights
+        }
+        lca_tables = self._compute_lca_tables()
+        if lca_tables is not None:
+            arrays['lca_first'], arrays['lca_sparse'] = lca_tables[:2]
+        arrays.update(metadata)
+        
+        with open(filename, 'wb') as f:
+            np.savez(f, **arrays)
+    
+    
+    @classmethod
+    def from_npz(cls, filename, cache_size = 1000000):
+        """ Loads a hierarchy written by `save_npz()`.
+        
+        filename - Path to the `.npz` file.
+        cache_size - Maximum number of items in each cache. See `__init__()`.
+        
+        Returns: a new ClassHierarchy instance
+        """
+        
+        with np.load(filename, allow_pickle = False) as f:
+            if int(f['format_version']) != NPZ_FORMAT_VERSION:
+                raise ValueError('Unsupported format version of binary hierarchy file: {}'.format(int(f['format_version'])))
+            
+            hierarchy = cls.__new__(cls)
+            hierarchy._init_caches(cache_size)
+            hierarchy._node_ids = f['node_ids'].tolist()
+            hierarchy._node_index = { id : i for i, id in enumerate(hierarchy._node_ids) }
+            for name in ('parent_ptr', 'parent_ind', 'child_ptr', 'child_ind', 'topological_order', 'min_depths', 'max_depths', 'heights'):
+                setattr(hierarchy, '_' + name, f[name])
+            hierarchy.max_height = int(hierarchy._heights.max())
+            if 'lca_first' in f:
+                hierarchy._lca_tables = (f['lca_first'], f['lca_sparse'], np.append(hierarchy._max_depths, np.int32(0)))
+        
+        return hierarchy
+    
+    
+    @staticmethod
+    def sidecar_filename(rel_file):
+        """ Returns the name of the binary file that `from_file()` looks for next to a text file with relations. """
+        
+        return rel_file + '.npz'
+    
+    
+    @classmethod
+    def convert(cls, rel_file, out_file = None, is_a_relations = False, id_type = str):
+        """ Converts a text file with parent-child or child-parent relations to the binary format.
+        
+        By default, the binary file will be stored next to the text file, so that it is used by `from_file()` automatically
+        as long as the text file is not modified.
+        
+        rel_file - Path to a text file with relations (see `from_file()`).
+        out_file - Path of the binary file. Defaults to `sidecar_filename(rel_file)`.
+        is_a_relations - If set to `True`, `rel_file` is supposed to contain `<child> <parent>` tuples, otherwise `<parent> <child>` tuples.
+        id_type - Data type of element IDs.
+        
+        Returns: the hierarchy
+        """
+        
+        hierarchy = cls.from_file(rel_file, is_a_relations, id_type, use_sidecar = False)
+        hierarchy.save_npz(out_file or cls.sidecar_filename(rel_file), {
+            'source_sha1' : np.array(_file_sha1(rel_file)),
+            'source_is_a' : np.bool_(is_a_relations),
+            'id_type' : np.array(id_type.__name__)
+        })
+        return hierarchy
+    
+    
     @classmethod
-    def from_file(cls, rel_file, is_a_relations = False, id_type = str):
+    def from_file(cls, rel_file, is_a_relations = False, id_type = str, cache_size = 1000000, use_sidecar = True):
         """ Constructs a class hierarchy based on a file with parent-child relations.
         
+        Files with the extension `.npz` are loaded using `from_npz()`. If a binary file created by `convert()` is found next to a text file,
+        it will be loaded instead of parsing the text file, unless the text file or the parsing options have been changed since the conversion.
+        
         rel_file - Path to a file specifying the relations between elements in the hierarchy, given by lines of ID tuples.
         is_a_relations - If set to `True`, `rel_file` is supposed to contain `<child> <parent>` tuples, otherwise `<parent> <child>` tuples.
         id_type - Data type of element IDs.
+        cache_size - Maximum number of items in each cache. See `__init__()`.
+        use_sidecar - Whether to load a binary file created by `convert()` if available.
         
         Returns: a new ClassHierarchy instance
         """
         
+        if rel_file.endswith('.npz'):
+            return cls.from_npz(rel_file, cache_size)
+        
+        sidecar = cls.sidecar_filename(rel_file)
+        if use_sidecar and os.path.exists(sidecar):
+            with np.load(sidecar, allow_pickle = False) as f:
+                is_valid = ('source_sha1' in f) and (str(f['source_sha1']) == _file_sha1(rel_file)) \
+                           and (bool(f['source_is_a']) == bool(is_a_relations)) and (str(f['id_type']) == id_type.__name__)
+            if is_valid:
+                return cls.from_npz(sidecar, cache_size)
+        
         parents, children = {}, {}
         with open(rel_file) as f:
             for l in f:
@@ -364,4 +1047,108 @@ class ClassHierarchy(object):
                     else:
                         children[parent] = [child]
         
-        return cls(parents, children)
+        return cls(parents, children, cache_size)
+
+
+
+class LRUCache(object):
+    """ Dictionary-like cache holding at most a given number of items, discarding the least recently used items first. """
+    
+    def __init__(self, max_size = None):
+        """ Initializes a new cache.
+        
+        max_size - Maximum number of items. `None` means unbounded.
+        """
+        
+        object.__init__(self)
+        self.max_size = max_size
+        self._items = OrderedDict()
+    
+    
+    def __len__(self):
+        
+        return len(self._items)
+    
+    
+    def __contains__(self, key):
+        
+        return key in self._items
+    
+    
+    def __getitem__(self, key):
+        
+        value = self._items[key]
+        self._items.move_to_end(key)
+        return value
+    
+    
+    def __setitem__(self, key, value):
+        
+        self._items[key] = value
+        self._items.move_to_end(key)
+        if (self.max_size is not None) and (len(self._items) > self.max_size):
+            self._items.popitem(last = False)
+    
+    
+    def clear(self):
+        
+        self._items.clear()
+    
+    
+    def memory_usage(self):
+        """ Estimates the memory consumed by the cache in bytes, including keys and values, but not objects referenced by them. """
+        
+        return _dict_size(self._items)
+
+
+
+def _file_sha1(filename):
+    """ Computes the SHA-1 hash of the contents of a file and returns it as hex string. """
+    
+    h = hashlib.sha1()
+    with open(filename, 'rb') as f:
+        for block in iter(lambda: f.read(1 << 20), b''):
+            h.update(block)
+    return h.hexdigest()
+
+
+def _dict_size(d):
+    """ Estimates the memory consumed by a dictionary including its keys and values, but not objects referenced by them. """
+    
+    return sys.getsizeof(d) + sum(sys.getsizeof(k) + sys.getsizeof(v) for k, v in d.items())
+
+
+def _csr(rows, cols, num_rows):
+    """ Converts a list of edges given by `rows` and `cols` to an adjacency matrix in CSR format.
+    
+    The order of edges with the same row is preserved.
+    
+    Returns: tuple of two int32 numpy arrays: the index of the first edge of each row (followed by the total number of edges) and the column of each edge
+    """
+    
+    order = np.argsort(rows, kind = 'stable')
+    ptr = np.zeros(num_rows + 1, dtype = np.int32)
+    np.cumsum(np.bincount(rows, minlength = num_rows), out = ptr[1:])
+    return ptr, cols[order].astype(np.int32)
+
+
+
+if __name__ == '__main__':
+    
+    parser = argparse.ArgumentParser(description = 'Converts class hierarchies to a binary format that can be loaded much faster.')
+    subparsers = parser.add_subparsers(dest = 'command')
+    convert_parser = subparsers.add_parser('convert', help = 'Converts a text file with parent-child or is-a relationships to the binary format.')
+    convert_parser.add_argument('hierarchy', type = str, nargs = '+', help = 'Path to a file containing parent-child or is-a relationships (one per line).')
+    convert_parser.add_argument('--out', type = str, default = None, help = 'Output filename. Defaults to the input filename with the extension ".npz" appended, which will be used automatically when loading the text file.')
+    convert_parser.add_argument('--is_a', action = 'store_true', default = False, help = 'If given, the hierarchy is assumed to contain is-a instead of parent-child relationships.')
+    convert_parser.add_argument('--str_ids', action = 'store_true', default = False, help = 'If given, class IDs are treated as strings instead of integers.')
+    args = parser.parse_args()
+    
+    if args.command == 'convert':
+        if (args.out is not None) and (len(args.hierarchy) > 1):
+            parser.error('--out cannot be used with multiple input files.')
+        for rel_file in args.hierarchy:
+            hierarchy = ClassHierarchy.convert(rel_file, args.out, args.is_a, str if args.str_ids else int)
+            print('{} -> {} ({} nodes, {})'.format(rel_file, args.out or ClassHierarchy.sidecar_filename(rel_file), len(hierarchy.nodes), 'tree' if hierarchy.is_tree() else 'DAG'))
+    else:
+        parser.print_help()
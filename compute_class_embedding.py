@@ -1,35 +1,64 @@
-import sys
+import sys, os.path
 import numpy as np
-import scipy.linalg, scipy.spatial.distance
+import scipy.linalg, scipy.sparse.linalg, scipy.spatial.distance
 
 import time
 import argparse
 import pickle
 from collections import OrderedDict
 
-from class_hierarchy import ClassHierarchy
+from embedding_cache import EmbeddingCache, add_cache_arguments
 
 
 
-def unitsphere_embedding(class_sim):
+def unitsphere_embedding(class_sim, method = 'cholesky', dtype = np.float64, pivoting = 'auto'):
     """
     Finds an embedding of `n` classes on a unit sphere in `n`-dimensional space, so that their dot products correspond
     to pre-defined similarities.
     
     class_sim - `n-by-n` matrix specifying the desired similarity between each pair of classes.
+    method - Either 'cholesky' or 'iterative'. The embedding is the Cholesky factor of `class_sim`, which is computed
+             by a blocked LAPACK routine by the 'cholesky' method. The 'iterative' method places one class after
+             another by solving a growing linear equation system, which takes O(n^4) time in total.
+    dtype - The floating point type used for computations (e.g., `np.float32` or `np.float64`).
+    pivoting - Whether to use a Cholesky factorization with complete pivoting, which can handle rank-deficient
+               similarity matrices (e.g., if the similarity between two different classes is 1).
+               In that case, the embedding will not be lower triangular in general and all dimensions beyond
+               the rank of `class_sim` will be 0. If set to 'auto', pivoting will only be used if the
+               factorization without pivoting fails. Only applies to the 'cholesky' method.
     
     Returns: `n-by-n` matrix with rows being the locations of the corresponding classes in the embedding space.
+             Unless pivoting has been used, the matrix is lower triangular.
     """
     
     # Check arguments
+    class_sim = np.asarray(class_sim, dtype = dtype)
     if (class_sim.ndim != 2) or (class_sim.shape[0] != class_sim.shape[1]):
         raise ValueError('Given class_sim has invalid shape. Expected: (n, n). Got: {}'.format(class_sim.shape))
     if (class_sim.shape[0] == 0):
         raise ValueError('Empty class_sim given.')
     
+    if method == 'iterative':
+        return _unitsphere_embedding_iterative(class_sim)
+    elif method != 'cholesky':
+        raise ValueError('Unknown method: {}'.format(method))
+    
+    if pivoting != True:
+        try:
+            return scipy.linalg.cholesky(class_sim, lower = True, check_finite = False)
+        except np.linalg.LinAlgError:
+            if pivoting == False:
+                raise RuntimeError('Given class_sim is not positive definite.')
+    
+    return _pivoted_cholesky(class_sim)
+
+
+def _unitsphere_embedding_iterative(class_sim):
+    """ Places classes on the unit sphere one after another. See `unitsphere_embedding` for details. """
+    
     # Place first class
     nc = class_sim.shape[0]
-    embeddings = np.zeros((nc, nc))
+    embeddings = np.zeros((nc, nc), dtype = class_sim.dtype)
     embeddings[0,0] = 1.
     
     # Iteratively place all remaining classes
@@ -40,14 +69,106 @@ def unitsphere_embedding(class_sim):
     return embeddings
 
 
+def _pivoted_cholesky(class_sim, num_probes = 4):
+    """
+    Computes a factor `E` of a positive semi-definite matrix, so that `np.dot(E, E.T) == class_sim`,
+    using a Cholesky factorization with complete pivoting.
+    
+    LAPACK stops the factorization as soon as the remaining diagonal is numerically zero, which does not necessarily
+    mean that the matrix is positive semi-definite. Thus, the factorization is verified by comparing its product
+    with a few random vectors against the product of `class_sim` with the same vectors.
+    A `RuntimeError` will be raised if they do not match.
+    """
+    
+    nc = class_sim.shape[0]
+    pstrf, = scipy.linalg.get_lapack_funcs(('pstrf',), (class_sim,))
+    factor, piv, rank, info = pstrf(class_sim, lower = True)
+    if info < 0:
+        raise ValueError('Illegal argument #{} passed to {}.'.format(-info, pstrf.typecode + 'pstrf'))
+    
+    # Discard the remainder of the input matrix and the Schur complement left in the output
+    factor = np.tril(factor)
+    factor[:, rank:] = 0
+    
+    # Undo permutation of the rows (LAPACK uses 1-based indices)
+    embeddings = np.empty_like(factor)
+    embeddings[piv - 1] = factor
+    
+    # Verify the factorization
+    probes = np.random.RandomState(0).randn(nc, num_probes).astype(class_sim.dtype)
+    target = np.dot(class_sim, probes)
+    residual = np.dot(embeddings, np.dot(embeddings.T, probes)) - target
+    if np.linalg.norm(residual) > np.sqrt(np.finfo(class_sim.dtype).eps) * max(np.linalg.norm(target), 1.):
+        raise RuntimeError('Given class_sim is not positive semi-definite.')
+    
+    return embeddings
+
+
 
-def sim_approx(class_sim, num_dim = None):
+def extend_unitsphere_embedding(embedding, new_sim, dtype = np.float64, pivoting = 'auto'):
+    """
+    Places additional classes on the unit sphere, given an existing embedding computed by `unitsphere_embedding`,
+    without changing the locations of the existing classes.
+    
+    This corresponds to extending the Cholesky factorization of the similarity matrix by new rows, which takes
+    O(k*n^2) time for `k` new and `n` existing classes.
+    
+    embedding - `n-by-n` lower triangular matrix with rows being the locations of the existing classes.
+    new_sim - `k-by-(n+k)` matrix specifying the desired similarities between the new classes and all classes,
+              with the existing classes coming first.
+    dtype - The floating point type used for computations (e.g., `np.float32` or `np.float64`).
+    pivoting - Whether to use pivoting for placing the new classes relative to each other.
+               See `unitsphere_embedding` for details.
+    
+    Returns: `(n+k)-by-(n+k)` matrix with rows being the locations of all classes in the embedding space.
+             The first `n` rows are the existing locations, padded with zeros.
+             If `k` is 0, the given embedding is returned unchanged.
+    """
+    
+    # Check arguments
+    embedding = np.asarray(embedding, dtype = dtype)
+    new_sim = np.asarray(new_sim, dtype = dtype)
+    if (embedding.ndim != 2) or (embedding.shape[0] != embedding.shape[1]):
+        raise ValueError('Given embedding has invalid shape. Expected: (n, n). Got: {}'.format(embedding.shape))
+    if np.any(np.triu(embedding, 1)):
+        raise ValueError('Given embedding is not lower triangular. It must have been computed by unitsphere_embedding without pivoting.')
+    nc = embedding.shape[0]
+    if (new_sim.ndim != 2) or (new_sim.shape[1] != nc + new_sim.shape[0]):
+        raise ValueError('Given new_sim has invalid shape. Expected: (k, {}+k). Got: {}'.format(nc, new_sim.shape))
+    if len(new_sim) == 0:
+        return embedding
+    
+    # Compute coordinates of the new classes determined by the existing ones
+    try:
+        x = scipy.linalg.solve_triangular(embedding, new_sim[:,:nc].T, lower = True, check_finite = False).T
+    except (np.linalg.LinAlgError, scipy.linalg.LinAlgError):
+        raise RuntimeError('Existing embedding is singular.')
+    
+    # Place new classes relative to each other in the orthogonal complement
+    schur = new_sim[:,nc:] - np.dot(x, x.T)
+    new_embedding = unitsphere_embedding(schur, dtype = dtype, pivoting = pivoting)
+    
+    extended = np.zeros((nc + len(new_sim), nc + len(new_sim)), dtype = dtype)
+    extended[:nc,:nc] = embedding
+    extended[nc:,:nc] = x
+    extended[nc:,nc:] = new_embedding
+    return extended
+
+
+
+def sim_approx(class_sim, num_dim = None, eig_solver = 'auto', return_info = False):
     """
     Finds an embedding of `n` classes in an `d`-dimensional space with `d <= n`, so that their
     dot products best approximate pre-defined similarities.
     
     class_sim - `n-by-n` matrix specifying the desired similarity between each pair of classes.
     num_dim - Optionally, the maximum target dimensionality `d` for the embeddings. If not given, it will be equal to `n`.
+    eig_solver - The eigensolver to be used: 'dense', 'lanczos', 'randomized', or 'auto'. See `truncated_eigh` for details.
+                 The dense solver verifies that `class_sim` is positive semi-definite, while the truncated solvers
+                 can only check the `d` largest eigenvalues.
+    return_info - If True, a dictionary with the keys 'eig_solver' and 'energy' will be returned in addition
+                  to the embedding, specifying the eigensolver used and the fraction of the trace of `class_sim`
+                  captured by the embedding.
     
     Returns: `n-by-d` matrix with rows being the locations of the corresponding classes in the embedding space.
     """
@@ -59,7 +180,7 @@ def sim_approx(class_sim, num_dim = None):
         raise ValueError('Empty class_sim given.')
     
     # Compute optimal embeddings based on eigendecomposition of similarity matrix
-    L, Q = np.linalg.eigh(class_sim)
+    L, Q, eig_solver = truncated_eigh(class_sim, num_dim, eig_solver)
     if np.any(L < 0):
         raise RuntimeError('Given class_sim is not positive semi-definite.')
     embeddings = Q * np.sqrt(L)[None,:]
@@ -68,11 +189,68 @@ def sim_approx(class_sim, num_dim = None):
     if (num_dim is not None) and (num_dim < embeddings.shape[1]):
         embeddings = embeddings[:,-num_dim:]  # pylint: disable=invalid-unary-operand-type
     
-    return embeddings
+    if return_info:
+        return embeddings, { 'eig_solver' : eig_solver, 'energy' : _captured_energy(L[-embeddings.shape[1]:], np.trace(class_sim)) }
+    else:
+        return embeddings
 
 
 
-def euclidean_embedding(class_dist, solver = 'general'):
+def truncated_eigh(A, num_dim = None, eig_solver = 'auto', oversampling = 10, power_iter = 4, seed = 0, overwrite_a = False):
+    """
+    Computes the largest eigenvalues and corresponding eigenvectors of a real symmetric matrix.
+    
+    A - `n-by-n` symmetric matrix.
+    num_dim - The number `d` of eigenvalues required. If not given, all eigenvalues will be computed.
+    eig_solver - The eigensolver to be used. Possible values are:
+                   - 'dense': full eigendecomposition using `np.linalg.eigh`. All eigenpairs will be returned.
+                   - 'lanczos': implicitly restarted Lanczos method as implemented by `scipy.sparse.linalg.eigsh`.
+                   - 'randomized': eigendecomposition of `A` projected onto a subspace found by a randomized
+                                   range finder with `oversampling` additional dimensions and `power_iter` power iterations.
+                                   This is usually faster than Lanczos, but less accurate if the spectrum decays slowly.
+                   - 'auto': 'dense' if `n` is at most 200 or `d` is larger than 20% of `n`, otherwise 'lanczos'.
+                             For such small matrices, a full eigendecomposition is faster than Lanczos iterations.
+                 If `num_dim` is not given or not smaller than `n`, the dense solver will always be used.
+    oversampling - Number of additional dimensions sampled by the randomized solver.
+    power_iter - Number of power iterations performed by the randomized solver.
+    seed - Seed for the random number generator used by the randomized solver.
+    overwrite_a - If True, the dense solver may use `A` as workspace, which saves memory but destroys its contents.
+    
+    Returns: tuple with a 1-d array of eigenvalues in ascending order, a 2-d array whose columns are the corresponding
+             eigenvectors, and the name of the solver that has been used.
+    """
+    
+    n = A.shape[0]
+    if (num_dim is None) or (num_dim >= n):
+        eig_solver = 'dense'
+    elif eig_solver == 'auto':
+        eig_solver = 'dense' if (n <= 200) or (num_dim > 0.2 * n) else 'lanczos'
+    
+    if eig_solver == 'dense':
+        L, Q = scipy.linalg.eigh(A, overwrite_a = overwrite_a, check_finite = False)
+    elif eig_solver == 'lanczos':
+        L, Q = scipy.sparse.linalg.eigsh(A, k = num_dim, which = 'LA')
+    elif eig_solver == 'randomized':
+        Q, _ = np.linalg.qr(np.dot(A, np.random.RandomState(seed).randn(n, min(n, num_dim + oversampling)).astype(A.dtype)))
+        for _ in range(power_iter):
+            Q, _ = np.linalg.qr(np.dot(A, Q))
+        L, V = np.linalg.eigh(np.dot(Q.T, np.dot(A, Q)))
+        L, Q = L[-num_dim:], np.dot(Q, V[:,-num_dim:])
+    else:
+        raise ValueError('Unknown eigensolver: {}'.format(eig_solver))
+    
+    sort_ind = np.argsort(L)
+    return L[sort_ind], Q[:,sort_ind], eig_solver
+
+
+def _captured_energy(eigvals, trace):
+    """ Computes the fraction of the trace of a matrix captured by the given eigenvalues of that matrix. """
+    
+    return float(np.sum(np.maximum(eigvals, 0)) / trace)
+
+
+
+def euclidean_embedding(class_dist, solver = 'general', block_size = 256):
     """
     Finds an embedding of `n` classes in an `(n-1)`-dimensional space, so that their Euclidean distances correspond
     to pre-defined ones.
@@ -80,9 +258,13 @@ def euclidean_embedding(class_dist, solver = 'general'):
     class_dist - `n-by-n` matrix specifying the desired distance between each pair of classes.
                  The distances in this matrix *must* define a proper metric that fulfills the triangle inequality.
                  Otherwise, a `RuntimeError` will be raised.
-    solver - The linear solver to be used. May be either 'general' or 'triangular'. The triangular solver is faster,
+    solver - The linear solver to be used. May be either 'general', 'triangular', or 'incremental'. The triangular solver is faster,
              since we are dealing with an equation system in triangular form here, but less accurate than the
-             general solver.
+             general solver. The incremental solver places blocks of classes at once: the coordinates with respect to
+             all classes placed before the block are obtained by a single triangular solve with multiple right-hand sides,
+             and only the remaining coordinates are computed class by class. Squared norms of the class locations are
+             cached as well. This reduces the total cost from O(n^4) to O(n^3).
+    block_size - Number of classes placed at once by the incremental solver.
     
     Returns: `n-by-(n-1)` matrix with rows being the locations of the corresponding classes in the embedding space.
     """
@@ -93,6 +275,9 @@ def euclidean_embedding(class_dist, solver = 'general'):
     if (class_dist.shape[0] == 0):
         raise ValueError('Empty class_dist given.')
     
+    if solver == 'incremental':
+        return _euclidean_embedding_incremental(class_dist, block_size)
+    
     # Place first class at the origin
     nc = class_dist.shape[0]
     embeddings = np.zeros((nc, nc - 1))
@@ -141,7 +326,67 @@ def euclidean_embedding(class_dist, solver = 'general'):
 
 
 
-def mds(class_dist, num_dim = None):
+def _euclidean_embedding_incremental(class_dist, block_size = 256):
+    """ Places blocks of classes at intersections of hyperspheres. See `euclidean_embedding` for details. """
+    
+    # Place first class at the origin and the second one offset along the first axis by the desired distance
+    nc = class_dist.shape[0]
+    embeddings = np.zeros((nc, nc - 1))
+    sq_norms = np.zeros(nc)
+    if nc > 1:
+        embeddings[1,0] = class_dist[0,1]
+        sq_norms[1] = class_dist[0,1] ** 2
+    
+    for block_start in range(2, nc, block_size):
+        
+        block_end = min(block_start + block_size, nc)
+        radii = class_dist[:block_end, block_start:block_end] ** 2
+        
+        # Compute the first block_start-1 coordinates of all classes in the block, which are fully determined
+        # by the classes placed before the block.
+        centers = embeddings[1:block_start, :block_start-1]
+        b = (radii[0] - radii[1:block_start] + sq_norms[1:block_start,None]) / 2
+        try:
+            x = scipy.linalg.solve_triangular(centers, b, lower = True, check_finite = False)
+        except (np.linalg.LinAlgError, scipy.linalg.LinAlgError):
+            raise RuntimeError('Failed to place class #{}: Hyperspheres do not intersect.'.format(block_start + 1))
+        solve_err = ~np.all(np.isclose(np.dot(centers, x), b), axis = 0)
+        if np.any(solve_err):
+            raise RuntimeError('Failed to place class #{}: Hyperspheres do not intersect.'.format(block_start + np.argmax(solve_err) + 1))
+        embeddings[block_start:block_end, :block_start-1] = x.T
+        
+        # Contribution of these coordinates to the dot products between classes in the block
+        block_dot = np.dot(x.T, x)
+        
+        # Place classes in the block one after another
+        for i, c in enumerate(range(block_start, block_end)):
+            
+            # Compute the coordinates determined by the preceding classes in the same block
+            if i > 0:
+                centers = embeddings[block_start:c, block_start-1:c-1]
+                b = (radii[0,i] - radii[block_start:c,i] + sq_norms[block_start:c]) / 2 - block_dot[:i,i]
+                try:
+                    x = scipy.linalg.solve_triangular(centers, b, lower = True, check_finite = False)
+                    solve_err = not np.allclose(np.dot(centers, x), b)
+                except (np.linalg.LinAlgError, scipy.linalg.LinAlgError):
+                    solve_err = True
+                if solve_err:
+                    raise RuntimeError('Failed to place class #{}: Hyperspheres do not intersect.'.format(c + 1))
+                embeddings[c, block_start-1:c-1] = x
+            
+            # Compute c-th coordindate of the new center
+            d_sq = np.sum(embeddings[c, :c-1] ** 2)
+            if d_sq > radii[0,i]:
+                raise RuntimeError('Failed to place class #{}: There is no common intersection of all spheres (offset: {}).'.format(
+                                   c + 1, np.sqrt(d_sq) - np.sqrt(radii[0,i])))
+            embeddings[c, c-1] = np.sqrt(radii[0,i] - d_sq)
+            sq_norms[c] = d_sq + embeddings[c, c-1] ** 2
+    
+    return embeddings
+
+
+
+def mds(class_dist, num_dim = None, eig_solver = 'auto', return_info = False, dtype = None, out = None):
     """
     Finds an embedding of `n` classes in a `d`-dimensional space, so that their Euclidean distances corresponds
     to pre-defined ones, using classical multidimensional scaling (MDS).
@@ -151,15 +396,34 @@ def mds(class_dist, num_dim = None):
                  Otherwise, a `RuntimeError` will be raised.
     num_dim - Optionally, the maximum target dimensionality `d` for the embeddings. If not given, it will be determined
               automatically based on the eigenvalues, but this might not be accurate due to limited machine precision.
+    eig_solver - The eigensolver to be used: 'dense', 'lanczos', 'randomized', or 'auto'. See `truncated_eigh` for details.
+    return_info - If True, a dictionary with the keys 'eig_solver' and 'energy' will be returned in addition
+                  to the embedding, specifying the eigensolver used and the fraction of the trace of the
+                  double-centered squared distance matrix captured by the embedding.
+    dtype - The floating point type used for computations. Defaults to the type of `out` if given, otherwise to the
+            type of `class_dist`.
+    out - Optionally, an `n-by-n` array used as buffer for the double-centered squared distance matrix, which will
+          be overwritten. This may also be `class_dist` itself. Otherwise, a new one will be allocated.
     
     Returns: `n-by-d` matrix with rows being the locations of the corresponding classes in the embedding space.
     """
 
-    H = np.eye(class_dist.shape[0], dtype=class_dist.dtype) - np.ones(class_dist.shape, dtype=class_dist.dtype) / class_dist.shape[0]
-    B = np.dot(H, np.dot(class_dist ** 2, H)) / -2
+    # Double-centering of the squared distance matrix: B = -1/2 * H * D^2 * H with H = I - 1/n
+    if out is None:
+        out = np.empty(class_dist.shape, dtype = dtype if dtype is not None else class_dist.dtype)
+    elif (out.shape != class_dist.shape) or ((dtype is not None) and (out.dtype != dtype)):
+        raise ValueError('Given buffer must be of shape {} and type {}.'.format(class_dist.shape, dtype))
+    B = np.square(class_dist, out = out, casting = 'same_kind')
+    row_means = B.mean(axis = 1)
+    col_means = B.mean(axis = 0)
+    B -= row_means[:,None]
+    B -= col_means[None,:]
+    B += row_means.mean()
+    B *= -0.5
+    trace = np.trace(B)
 
-    eigval, eigvec = np.linalg.eigh(B)
-    nonzero_eigvals = (eigval > np.finfo(class_dist.dtype).eps)
+    eigval, eigvec, eig_solver = truncated_eigh(B, num_dim, eig_solver, overwrite_a = True)
+    nonzero_eigvals = (eigval > np.finfo(B.dtype).eps)
     eigval = eigval[nonzero_eigvals]
     eigvec = eigvec[:,nonzero_eigvals]
     
@@ -169,7 +433,87 @@ def mds(class_dist, num_dim = None):
         eigvec = eigvec[:,sort_ind[:num_dim]]
 
     embedding = eigvec * np.sqrt(eigval[None,:])
-    return embedding
+    if return_info:
+        return embedding, { 'eig_solver' : eig_solver, 'energy' : _captured_energy(eigval, trace) }
+    else:
+        return embedding
+
+
+
+def embed_classes(class_dist, method = 'unitsphere', num_dim = None, solver = 'general', eig_solver = 'auto', dtype = np.float64):
+    """
+    Computes class embeddings from pairwise class distances using one of the methods supported by this script.
+    
+    class_dist - `n-by-n` matrix specifying the desired distance between each pair of classes.
+    method - One of 'unitsphere', 'approx_sim', 'spheres', or 'mds'.
+    num_dim - Number of embedding dimensions for the 'mds' and 'approx_sim' methods.
+    solver - Linear solver used by the 'spheres' method. See `euclidean_embedding()`.
+    eig_solver - Eigensolver used by the 'mds' and 'approx_sim' methods. See `truncated_eigh()`.
+    dtype - The floating point type used by the 'unitsphere' method.
+    
+    Returns: tuple with the embedding matrix and a dictionary with information about the eigendecomposition
+             (see `mds()`) or `None`.
+    """
+    
+    info = None
+    if method == 'spheres':
+        embedding = euclidean_embedding(class_dist, solver)
+    elif method == 'mds':
+        embedding, info = mds(class_dist, num_dim if num_dim else len(class_dist) - 1, eig_solver = eig_solver, return_info = True)
+    elif method == 'unitsphere':
+        embedding = unitsphere_embedding(1. - class_dist, dtype = dtype)
+    elif method == 'approx_sim':
+        embedding, info = sim_approx(1. - class_dist, num_dim, eig_solver = eig_solver, return_info = True)
+    else:
+        raise ValueError('Unknown method: {}'.format(method))
+    return embedding, info
+
+
+def compute_class_distances(hierarchy, labels, other_labels = None):
+    """
+    Computes the semantic dissimilarity between each pair of classes as the height of their lowest common subsumer.
+    
+    hierarchy - The `ClassHierarchy`.
+    labels - List of the `n` class labels.
+    other_labels - Optionally, a list of `m` other class labels. If given, distances between each class in `labels`
+                   and each class in `other_labels` will be computed.
+    
+    Returns: `n-by-n` matrix with pairwise class distances or `n-by-m` matrix if `other_labels` is given.
+    """
+    
+    if other_labels is not None:
+        return np.array([[hierarchy.lcs_height(a, b) for b in other_labels] for a in labels]).reshape(len(labels), len(other_labels))
+    
+    class_dist = np.zeros((len(labels), len(labels)))
+    for i in range(len(labels)):
+        for j in range(i + 1, len(labels)):
+            class_dist[i,j] = class_dist[j,i] = hierarchy.lcs_height(labels[i], labels[j])
+    return class_dist
+
+
+def output_filename(template, num_dim, append_dim = False, unnormed = False):
+    """
+    Determines the filename for storing embeddings.
+    
+    template - The filename given by the user, which may contain a "{dim}" placeholder.
+    num_dim - Dimensionality of the embeddings.
+    append_dim - If True and `template` does not contain a placeholder, `num_dim` will be inserted before the file extension.
+    unnormed - If True, the suffix "_unnormed" will be inserted before the file extension.
+    
+    Returns: filename
+    """
+    
+    if '{dim}' in template:
+        filename = template.format(dim = num_dim)
+    elif append_dim:
+        base, ext = os.path.splitext(template)
+        filename = '{}{}{}'.format(base, num_dim, ext)
+    else:
+        filename = template
+    if unnormed:
+        base, ext = os.path.splitext(filename)
+        filename = '{}_unnormed{}'.format(base, ext)
+    return filename
 
 
 
@@ -181,6 +525,7 @@ if __name__ == '__main__':
     parser.add_argument('--is_a', action = 'store_true', default = False, help = 'If given, --hierarchy is assumed to contain is-a instead of parent-child relationships.')
     parser.add_argument('--str_ids', action = 'store_true', default = False, help = 'If given, class IDs are treated as strings instead of integers.')
     parser.add_argument('--class_list', type = str, default = None, help = 'Path to a file containing the IDs of the classes to compute embeddings for (as first words per line). If not given, all leaf nodes in the hierarchy will be considered as target classes.')
+    parser.add_argument('--prune_hierarchy', action = 'store_true', default = False, help = 'Compute embeddings based on the sub-hierarchy induced by the target classes, i.e., without nodes that are neither target classes nor their hypernyms and without hypernyms having only a single child.')
     parser.add_argument('--out', type = str, required = True, help = 'Filename of the resulting pickle dump (containing keys "embedding", "ind2label", and "label2ind").')
     parser.add_argument('--method', type = str, default = 'unitsphere', choices = ['unitsphere', 'approx_sim', 'spheres', 'mds'],
                         help = '''Which algorithm to use for computing class embeddings. Options are:
@@ -189,13 +534,35 @@ if __name__ == '__main__':
     - "spheres": Compute (n-1)-dimensional embeddings so that Euclidean distances of class embeddings correspond to their semantic dissimilarity using successive intersections of hyperspheres.
     - "mds": Compute embeddings of arbitrary dimensionality so that Euclidean distances of class embeddings correspond to their semantic dissimilarity using classical multidimensional scaling.
 Default: "unitsphere"''')
-    parser.add_argument('--num_dim', type = int, default = None, help = 'Number of embedding dimensions when using the "mds" or "approx_sim" method.')
-    parser.add_argument('--norm', action = 'store_true', default = False, help = 'Force L2-normalization of computed embeddings (most useful in combination with the approx_sim method).')
+    parser.add_argument('--num_dim', type = str, default = None,
+                        help = '''Number of embedding dimensions when using the "mds" or "approx_sim" method.
+A comma-separated list of dimensionalities (e.g., "8,16,32") computes embeddings for all of them in one pass.
+In that case, --out may contain a "{dim}" placeholder. Otherwise, the dimensionality will be appended to the filename.''')
+    parser.add_argument('--norm', type = str, nargs = '?', default = 'no', const = 'yes', choices = ['no', 'yes', 'both'],
+                        help = '''Force L2-normalization of computed embeddings (most useful in combination with the approx_sim method).
+If set to "both", normalized and unnormalized embeddings will be stored, the latter with the suffix "_unnormed".''')
+    parser.add_argument('--solver', type = str, default = 'general', choices = ['general', 'triangular', 'incremental'], help = 'Linear solver used by the "spheres" method. See the documentation of euclidean_embedding() for details.')
+    parser.add_argument('--eig_solver', type = str, default = 'auto', choices = ['auto', 'dense', 'lanczos', 'randomized'], help = 'Eigensolver used by the "mds" and "approx_sim" methods. "auto" uses a truncated Lanczos solver if there are more than 200 classes and --num_dim is at most 20%% of the number of classes, otherwise a dense eigendecomposition.')
+    parser.add_argument('--append', type = str, default = None,
+                        help = '''Path to a pickle dump of existing embeddings computed with the "unitsphere" method.
+If given, only classes not contained in it will be placed relative to the existing ones. The locations
+and indices of existing classes will not change, so that models trained on them remain valid.''')
+    parser.add_argument('--dtype', type = str, default = 'float64', choices = ['float32', 'float64'], help = 'Floating point precision used for computing embeddings with the "unitsphere" method.')
+    add_cache_arguments(parser)
     args = parser.parse_args()
     id_type = str if args.str_ids else int
+    num_dims = [int(d) for d in args.num_dim.split(',')] if args.num_dim else [None]
+    if (len(num_dims) > 1) and (args.method not in ('mds', 'approx_sim')):
+        parser.error('Multiple dimensionalities are only supported by the "mds" and "approx_sim" methods.')
+    norm_modes = [True, False] if args.norm == 'both' else [args.norm == 'yes']
+    if args.append and ((args.method != 'unitsphere') or (len(num_dims) > 1)):
+        parser.error('--append is only supported by the "unitsphere" method.')
+    if args.append and args.prune_hierarchy:
+        parser.error('--append cannot be combined with --prune_hierarchy.')
     
     # Read hierarchy
-    hierarchy = ClassHierarchy.from_file(args.hierarchy, is_a_relations = args.is_a, id_type = id_type)
+    cache = EmbeddingCache.from_args(args)
+    hierarchy = cache.hierarchy(args.hierarchy, args.is_a, id_type)
     
     # Determine target classes
     if args.class_list is not None:
@@ -205,46 +572,107 @@ Default: "unitsphere"''')
         unique_labels = [lbl for lbl in hierarchy.nodes if (lbl not in hierarchy.children) or (len(hierarchy.children[lbl]) == 0)]
         if not args.str_ids:
             unique_labels.sort()
+    if args.prune_hierarchy:
+        hierarchy = cache.subset(args.hierarchy, unique_labels, args.is_a, id_type)
+        print('Pruned hierarchy to {} nodes.'.format(len(hierarchy.nodes)))
+    
+    # Load existing embeddings and append new classes to the list of labels
+    if args.append:
+        with open(args.append, 'rb') as f:
+            existing = pickle.load(f)
+        num_existing = len(existing['ind2label'])
+        unique_labels = list(existing['ind2label']) + [lbl for lbl in unique_labels if lbl not in existing['label2ind']]
+        missing_labels = [lbl for lbl in existing['ind2label'] if lbl not in hierarchy.nodes]
+        if len(missing_labels) > 0:
+            raise RuntimeError('Existing classes missing in the hierarchy: {}'.format(missing_labels))
     linear_labels = { lbl : i for i, lbl in enumerate(unique_labels) }
     
     # Compute target distances between classes
-    sem_class_dist = np.zeros((len(unique_labels), len(unique_labels)))
-    for i in range(len(unique_labels)):
-        for j in range(i + 1, len(unique_labels)):
-            sem_class_dist[i,j] = sem_class_dist[j,i] = hierarchy.lcs_height(unique_labels[i], unique_labels[j])
+    if args.append:
+        # Only distances of new classes are needed
+        sem_class_dist = np.hstack([
+            compute_class_distances(hierarchy, unique_labels[num_existing:], unique_labels[:num_existing]),
+            compute_class_distances(hierarchy, unique_labels[num_existing:])
+        ])
+        # Verify that the similarities of existing classes are unaffected by changes of the hierarchy
+        rs = np.random.RandomState(0)
+        sample_pairs = rs.randint(num_existing, size = (min(1000, num_existing * num_existing), 2))
+        sample_sim = 1. - np.array([hierarchy.lcs_height(unique_labels[i], unique_labels[j]) for i, j in sample_pairs])
+        sample_error = np.abs(np.sum(existing['embedding'][sample_pairs[:,0]] * existing['embedding'][sample_pairs[:,1]], axis = -1) - sample_sim).max()
+        if sample_error > 1e-5:
+            raise RuntimeError('The existing embeddings deviate from the target similarities by up to {} (e.g., because the height of the hierarchy changed) and need to be re-computed from scratch.'.format(sample_error))
+    else:
+        sem_class_dist = cache.class_distances(args.hierarchy, unique_labels, args.is_a, id_type, args.prune_hierarchy)
     
     # Compute class embeddings
+    # (in sweep mode, embeddings are computed for the largest dimensionality and truncated afterwards)
+    max_dim = None if None in num_dims else max(num_dims)
     start_time = time.time()
-    if args.method == 'spheres':
-        embedding = euclidean_embedding(sem_class_dist)
-    elif args.method == 'mds':
-        embedding = mds(sem_class_dist, args.num_dim if args.num_dim else len(unique_labels) - 1)
-    elif args.method == 'unitsphere':
-        embedding = unitsphere_embedding(1. - sem_class_dist)
-    elif args.method == 'approx_sim':
-        embedding = sim_approx(1. - sem_class_dist, args.num_dim)
+    if args.append:
+        if len(unique_labels) == num_existing:
+            print('No new classes to append. The existing embedding will be kept unchanged.')
+        embedding, info = extend_unitsphere_embedding(existing['embedding'], 1. - sem_class_dist, dtype = np.dtype(args.dtype)), None
     else:
-        raise ValueError('Unknown method: {}'.format(args.method))
+        embedding, info = embed_classes(sem_class_dist, args.method, max_dim, args.solver, args.eig_solver, np.dtype(args.dtype))
     stop_time = time.time()
     print('Computed {}-dimensional semantic embeddings for {} classes using the "{}" method in {} seconds.'.format(
         embedding.shape[1], embedding.shape[0], args.method, stop_time - start_time)
     )
-    if args.method in ('unitsphere', 'approx_sim'):
-        sim_error = np.abs(np.dot(embedding, embedding.T) - (1. - sem_class_dist))
-        print('Maximum deviation from target similarities: {}'.format(sim_error.max()))
-        print('Average deviation from target similarities: {}'.format(sim_error.mean()))
-    else:
-        dist_error = np.abs(scipy.spatial.distance.squareform(scipy.spatial.distance.pdist(embedding)) - sem_class_dist)
-        print('Maximum deviation from target distances: {}'.format(dist_error.max()))
-        print('Average deviation from target distances: {}'.format(dist_error.mean()))
-    
-    if args.norm:
-        embedding /= np.linalg.norm(embedding, axis=-1, keepdims=True)
-    
-    # Store results
-    with open(args.out, 'wb') as dump_file:
-        pickle.dump({
-                'ind2label' : unique_labels,
-                'label2ind' : linear_labels,
-                'embedding' : embedding
-        }, dump_file)
+    if info is not None:
+        print('Captured spectral energy: {:.2%} (eigensolver: {})'.format(info['energy'], info['eig_solver']))
+    
+    sweep_stats = []
+    stored_dims = set()
+    for num_dim in num_dims:
+        
+        # Select the dimensions corresponding to the largest eigenvalues
+        if (num_dim is None) or (num_dim >= embedding.shape[1]):
+            dim_embedding = embedding
+        elif args.method == 'approx_sim':
+            dim_embedding = embedding[:,-num_dim:]
+        else:
+            dim_embedding = embedding[:,:num_dim]
+        
+        # Fewer dimensions than requested may be available (e.g., if MDS dropped non-positive eigenvalues)
+        if (num_dim is not None) and (num_dim > dim_embedding.shape[1]):
+            print('Warning: Only {} dimensions are available for --num_dim {}.'.format(dim_embedding.shape[1], num_dim))
+        if dim_embedding.shape[1] in stored_dims:
+            print('Warning: {}-dimensional embeddings have already been stored. Skipping --num_dim {}.'.format(dim_embedding.shape[1], num_dim))
+            continue
+        stored_dims.add(dim_embedding.shape[1])
+        
+        # Measure approximation error
+        if args.append:
+            error = np.abs(np.dot(dim_embedding[num_existing:], dim_embedding.T) - (1. - sem_class_dist))
+            error_type = 'similarities of new classes'
+        elif args.method in ('unitsphere', 'approx_sim'):
+            error = np.abs(np.dot(dim_embedding, dim_embedding.T) - (1. - sem_class_dist))
+            error_type = 'similarities'
+        else:
+            error = np.abs(scipy.spatial.distance.squareform(scipy.spatial.distance.pdist(dim_embedding)) - sem_class_dist)
+            error_type = 'distances'
+        if len(num_dims) > 1:
+            energy = info['energy'] * np.sum(dim_embedding ** 2) / np.sum(embedding ** 2)
+            sweep_stats.append((dim_embedding.shape[1], error.max(), error.mean(), energy))
+        elif error.size > 0:
+            print('Maximum deviation from target {}: {}'.format(error_type, error.max()))
+            print('Average deviation from target {}: {}'.format(error_type, error.mean()))
+        del error
+        
+        # Store results
+        for norm in norm_modes:
+            out_embedding = dim_embedding / np.maximum(np.linalg.norm(dim_embedding, axis=-1, keepdims=True), 1e-12) if norm else np.array(dim_embedding)
+            out_filename = output_filename(args.out, dim_embedding.shape[1], len(num_dims) > 1, (not norm) and (len(norm_modes) > 1))
+            with open(out_filename, 'wb') as dump_file:
+                pickle.dump({
+                        'ind2label' : unique_labels,
+                        'label2ind' : linear_labels,
+                        'embedding' : out_embedding
+                }, dump_file)
+    
+    if len(sweep_stats) > 0:
+        print()
+        print('{:>5s} | {:>13s} | {:>13s} | {:>7s}'.format('Dims', 'Max deviation', 'Avg deviation', 'Energy'))
+        print('-' * 48)
+        for stats in sweep_stats:
+            print('{:>5d} | {:>13.6f} | {:>13.6f} | {:>6.2%}'.format(*stats))
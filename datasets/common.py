@@ -1,7 +1,10 @@
 import numpy as np
 import PIL.Image
 import warnings
-from collections import Counter
+import os, io, time, threading, json, tempfile
+from collections import Counter, OrderedDict, deque
+from contextlib import contextmanager
+from concurrent.futures import ThreadPoolExecutor, ProcessPoolExecutor
 
 try:
     from keras.preprocessing.image import ImageDataGenerator, load_img, img_to_array
@@ -27,7 +30,7 @@ class DataSequence(Sequence):
     """ Helper class representing a sequence that can be passed to Keras functions expecting a generator. """
 
     def __init__(self, data_generator, ids, labels, batch_size = 32, shuffle = False, oversample = False, repeats = 1,
-                 batch_transform = None, batch_transform_kwargs = {}, **kwargs):
+                 buckets = None, batch_transform = None, batch_transform_kwargs = {}, **kwargs):
         """
         # Arguments:
 
@@ -49,6 +52,12 @@ class DataSequence(Sequence):
         - repeats: Number of repeats per epoch. If this was set to 3, for example, a single epoch would actually
                    comprise 3 epochs.
 
+        - buckets: Optionally, an array with a bucket index for each image in `ids` (see `FileDatasetGenerator.size_buckets`).
+                   If given, each batch will only consist of images from the same bucket. The order of batches will be
+                   shuffled across buckets if `shuffle` is True. In combination with `oversample`, the number of batches
+                   may vary, since different members of smaller classes are used. The number of batches is hence fixed
+                   when the sequence is created and each (sub-)epoch is trimmed or padded with repeated batches to it.
+
         - batch_transform: Optionally, a function that takes the inputs and targets of a batch and returns
                            transformed inputs and targets that will be provided by this sequence instead of
                            the original ones.
@@ -64,6 +73,9 @@ class DataSequence(Sequence):
         self.shuffle = shuffle
         self.oversample = oversample
         self.repeats = repeats
+        self.buckets = np.asarray(buckets) if buckets is not None else None
+        self.batches = None
+        self.bucket_epoch_len = None
         self.batch_transform = batch_transform
         self.batch_transform_kwargs = batch_transform_kwargs
         self.kwargs = kwargs
@@ -93,17 +105,26 @@ class DataSequence(Sequence):
     def __getitem__(self, idx):
         """ Returns the batch with the given index. """
         
-        subepoch = idx // self.epoch_len
-        idx = idx % self.epoch_len
-        batch_ind = self.permutations[subepoch][idx*self.batch_size:(idx+1)*self.batch_size]
+        batch_ind = self.batch_indices(idx)
         X = self.data_generator.compose_batch([self.ids[i] for i in batch_ind], **self.kwargs)
         y = self.labels[batch_ind]
         if self.batch_transform is not None:
-            return self.batch_transform(X, y, **self.batch_transform_kwargs)  # pylint: disable=not-callable
+            with timed_stage(getattr(self.data_generator, 'stage_timer', None), 'batch_transform'):
+                return self.batch_transform(X, y, **self.batch_transform_kwargs)  # pylint: disable=not-callable
         else:
             return X, y
 
 
+    def batch_indices(self, idx):
+        """ Returns the indices of the images in `self.ids` belonging to the batch with the given index. """
+
+        subepoch = idx // self.epoch_len
+        idx = idx % self.epoch_len
+        if self.batches is not None:
+            return self.batches[subepoch][idx]
+        return self.permutations[subepoch][idx*self.batch_size:(idx+1)*self.batch_size]
+
+
     def on_epoch_end(self):
         """ Called by Keras after each epoch. Handles shuffling of the data if required. """
 
@@ -120,6 +141,294 @@ class DataSequence(Sequence):
             
             for i in range(self.repeats):
                 np.random.shuffle(self.permutations[i])
+        
+        if self.buckets is not None:
+            self.batches = [_bucket_batches(perm, self.buckets, self.batch_size, self.shuffle) for perm in self.permutations]
+            if self.bucket_epoch_len is None:
+                self.bucket_epoch_len = max(len(batches) for batches in self.batches)
+            self.batches = [_resize_batches(batches, self.bucket_epoch_len, self.shuffle) for batches in self.batches]
+            self.epoch_len = self.bucket_epoch_len
+
+
+
+class StageTimer(object):
+    """ Accumulates the time spent in the individual stages of a data pipeline.
+
+    An instance of this class can be assigned to the `stage_timer` attribute of a data generator,
+    which will then record the time spent for reading, decoding, and transforming images.
+    Timings are only recorded in the process the timer lives in, not in worker processes.
+    """
+
+    def __init__(self):
+
+        super(StageTimer, self).__init__()
+        self._lock = threading.Lock()
+        self.reset()
+
+
+    def reset(self):
+        """ Discards all recorded timings. """
+
+        with self._lock:
+            self.times = OrderedDict()
+            self.counts = OrderedDict()
+
+
+    @contextmanager
+    def measure(self, stage):
+        """ Context manager measuring the time spent in the given stage. """
+
+        start_time = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.add(stage, time.perf_counter() - start_time)
+
+
+    def add(self, stage, duration):
+        """ Records that `duration` seconds have been spent in the given stage. """
+
+        with self._lock:
+            self.times[stage] = self.times.get(stage, 0.0) + duration
+            self.counts[stage] = self.counts.get(stage, 0) + 1
+
+
+    @property
+    def total_time(self):
+        """ Total time spent in all stages. """
+
+        return sum(self.times.values())
+
+
+
+@contextmanager
+def _no_timing():
+    yield
+
+
+def timed_stage(timer, stage):
+    """ Returns a context manager measuring the time spent in `stage` using a `StageTimer`, which may also be None. """
+
+    return timer.measure(stage) if timer is not None else _no_timing()
+
+
+
+class PrefetchIterator(object):
+    """ Iterator composing batches asynchronously in background threads or processes.
+
+    Batches are yielded in exactly the order in which they are specified, while up to `max_queue_size`
+    further batches are being composed in advance by a pool of workers.
+    """
+
+    def __init__(self, data_generator, batches, workers = 1, max_queue_size = 10, use_multiprocessing = False, **kwargs):
+        """
+        # Arguments:
+
+        - data_generator: The data generator instance whose `compose_batch` method will be used for composing batches.
+
+        - batches: Iterable yielding a tuple `(items, labels)` for each batch, where `items` is the list of images
+                   passed to `compose_batch` as first argument and `labels` is either None or an array with the
+                   labels of the images in the batch.
+
+        - workers: Number of worker threads or processes.
+
+        - max_queue_size: Maximum number of batches being composed in advance.
+
+        - use_multiprocessing: If True, batches will be composed in separate processes instead of threads.
+
+        Remaining keyword arguments will be passed through to `compose_batch`.
+        """
+
+        super(PrefetchIterator, self).__init__()
+        self.data_generator = data_generator
+        self.batches = iter(batches)
+        self.max_queue_size = max(1, max_queue_size)
+        self.use_multiprocessing = use_multiprocessing
+        self.kwargs = kwargs
+
+        if use_multiprocessing:
+            self.executor = ProcessPoolExecutor(workers, initializer = _init_prefetch_worker, initargs = (data_generator,))
+        else:
+            self.executor = ThreadPoolExecutor(workers)
+        self.queue = deque()
+
+        self._num_batches = 0
+        self._num_stalls = 0
+        self._stall_time = 0.0
+        self._queue_depth_sum = 0
+        self._fill_queue()
+
+
+    def __iter__(self):
+
+        return self
+
+
+    def __next__(self):
+        """ Returns the next batch, waiting for it to be composed if necessary. """
+
+        if len(self.queue) == 0:
+            raise StopIteration()
+
+        # Record the number of batches that are ready at the time of the request
+        self._queue_depth_sum += sum(1 for future, _ in self.queue if future.done())
+        self._num_batches += 1
+
+        future, labels = self.queue.popleft()
+        if future.done():
+            X = future.result()
+        else:
+            start_time = time.perf_counter()
+            X = future.result()
+            self._stall_time += time.perf_counter() - start_time
+            self._num_stalls += 1
+
+        self._fill_queue()
+        return (X, labels) if labels is not None else X
+
+    next = __next__
+
+
+    def _fill_queue(self):
+        """ Submits batches to the workers until the queue is full or there are no more batches. """
+
+        while len(self.queue) < self.max_queue_size:
+            try:
+                items, labels = next(self.batches)
+            except StopIteration:
+                break
+            if self.use_multiprocessing:
+                future = self.executor.submit(_compose_batch_in_worker, items, self.kwargs)
+            else:
+                future = self.executor.submit(self.data_generator.compose_batch, items, **self.kwargs)
+            self.queue.append((future, labels))
+
+
+    @property
+    def stats(self):
+        """ Dictionary with statistics about the input pipeline, which can be used to determine whether a job is input-bound:
+
+        - 'batches': Number of batches consumed so far.
+        - 'avg_queue_depth': Average number of completely composed batches waiting in the queue when a batch was requested.
+        - 'stalls': Number of batches the consumer had to wait for, because they were not ready yet.
+        - 'stall_time': Total time in seconds the consumer spent waiting for batches.
+        """
+
+        return {
+            'batches' : self._num_batches,
+            'avg_queue_depth' : self._queue_depth_sum / max(1, self._num_batches),
+            'stalls' : self._num_stalls,
+            'stall_time' : self._stall_time
+        }
+
+
+    def close(self):
+        """ Cancels all pending batches and shuts down the workers. """
+
+        for future, _ in self.queue:
+            future.cancel()
+        self.queue.clear()
+        self.executor.shutdown(wait = False)
+
+
+    def __del__(self):
+
+        try:
+            self.close()
+        except Exception:
+            pass
+
+
+
+_prefetch_worker_generator = None
+
+def _init_prefetch_worker(data_generator):
+    """ Initializes a worker process of a `PrefetchIterator`. """
+
+    global _prefetch_worker_generator
+    _prefetch_worker_generator = data_generator
+    # Make sure that forked workers don't produce identical random augmentations
+    np.random.seed((os.getpid() * 1000003 + int(time.time() * 1000)) % (2 ** 32))
+
+
+def _compose_batch_in_worker(items, kwargs):
+    """ Composes a batch using the data generator of the current worker process. """
+
+    return _prefetch_worker_generator.compose_batch(items, **kwargs)
+
+
+def _batch_indices(num_samples, batch_size, shuffle = False):
+    """ Generator yielding the indices of the samples in each batch of an infinite sequence of epochs. """
+
+    ind = np.arange(num_samples)
+    if shuffle:
+        np.random.shuffle(ind)
+
+    offs = 0
+    while True:
+
+        if offs >= len(ind):
+            offs = 0
+            if shuffle:
+                np.random.shuffle(ind)
+
+        yield ind[offs:offs+batch_size]
+        offs += batch_size
+
+
+def _bucket_batches(ind, buckets, batch_size, shuffle = False):
+    """ Splits a sequence of sample indices into batches of samples belonging to the same bucket.
+
+    The order of samples within each bucket is retained. If `shuffle` is True, the order of batches will be shuffled,
+    otherwise batches are sorted by bucket index.
+    """
+
+    ind = np.asarray(ind)
+    ind_buckets = buckets[ind]
+    sort_ind = np.argsort(ind_buckets, kind = 'stable')
+    bounds = np.flatnonzero(ind_buckets[sort_ind][1:] != ind_buckets[sort_ind][:-1]) + 1
+    batches = [members[offs:offs+batch_size] for members in np.split(ind[sort_ind], bounds) for offs in range(0, len(members), batch_size)]
+    if shuffle:
+        batches = [batches[i] for i in np.random.permutation(len(batches))]
+    return batches
+
+
+def _resize_batches(batches, num_batches, shuffle = False):
+    """ Trims a list of batches or pads it with repeated batches to a given length.
+
+    Repeated batches are chosen randomly if `shuffle` is True, otherwise from the beginning of the list.
+    """
+
+    if len(batches) >= num_batches:
+        return batches[:num_batches]
+    extra = np.random.choice(len(batches), num_batches - len(batches)) if shuffle else np.arange(num_batches - len(batches)) % len(batches)
+    return batches + [batches[i] for i in extra]
+
+
+def _bucket_batch_indices(buckets, batch_size, shuffle = False):
+    """ Counterpart of `_batch_indices` yielding batches of samples belonging to the same bucket (see `_bucket_batches`). """
+
+    while True:
+        for batch_ind in _bucket_batches(np.arange(len(buckets)), buckets, batch_size, shuffle):
+            yield batch_ind
+
+
+def _compose_batches(data_generator, batches, **kwargs):
+    """ Synchronous counterpart of `PrefetchIterator`. """
+
+    for items, labels in batches:
+        X = data_generator.compose_batch(items, **kwargs)
+        yield (X, labels) if labels is not None else X
+
+
+
+SIZE_INDEX_FILENAME = '.image_sizes.json'
+
+
+def num_tta_views(scales = None, corners = True, flips = True):
+    """ Returns the number of views per image generated by test-time augmentation with the given options (see `FileDatasetGenerator.compose_batch`). """
+
+    return (len(scales) if scales else 1) * (5 if corners else 1) * (2 if flips else 1)
 
 
 
@@ -159,6 +468,12 @@ class FileDatasetGenerator(object):
         - randerase_params: Random erasing parameters (see Zhong et al. (2017): "Random erasing data augmentation.").
 
         - color_mode: Image color mode, either "rgb" or "bgr".
+
+        The attribute `stage_timer` can be set to a `StageTimer` instance for profiling the individual stages of the pipeline.
+
+        If the attribute `uint8_batches` is set to True, batches will be provided as unnormalized uint8 arrays, which are 4 times
+        smaller than float32 batches. Normalization then has to be performed by the model, using the parameters obtained from
+        `input_normalization()`.
         """
         
         super(FileDatasetGenerator, self).__init__()
@@ -173,6 +488,9 @@ class FileDatasetGenerator(object):
         self.randerase_prob = randerase_prob
         self.randerase_params = randerase_params
         self.color_mode = color_mode.lower()
+        self.stage_timer = None
+        self.uint8_batches = False
+        self._size_index = None
         
         self.classes = []
         self.train_img_files = []
@@ -207,7 +525,22 @@ class FileDatasetGenerator(object):
         self.std = np.asarray(std, dtype=np.float32)
     
     
-    def flow_train(self, batch_size = 32, include_labels = True, shuffle = True, target_size = None, augment = True):
+    def input_normalization(self):
+        """ Provides the parameters for normalizing unnormalized batches, as generated if `uint8_batches` is True.
+
+        # Returns:
+            a tuple with the channel-wise mean and standard deviation as 1-dimensional numpy arrays,
+            in the channel order of the generated batches.
+        """
+
+        if self.color_mode == 'bgr':
+            return self.mean[::-1].copy(), self.std[::-1].copy()
+        else:
+            return self.mean.copy(), self.std.copy()
+    
+    
+    def flow_train(self, batch_size = 32, include_labels = True, shuffle = True, target_size = None, augment = True,
+                   workers = 0, max_queue_size = 10, use_multiprocessing = False, bucket_size = None, tta = None):
         """ A generator yielding batches of pre-processed and augmented training images.
 
         # Arguments:
@@ -225,18 +558,36 @@ class FileDatasetGenerator(object):
         
         - augment: Whether data augmentation should be applied or not.
 
+        - workers: Number of threads or processes composing batches asynchronously in the background.
+                   If set to 0, batches will be composed synchronously when they are requested.
+
+        - max_queue_size: Maximum number of batches composed in advance if `workers > 0`.
+
+        - use_multiprocessing: If True and `workers > 0`, batches will be composed in separate processes instead of threads.
+
+        - bucket_size: If given and `self.cropsize` is None, images will be grouped into buckets by their size after resizing,
+                       rounded to multiples of `bucket_size` pixels, and each batch will only contain images from the same bucket.
+                       This reduces the amount of cropping and padding, since batches are cropped to the median size of their images.
+
+        - tta: Optionally, a dictionary with options for test-time augmentation passed to `compose_batch` (see there).
+               Each batch will then contain several views of each image instead of a single one and `augment` will be ignored.
+
         # Yields:
             If `include_labels` is True, a tuple of inputs and targets for each batch.
             Otherwise, only inputs will be yielded.
+            If `workers > 0`, the generator is a `PrefetchIterator`, which also provides statistics about the input pipeline.
         """
         
         return self._flow(self.train_img_files, self._train_labels if include_labels else None,
                           batch_size=batch_size, shuffle=shuffle, target_size=target_size,
+                          buckets=self.size_buckets(self.train_img_files, target_size, bucket_size) if bucket_size and (self.cropsize is None) else None,
+                          workers=workers, max_queue_size=max_queue_size, use_multiprocessing=use_multiprocessing,
                           normalize=True, hflip=augment, vflip=False, colordistort=self.distort_colors and augment,
-                          randzoom=augment, randrot=augment, cropsize=self.cropsize, randcrop=augment, randerase=augment)
+                          randzoom=augment, randrot=augment, cropsize=self.cropsize, randcrop=augment, randerase=augment, tta=tta)
     
     
-    def flow_test(self, batch_size = 32, include_labels = True, shuffle = False, target_size = None, augment = False):
+    def flow_test(self, batch_size = 32, include_labels = True, shuffle = False, target_size = None, augment = False,
+                  workers = 0, max_queue_size = 10, use_multiprocessing = False, batch_indices = None, bucket_size = None, tta = None):
         """ A generator yielding batches of pre-processed and augmented test images.
 
         # Arguments:
@@ -254,18 +605,38 @@ class FileDatasetGenerator(object):
         
         - augment: Whether data augmentation should be applied or not.
 
+        - workers: Number of threads or processes composing batches asynchronously in the background.
+                   If set to 0, batches will be composed synchronously when they are requested.
+
+        - max_queue_size: Maximum number of batches composed in advance if `workers > 0`.
+
+        - use_multiprocessing: If True and `workers > 0`, batches will be composed in separate processes instead of threads.
+
+        - batch_indices: Optionally, a list with an array of indices of test images for each batch, which overrides `batch_size` and `shuffle`.
+                         The flow will end after the last batch. See `test_batch_indices()`.
+
+        - bucket_size: If given and `self.cropsize` is None, images will be grouped into buckets by their size after resizing,
+                       rounded to multiples of `bucket_size` pixels, and each batch will only contain images from the same bucket.
+                       This reduces the amount of cropping and padding, since batches are cropped to the median size of their images.
+
+        - tta: Optionally, a dictionary with options for test-time augmentation passed to `compose_batch` (see there).
+               Each batch will then contain several views of each image instead of a single one and `augment` will be ignored.
+
         # Yields:
             If `include_labels` is True, a tuple of inputs and targets for each batch.
             Otherwise, only inputs will be yielded.
+            If `workers > 0`, the generator is a `PrefetchIterator`, which also provides statistics about the input pipeline.
         """
         
         return self._flow(self.test_img_files, self._test_labels if include_labels else None,
-                          batch_size=batch_size, shuffle=shuffle, target_size=target_size,
+                          batch_size=batch_size, shuffle=shuffle, target_size=target_size, batch_indices=batch_indices,
+                          buckets=self.size_buckets(self.test_img_files, target_size, bucket_size) if bucket_size and (self.cropsize is None) else None,
+                          workers=workers, max_queue_size=max_queue_size, use_multiprocessing=use_multiprocessing,
                           normalize=True, hflip=augment, vflip=False, colordistort=False,
-                          randzoom=augment, randrot=augment, cropsize=self.cropsize, randcrop=augment, randerase=augment)
+                          randzoom=augment, randrot=augment, cropsize=self.cropsize, randcrop=augment, randerase=augment, tta=tta)
     
 
-    def train_sequence(self, batch_size = 32, shuffle = True, target_size = None, augment = True, batch_transform = None, batch_transform_kwargs = {}):
+    def train_sequence(self, batch_size = 32, shuffle = True, target_size = None, augment = True, batch_transform = None, batch_transform_kwargs = {}, bucket_size = None):
         """ Creates a `DataSequence` with pre-processed and augmented training images that can be passed to the Keras methods expecting a generator for efficient and safe multi-processing.
 
         # Arguments:
@@ -287,18 +658,23 @@ class FileDatasetGenerator(object):
         
         - batch_transform_kwargs: Additional keyword arguments passed to `batch_transform`.
 
+        - bucket_size: If given and `self.cropsize` is None, images will be grouped into buckets by their size after resizing,
+                       rounded to multiples of `bucket_size` pixels, and each batch will only contain images from the same bucket.
+                       This reduces the amount of cropping and padding, since batches are cropped to the median size of their images.
+
         # Returns:
             a DataSequence instance
         """
         
         return DataSequence(self, self.train_img_files, self._train_labels,
                             batch_size=batch_size, shuffle=shuffle,
+                            buckets=self.size_buckets(self.train_img_files, target_size, bucket_size) if bucket_size and (self.cropsize is None) else None,
                             target_size=target_size, normalize=True, hflip=augment, vflip=False, colordistort=self.distort_colors and augment,
                             randzoom=augment, randrot=augment, cropsize=self.cropsize, randcrop=augment, randerase=augment,
                             batch_transform=batch_transform, batch_transform_kwargs=batch_transform_kwargs)
     
     
-    def test_sequence(self, batch_size = 32, shuffle = False, target_size = None, augment = False, batch_transform = None, batch_transform_kwargs = {}):
+    def test_sequence(self, batch_size = 32, shuffle = False, target_size = None, augment = False, batch_transform = None, batch_transform_kwargs = {}, bucket_size = None):
         """ Creates a `DataSequence` with pre-processed and augmented test images that can be passed to the Keras methods expecting a generator for efficient and safe multi-processing.
 
         # Arguments:
@@ -320,18 +696,24 @@ class FileDatasetGenerator(object):
         
         - batch_transform_kwargs: Additional keyword arguments passed to `batch_transform`.
 
+        - bucket_size: If given and `self.cropsize` is None, images will be grouped into buckets by their size after resizing,
+                       rounded to multiples of `bucket_size` pixels, and each batch will only contain images from the same bucket.
+                       This reduces the amount of cropping and padding, since batches are cropped to the median size of their images.
+
         # Returns:
             a DataSequence instance
         """
 
         return DataSequence(self, self.test_img_files, self._test_labels,
                             batch_size=batch_size, shuffle=shuffle,
+                            buckets=self.size_buckets(self.test_img_files, target_size, bucket_size) if bucket_size and (self.cropsize is None) else None,
                             target_size=target_size, normalize=True, hflip=augment, vflip=False, colordistort=False,
                             randzoom=augment, randrot=augment, cropsize=self.cropsize, randcrop=augment, randerase=augment,
                             batch_transform=batch_transform, batch_transform_kwargs=batch_transform_kwargs)
     
     
-    def _flow(self, filenames, labels = None, batch_size = 32, shuffle = False, **kwargs):
+    def _flow(self, filenames, labels = None, batch_size = 32, shuffle = False,
+              workers = 0, max_queue_size = 10, use_multiprocessing = False, batch_indices = None, buckets = None, **kwargs):
         """ A generator yielding batches of pre-processed and augmented images.
 
         # Arguments:
@@ -344,40 +726,155 @@ class FileDatasetGenerator(object):
 
         - shuffle: If True, the order of images will be shuffled after each epoch.
 
+        - workers: Number of threads or processes composing batches asynchronously in the background.
+                   If set to 0, batches will be composed synchronously when they are requested.
+
+        - max_queue_size: Maximum number of batches composed in advance if `workers > 0`.
+
+        - use_multiprocessing: If True and `workers > 0`, batches will be composed in separate processes instead of threads.
+
+        - batch_indices: Optionally, an iterable yielding an array of indices into `filenames` for each batch,
+                         which overrides `batch_size` and `shuffle`.
+
+        - buckets: Optionally, an array with a bucket index for each file in `filenames` (see `size_buckets`).
+                   If given, each batch will only consist of images from the same bucket. The order of batches will be
+                   shuffled across buckets if `shuffle` is True.
+
         Remaining keyword arguments will be passed through to `compose_batch`.
 
         # Yields:
             If `labels` is not None, a tuple of inputs and targets for each batch.
             Otherwise, only inputs will be yielded.
+            Batches are always yielded in the order of `filenames` if `shuffle` is False, even if `workers > 0`.
         """
         
-        ind = np.arange(len(filenames))
-        if shuffle:
-            np.random.shuffle(ind)
-        
         if labels is not None:
             labels = np.asarray(labels)
         
-        offs = 0
-        while True:
-            
-            if offs >= len(ind):
-                offs = 0
-                if shuffle:
-                    np.random.shuffle(ind)
-            
-            batch_ind = ind[offs:offs+batch_size]
-            offs += batch_size
-            
-            X = self.compose_batch([filenames[i] for i in batch_ind], **kwargs)
-
-            if labels is not None:
-                yield X, labels[batch_ind]
+        if batch_indices is None:
+            if buckets is not None:
+                batch_indices = _bucket_batch_indices(np.asarray(buckets), batch_size, shuffle)
             else:
-                yield X
+                batch_indices = _batch_indices(len(filenames), batch_size, shuffle)
+        batches = (
+            ([filenames[i] for i in batch_ind], labels[batch_ind] if labels is not None else None)
+            for batch_ind in batch_indices
+        )
+        
+        if workers > 0:
+            return PrefetchIterator(self, batches, workers=workers, max_queue_size=max_queue_size, use_multiprocessing=use_multiprocessing, **kwargs)
+        else:
+            return _compose_batches(self, batches, **kwargs)
+
 
+    def test_batch_indices(self, batch_size = 32, target_size = None):
+        """ Divides the test images into batches that can be passed to `flow_test` as `batch_indices`.
 
-    def compose_batch(self, filenames, cropsize = None, randcrop = False, data_format = None, **kwargs):
+        If `self.cropsize` is None, images are cropped to the median size of the images in each batch. To obtain the
+        same result as when processing each image on its own, only images of the same size are grouped into a batch then.
+        Otherwise, batches simply consist of consecutive images.
+
+        # Arguments:
+
+        - batch_size: Maximum number of images per batch.
+
+        - target_size: Target size passed to `flow_test` (see there).
+
+        # Returns:
+            a list with an array of indices of test images for each batch.
+        """
+
+        if self.cropsize is not None:
+            return [np.arange(offs, min(offs + batch_size, len(self.test_img_files))) for offs in range(0, len(self.test_img_files), batch_size)]
+        return _bucket_batches(np.arange(len(self.test_img_files)), self.size_buckets(self.test_img_files, target_size), batch_size)
+
+
+    def size_buckets(self, filenames, target_size = None, granularity = 1):
+        """ Assigns images to buckets of images with similar size after resizing, without opening the image files.
+
+        # Arguments:
+
+        - filenames: List of image filenames.
+
+        - target_size: Target size as passed to `_load_image` without random zooming (see there).
+
+        - granularity: Image sizes are rounded to multiples of this number of pixels before being compared.
+
+        # Returns:
+            an array with a bucket index for each image. Buckets are numbered in the order of their first image.
+        """
+
+        bucket_index = {}
+        return np.array([
+            bucket_index.setdefault((int(round(w / granularity)), int(round(h / granularity))), len(bucket_index))
+            for w, h in self.image_sizes(filenames, target_size)
+        ], dtype = int)
+
+
+    def image_sizes(self, filenames, target_size = None):
+        """ Determines the sizes of images after resizing them to a given target size.
+
+        The original image sizes are read from the image headers once and stored in the file `SIZE_INDEX_FILENAME`
+        in the root directory of the dataset, so that subsequent calls do not need to open the image files.
+        That file can be deleted at any time and is ignored if the root directory is not writable.
+
+        # Arguments:
+
+        - filenames: List of image filenames.
+
+        - target_size: Target size as passed to `_load_image` without random zooming (see there).
+
+        # Returns:
+            a list of tuples with the width and height of each image.
+        """
+
+        if target_size is None:
+            target_size = self.default_target_size
+        
+        sizes = []
+        for w, h in self._original_image_sizes(filenames):
+            if isinstance(target_size, int):
+                if target_size > 0:
+                    w, h = (target_size, round(h * (target_size / w))) if w < h else (round(w * (target_size / h)), target_size)
+                sizes.append((w, h))
+            else:
+                sizes.append(tuple(target_size))
+        return sizes
+
+
+    def _original_image_sizes(self, filenames):
+        """ Looks up the original sizes of images in the size index and adds missing images to the index. """
+
+        index_file = os.path.join(self.root_dir, SIZE_INDEX_FILENAME)
+        if self._size_index is None:
+            try:
+                with open(index_file) as f:
+                    self._size_index = json.load(f)
+            except (OSError, ValueError):
+                self._size_index = {}
+        
+        keys = [os.path.relpath(fn, self.root_dir) for fn in filenames]
+        missing = [(key, fn) for key, fn in zip(keys, filenames) if key not in self._size_index]
+        if len(missing) > 0:
+            for key, fn in tqdm(missing, desc = 'Reading image sizes', disable = len(missing) < 1000):
+                with PIL.Image.open(fn) as img:
+                    self._size_index[key] = img.size
+            try:
+                fd, tmp_filename = tempfile.mkstemp(dir = self.root_dir, prefix = SIZE_INDEX_FILENAME, suffix = '.tmp')
+                try:
+                    with os.fdopen(fd, 'w') as f:
+                        json.dump(self._size_index, f)
+                    os.replace(tmp_filename, index_file)
+                except:
+                    os.remove(tmp_filename)
+                    raise
+            except OSError:
+                pass
+        
+        return [tuple(self._size_index[key]) for key in keys]
+
+
+    def compose_batch(self, filenames, cropsize = None, randcrop = False, data_format = None, tta = None, **kwargs):
         """ Composes a batch of augmented images given by their filenames.
 
         # Arguments:
@@ -392,12 +889,27 @@ class FileDatasetGenerator(object):
 
         - data_format: The image data format (either 'channels_first' or 'channels_last'). Set to None for the default value.
 
+        - tta: Optionally, a dictionary with the following options for test-time augmentation:
+               - 'scales': List of target sizes (see `_load_image`). Defaults to the target size passed to this method.
+               - 'corners': Whether to extract crops from the four corners in addition to the center crop. Defaults to True.
+               - 'flips': Whether to add horizontally flipped versions of all crops. Defaults to True.
+               Each image will be decoded only once and all its views will be stored consecutively in the batch.
+               The number of views per image can be obtained from `num_tta_views(**tta)`.
+               Requires a fixed `cropsize`. Data augmentation options will be ignored.
+
         Remaining keyword arguments will be passed through to `_load_and_transform`.
+        If `self.uint8_batches` is True, `normalize` will be ignored and images will not be normalized.
 
         # Returns:
             a batch of images as 4-dimensional numpy array.
         """
 
+        if self.uint8_batches:
+            kwargs['normalize'] = False
+
+        if tta is not None:
+            return self._compose_tta_batch(filenames, cropsize, kwargs.get('target_size'), kwargs.get('normalize', True), data_format, **tta)
+
         if data_format is None:
             data_format = K.image_data_format()
         if data_format == 'channels_first':
@@ -412,24 +924,79 @@ class FileDatasetGenerator(object):
             crop_height = int(np.median([img.shape[y_axis] for img in X]))
             crop_width = int(np.median([img.shape[x_axis] for img in X]))
         for i, img in enumerate(X):
-            y_pad = x_pad = 0
-            if img.shape[y_axis] > crop_height:
-                y_offs = np.random.randint(img.shape[y_axis] - crop_height + 1) if randcrop else (img.shape[y_axis] - crop_height) // 2
-                img = img[:,y_offs:y_offs+crop_height,:] if data_format == 'channels_first' else img[y_offs:y_offs+crop_height,:,:]
-            elif img.shape[y_axis] < crop_height:
-                y_pad = np.random.randint(crop_height - img.shape[y_axis] + 1) if randcrop else (crop_height - img.shape[y_axis]) // 2
-            if img.shape[x_axis] > crop_width:
-                x_offs = np.random.randint(img.shape[x_axis] - crop_width + 1) if randcrop else (img.shape[x_axis] - crop_width) // 2
-                img = img[:,:,x_offs:x_offs+crop_width] if data_format == 'channels_first' else img[:,x_offs:x_offs+crop_width,:]
-            elif img.shape[x_axis] < crop_width:
-                x_pad = np.random.randint(crop_width - img.shape[x_axis] + 1) if randcrop else (crop_width - img.shape[x_axis]) // 2
-            X[i] = np.pad(
-                img,
-                ((0,0), (y_pad, crop_height - img.shape[1] - y_pad), (x_pad, crop_width - img.shape[2] - x_pad)) if data_format == 'channels_first' else \
-                ((y_pad, crop_height - img.shape[0] - y_pad), (x_pad, crop_width - img.shape[1] - x_pad), (0,0)),
-                'reflect'
-            )
-        return np.stack(X)
+            with timed_stage(self.stage_timer, 'crop_pad'):
+                X[i] = self._crop_or_pad(img, crop_width, crop_height, randcrop, data_format)
+            if self.uint8_batches:
+                X[i] = np.clip(np.round(X[i]), 0, 255).astype(np.uint8)
+        with timed_stage(self.stage_timer, 'stack'):
+            return np.stack(X)
+
+
+    def _compose_tta_batch(self, filenames, cropsize, target_size = None, normalize = True, data_format = None, scales = None, corners = True, flips = True):
+        """ Composes a batch with several views of each image for test-time augmentation (see `compose_batch`). """
+
+        if cropsize is None:
+            raise ValueError('Test-time augmentation requires a fixed crop size.')
+        crop_width, crop_height = cropsize
+        if data_format is None:
+            data_format = K.image_data_format()
+        if data_format == 'channels_first':
+            x_axis, y_axis = 2, 1
+        else:
+            x_axis, y_axis = 1, 0
+        if not scales:
+            scales = [target_size if target_size is not None else self.default_target_size]
+
+        X = []
+        for fn in filenames:
+            orig_img = self._load_image(fn, target_size=-1)
+            for scale in scales:
+                img = self._transform(self._resize_image(orig_img, scale), normalize=normalize, data_format=data_format)
+                with timed_stage(self.stage_timer, 'crop_pad'):
+                    crops = [self._crop_or_pad(img, crop_width, crop_height, False, data_format)]
+                    if corners:
+                        img = self._crop_or_pad(img, max(crop_width, img.shape[x_axis]), max(crop_height, img.shape[y_axis]), False, data_format)
+                        for y_offs in (0, img.shape[y_axis] - crop_height):
+                            for x_offs in (0, img.shape[x_axis] - crop_width):
+                                crops.append(img[:,y_offs:y_offs+crop_height,x_offs:x_offs+crop_width] if data_format == 'channels_first' else img[y_offs:y_offs+crop_height,x_offs:x_offs+crop_width,:])
+                for crop in crops:
+                    X.append(crop)
+                    if flips:
+                        X.append(crop[:,:,::-1] if data_format == 'channels_first' else crop[:,::-1,:])
+        
+        if self.uint8_batches:
+            X = [np.clip(np.round(img), 0, 255).astype(np.uint8) for img in X]
+        with timed_stage(self.stage_timer, 'stack'):
+            return np.stack(X)
+
+
+    def _crop_or_pad(self, img, crop_width, crop_height, randcrop = False, data_format = None):
+        """ Crops or reflect-pads a single image to a given size. """
+
+        if data_format is None:
+            data_format = K.image_data_format()
+        if data_format == 'channels_first':
+            x_axis, y_axis = 2, 1
+        else:
+            x_axis, y_axis = 1, 0
+
+        y_pad = x_pad = 0
+        if img.shape[y_axis] > crop_height:
+            y_offs = np.random.randint(img.shape[y_axis] - crop_height + 1) if randcrop else (img.shape[y_axis] - crop_height) // 2
+            img = img[:,y_offs:y_offs+crop_height,:] if data_format == 'channels_first' else img[y_offs:y_offs+crop_height,:,:]
+        elif img.shape[y_axis] < crop_height:
+            y_pad = np.random.randint(crop_height - img.shape[y_axis] + 1) if randcrop else (crop_height - img.shape[y_axis]) // 2
+        if img.shape[x_axis] > crop_width:
+            x_offs = np.random.randint(img.shape[x_axis] - crop_width + 1) if randcrop else (img.shape[x_axis] - crop_width) // 2
+            img = img[:,:,x_offs:x_offs+crop_width] if data_format == 'channels_first' else img[:,x_offs:x_offs+crop_width,:]
+        elif img.shape[x_axis] < crop_width:
+            x_pad = np.random.randint(crop_width - img.shape[x_axis] + 1) if randcrop else (crop_width - img.shape[x_axis]) // 2
+        return np.pad(
+            img,
+            ((0,0), (y_pad, crop_height - img.shape[1] - y_pad), (x_pad, crop_width - img.shape[2] - x_pad)) if data_format == 'channels_first' else \
+            ((y_pad, crop_height - img.shape[0] - y_pad), (x_pad, crop_width - img.shape[1] - x_pad), (0,0)),
+            'reflect'
+        )
 
 
     def _load_image(self, filename, target_size = None, randzoom = False):
@@ -453,7 +1020,16 @@ class FileDatasetGenerator(object):
             the image as PIL image.
         """
 
-        img = load_img(filename)
+        if self.stage_timer is None:
+            img = load_img(filename)
+        else:
+            # Separate reading from decoding for profiling
+            with self.stage_timer.measure('read'):
+                with open(filename, 'rb') as f:
+                    img_data = io.BytesIO(f.read())
+            with self.stage_timer.measure('decode'):
+                img = load_img(img_data)
+                img.load()
         if target_size is None:
             target_size = self.default_target_size
         
@@ -465,13 +1041,33 @@ class FileDatasetGenerator(object):
                     target_size = np.round(np.array(target_size) * np.random.uniform(self.randzoom_range[0], self.randzoom_range[1])).astype(int).tolist()
                 else:
                     target_size = np.random.randint(self.randzoom_range[0], self.randzoom_range[1])
-            if isinstance(target_size, int):
-                target_size = (target_size, round(img.size[1] * (target_size / img.size[0]))) if img.size[0] < img.size[1] else (round(img.size[0] * (target_size / img.size[1])), target_size)
-            img = img.resize(target_size, PIL.Image.BILINEAR)
+            img = self._resize_image(img, target_size)
         
         return img
 
 
+    def _resize_image(self, img, target_size):
+        """ Resizes a PIL image.
+
+        # Arguments:
+
+        - img: The PIL image.
+
+        - target_size: Int or tuple of ints. If a single int is given, it specifies the size of the smaller side of the image
+                       and the aspect ratio will be retained. If set to -1, the image won't be resized.
+
+        # Returns:
+            the resized PIL image.
+        """
+
+        if isinstance(target_size, int):
+            if target_size <= 0:
+                return img
+            target_size = (target_size, round(img.size[1] * (target_size / img.size[0]))) if img.size[0] < img.size[1] else (round(img.size[0] * (target_size / img.size[1])), target_size)
+        with timed_stage(self.stage_timer, 'resize'):
+            return img.resize(tuple(target_size), PIL.Image.BILINEAR)
+
+
     def _transform(self, img, normalize = True,
                    hflip = False, vflip = False, randrot = False, colordistort = False, randerase = False,
                    data_format = None):
@@ -500,20 +1096,24 @@ class FileDatasetGenerator(object):
         
         # Rotate image
         if randrot and (self.randrot_max > 0):
-            angle = np.random.uniform(-self.randrot_max, self.randrot_max)
-            img = img.rotate(angle, PIL.Image.BILINEAR)
+            with timed_stage(self.stage_timer, 'rotate'):
+                angle = np.random.uniform(-self.randrot_max, self.randrot_max)
+                img = img.rotate(angle, PIL.Image.BILINEAR)
 
         # Convert PIL image to array
-        img = img_to_array(img, data_format=data_format)
+        with timed_stage(self.stage_timer, 'to_array'):
+            img = img_to_array(img, data_format=data_format)
 
         # Color distortions
         if colordistort:
-            img = distort_color(img, data_format=data_format, **self.colordistort_params)
+            with timed_stage(self.stage_timer, 'color_distort'):
+                img = distort_color(img, data_format=data_format, **self.colordistort_params)
         
         # Normalize image
         if normalize:
-            img -= self.mean[:,None,None] if data_format == 'channels_first' else self.mean[None,None,:]
-            img /= self.std[:,None,None] if data_format == 'channels_first' else self.std[None,None,:]
+            with timed_stage(self.stage_timer, 'normalize'):
+                img -= self.mean[:,None,None] if data_format == 'channels_first' else self.mean[None,None,:]
+                img /= self.std[:,None,None] if data_format == 'channels_first' else self.std[None,None,:]
         
         # RGB -> BGR conversion
         if self.color_mode == 'bgr':
@@ -528,6 +1128,7 @@ class FileDatasetGenerator(object):
         
         # Random erasing
         if randerase and (self.randerase_prob > 0) and (np.random.random() < self.randerase_prob):
+            erase_start = time.perf_counter()
             while True:
                 se = np.random.uniform(self.randerase_params['sl'], self.randerase_params['sh']) * (img.shape[0] * img.shape[1])
                 re = np.random.uniform(self.randerase_params['r1'], self.randerase_params['r2'])
@@ -535,9 +1136,13 @@ class FileDatasetGenerator(object):
                 if (he < img.shape[0]) and (we < img.shape[1]):
                     break
             xe, ye = np.random.randint(0, img.shape[1] - we), np.random.randint(0, img.shape[0] - he)
-            img[ye:ye+he,xe:xe+we,:] = (np.random.uniform(0., 255., (he, we, img.shape[-1])) \
-                                       - (self.mean[:,None,None] if data_format == 'channels_first' else self.mean[None,None,:])) \
-                                       / (self.std[:,None,None] if data_format == 'channels_first' else self.std[None,None,:])
+            noise = np.random.uniform(0., 255., (he, we, img.shape[-1]))
+            if normalize:
+                noise -= self.mean[:,None,None] if data_format == 'channels_first' else self.mean[None,None,:]
+                noise /= self.std[:,None,None] if data_format == 'channels_first' else self.std[None,None,:]
+            img[ye:ye+he,xe:xe+we,:] = noise
+            if self.stage_timer is not None:
+                self.stage_timer.add('random_erase', time.perf_counter() - erase_start)
         
         return img
 
@@ -653,9 +1258,16 @@ class TinyDatasetGenerator(object):
         - generator_kwargs: Dictionary with keyword arguments passed to Keras' ImageDataGenerator for both training and test.
 
         - train_generator_kwargs: Dictionary with keyword arguments passed to Keras' ImageDataGenerator for the training set.
+
+        The attribute `stage_timer` can be set to a `StageTimer` instance for profiling the individual stages of the pipeline.
+
+        If the attribute `uint8_batches` is set to True, batches will be provided as unnormalized uint8 arrays.
+        Normalization then has to be performed by the model, using the parameters obtained from `input_normalization()`.
         """
         
         super(TinyDatasetGenerator, self).__init__()
+        self.stage_timer = None
+        self.uint8_batches = False
 
         self.X_train = X_train
         self.X_test = X_test
@@ -670,7 +1282,8 @@ class TinyDatasetGenerator(object):
         self.test_image_generator.fit(self.X_train)
     
     
-    def flow_train(self, batch_size = 32, include_labels = True, shuffle = True, augment = True):
+    def flow_train(self, batch_size = 32, include_labels = True, shuffle = True, augment = True,
+                   workers = 0, max_queue_size = 10, use_multiprocessing = False):
         """ A generator yielding batches of pre-processed and augmented training images.
 
         # Arguments:
@@ -683,17 +1296,35 @@ class TinyDatasetGenerator(object):
         
         - augment: Whether data augmentation should be applied or not.
 
+        - workers: Number of threads or processes composing batches asynchronously in the background.
+                   If set to 0, batches will be generated by Keras' `ImageDataGenerator` (or by `compose_batch` if `uint8_batches` is True)
+                   when they are requested.
+
+        - max_queue_size: Maximum number of batches composed in advance if `workers > 0`.
+
+        - use_multiprocessing: If True and `workers > 0`, batches will be composed in separate processes instead of threads.
+
         # Yields:
             If `include_labels` is True, a tuple of inputs and targets for each batch.
             Otherwise, only inputs will be yielded.
         """
         
+        if (workers > 0) or self.uint8_batches:
+            labels = np.asarray(self.y_train) if include_labels else None
+            batches = ((batch_ind, labels[batch_ind] if labels is not None else None) for batch_ind in _batch_indices(len(self.X_train), batch_size, shuffle))
+            if workers > 0:
+                return PrefetchIterator(self, batches, workers=workers, max_queue_size=max_queue_size, use_multiprocessing=use_multiprocessing,
+                                        train=True, augment=augment)
+            else:
+                return _compose_batches(self, batches, train=True, augment=augment)
+        
         image_generator = self.image_generator if augment else self.test_image_generator
         return image_generator.flow(self.X_train, self.y_train if include_labels else None,
                                     batch_size=batch_size, shuffle=shuffle)
     
     
-    def flow_test(self, batch_size = 32, include_labels = True, shuffle = False, augment = False):
+    def flow_test(self, batch_size = 32, include_labels = True, shuffle = False, augment = False,
+                  workers = 0, max_queue_size = 10, use_multiprocessing = False):
         """ A generator yielding batches of pre-processed and augmented test images.
 
         # Arguments:
@@ -706,11 +1337,28 @@ class TinyDatasetGenerator(object):
         
         - augment: Whether data augmentation should be applied or not.
 
+        - workers: Number of threads or processes composing batches asynchronously in the background.
+                   If set to 0, batches will be generated by Keras' `ImageDataGenerator` (or by `compose_batch` if `uint8_batches` is True)
+                   when they are requested.
+
+        - max_queue_size: Maximum number of batches composed in advance if `workers > 0`.
+
+        - use_multiprocessing: If True and `workers > 0`, batches will be composed in separate processes instead of threads.
+
         # Yields:
             If `include_labels` is True, a tuple of inputs and targets for each batch.
             Otherwise, only inputs will be yielded.
         """
         
+        if (workers > 0) or self.uint8_batches:
+            labels = np.asarray(self.y_test) if include_labels else None
+            batches = ((batch_ind, labels[batch_ind] if labels is not None else None) for batch_ind in _batch_indices(len(self.X_test), batch_size, shuffle))
+            if workers > 0:
+                return PrefetchIterator(self, batches, workers=workers, max_queue_size=max_queue_size, use_multiprocessing=use_multiprocessing,
+                                        train=False, augment=augment)
+            else:
+                return _compose_batches(self, batches, train=False, augment=augment)
+        
         image_generator = self.image_generator if augment else self.test_image_generator
         return image_generator.flow(self.X_test, self.y_test if include_labels else None,
                                     batch_size=batch_size, shuffle=shuffle)
@@ -781,21 +1429,52 @@ class TinyDatasetGenerator(object):
 
         # Returns:
             a batch of images as 4-dimensional numpy array.
+            If `self.uint8_batches` is True, the images will not be normalized and the batch will be of type uint8.
         """
 
         X = self.X_train if train else self.X_test
         image_generator = self.image_generator if augment else self.test_image_generator
 
-        batch = np.zeros((len(indices),) + tuple(X.shape[1:]), dtype=K.floatx())
+        batch = np.zeros((len(indices),) + tuple(X.shape[1:]), dtype=np.uint8 if self.uint8_batches else K.floatx())
         for i, j in enumerate(indices):
             x = X[j]
-            x = image_generator.random_transform(x.astype(K.floatx()))
-            x = image_generator.standardize(x)
+            with timed_stage(self.stage_timer, 'augment'):
+                x = image_generator.random_transform(x.astype(K.floatx()))
+            if self.uint8_batches:
+                x = np.clip(np.round(x), 0, 255)
+            else:
+                with timed_stage(self.stage_timer, 'normalize'):
+                    x = image_generator.standardize(x)
             batch[i] = x
         
         return batch
     
 
+    def input_normalization(self):
+        """ Provides the parameters for normalizing unnormalized batches, as generated if `uint8_batches` is True.
+
+        Only feature-wise centering and standard deviation normalization are supported.
+
+        # Returns:
+            a tuple with the channel-wise mean and standard deviation as 1-dimensional numpy arrays.
+        """
+
+        image_generator = self.test_image_generator
+        if image_generator.samplewise_center or image_generator.samplewise_std_normalization or image_generator.zca_whitening or image_generator.rescale:
+            raise NotImplementedError('Deferred normalization is only supported for feature-wise centering and standard deviation normalization.')
+        
+        num_channels = self.X_train.shape[1 if K.image_data_format() == 'channels_first' else -1]
+        if image_generator.featurewise_center:
+            mean = np.ravel(image_generator.mean).astype(np.float32)
+        else:
+            mean = np.zeros(num_channels, dtype=np.float32)
+        if image_generator.featurewise_std_normalization:
+            std = np.ravel(image_generator.std).astype(np.float32) + K.epsilon()
+        else:
+            std = np.ones(num_channels, dtype=np.float32)
+        return mean, std
+    
+
     @property
     def labels_train(self):
         """ List with labels corresponding to the training files in `self.X_train`.
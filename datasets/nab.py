@@ -93,10 +93,11 @@ class NABGenerator(FileDatasetGenerator):
         self._compute_stats(mean, std)
 
 
-    def train_sequence(self, batch_size = 32, shuffle = True, target_size = None, augment = True, batch_transform = None, batch_transform_kwargs = {}):
+    def train_sequence(self, batch_size = 32, shuffle = True, target_size = None, augment = True, batch_transform = None, batch_transform_kwargs = {}, bucket_size = None):
         
         return DataSequence(self, self.train_img_files, self._train_labels,
                             batch_size=batch_size, shuffle=shuffle,
+                            buckets=self.size_buckets(self.train_img_files, target_size, bucket_size) if bucket_size and (self.cropsize is None) else None,
                             target_size=target_size, normalize=True, hflip=augment, vflip=False, colordistort=self.distort_colors and augment,
                             randzoom=augment, randrot=augment, cropsize=self.cropsize, randcrop=augment, randerase=augment,
                             repeats=self.train_repeats,
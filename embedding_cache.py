@@ -0,0 +1,380 @@
+import numpy as np
+
+import sys, os, shutil, hashlib, json, pickle, tempfile
+
+from class_hierarchy import ClassHierarchy
+
+
+
+CACHE_VERSION = 6
+
+DEFAULT_CACHE_DIR = os.environ.get('SEMANTIC_EMBEDDINGS_CACHE', os.path.join(os.path.expanduser('~'), '.cache', 'semantic-embeddings'))
+
+
+
+def file_hash(filename, block_size = 1 << 20):
+    """ Computes the SHA-1 hash of the contents of a file and returns it as hex string. """
+
+    h = hashlib.sha1()
+    with open(filename, 'rb') as f:
+        for block in iter(lambda: f.read(block_size), b''):
+            h.update(block)
+    return h.hexdigest()
+
+
+
+class EmbeddingCache(object):
+    """ Content-addressed on-disk cache for parsed class hierarchies, class distance matrices, class embeddings, LCS/WUP tables, retrieval rankings, and retrieval indexes.
+
+    Entries are keyed by the hash of the contents of the hierarchy (or feature) file, the list of classes, and all parameters of
+    the computation. Thus, modifying the hierarchy file or changing any parameter results in a cache miss instead
+    of stale results. Entries are never evicted automatically, but the cache directory can be deleted at any time.
+    """
+
+    def __init__(self, cache_dir = DEFAULT_CACHE_DIR, enabled = True, verbose = True):
+        """ Initializes a new cache.
+
+        cache_dir - Directory where cache entries are stored. Will be created if it does not exist.
+        enabled - If set to `False`, all results will be computed from scratch and nothing will be written to disk.
+        verbose - If set to `True`, cache hits and misses will be reported on stderr.
+        """
+
+        object.__init__(self)
+        self.cache_dir = cache_dir
+        self.enabled = enabled
+        self.verbose = verbose
+        self._file_hashes = {}
+        self._hierarchies = {}
+
+
+    @classmethod
+    def from_args(cls, args):
+        """ Creates a cache from command-line arguments added by `add_cache_arguments()`. """
+
+        return cls(args.cache_dir, not args.no_cache)
+
+
+    def file_hash(self, filename):
+        """ Computes the hash of a file, which is only re-computed if the modification time or the size of the file changed. """
+
+        stat = os.stat(filename)
+        stat_key = (os.path.abspath(filename), stat.st_mtime_ns, stat.st_size)
+        if stat_key not in self._file_hashes:
+            self._file_hashes[stat_key] = file_hash(filename)
+        return self._file_hashes[stat_key]
+
+
+    def key(self, kind, hierarchy_file, is_a = False, id_type = int, labels = None, **params):
+        """ Computes the key of a cache entry.
+
+        kind - Type of the cached object (e.g., 'embedding').
+        hierarchy_file - Path to the hierarchy file the object has been derived from or None if it does not depend on a hierarchy.
+        is_a - Whether the hierarchy file contains is-a instead of parent-child relationships.
+        id_type - Data type of class IDs.
+        labels - Optionally, the list of classes the object refers to. The order of classes matters.
+        params - Further parameters that affect the cached object. Must be JSON-serializable or convertible to strings.
+
+        Returns: key string
+        """
+
+        desc = {
+            'version' : CACHE_VERSION,
+            'kind' : kind,
+            'hierarchy' : self.file_hash(hierarchy_file) if hierarchy_file is not None else None,
+            'is_a' : bool(is_a),
+            'id_type' : id_type.__name__,
+            'labels' : [str(lbl) for lbl in labels] if labels is not None else None,
+            'params' : params
+        }
+        return '{}-{}'.format(kind, hashlib.sha1(json.dumps(desc, sort_keys = True, default = str).encode()).hexdigest())
+
+
+    def filename(self, key):
+        """ Returns the path of the file storing the cache entry with the given key. """
+
+        return os.path.join(self.cache_dir, key + '.pickle')
+
+
+    def load(self, key):
+        """ Loads a cache entry. Returns `None` if the entry does not exist or cannot be read. """
+
+        if not self.enabled:
+            return None
+        try:
+            with open(self.filename(key), 'rb') as f:
+                value = pickle.load(f)
+        except (OSError, EOFError, pickle.UnpicklingError):
+            value = None
+        if self.verbose:
+            sys.stderr.write('Embedding cache {}: {}\n'.format('hit' if value is not None else 'miss', key))
+        return value
+
+
+    def store(self, key, value):
+        """ Writes a cache entry atomically, so that concurrent readers will never see partially written files.
+
+        Failures (e.g., due to a read-only cache directory) are reported on stderr but otherwise ignored.
+        """
+
+        if not self.enabled:
+            return
+        try:
+            os.makedirs(self.cache_dir, exist_ok = True)
+            fd, tmp_filename = tempfile.mkstemp(dir = self.cache_dir, prefix = '.' + key, suffix = '.tmp')
+            try:
+                with os.fdopen(fd, 'wb') as f:
+                    pickle.dump(value, f, protocol = pickle.HIGHEST_PROTOCOL)
+                os.replace(tmp_filename, self.filename(key))
+            except:
+                os.remove(tmp_filename)
+                raise
+        except OSError as e:
+            sys.stderr.write('Could not write to embedding cache: {}\n'.format(e))
+
+
+    def array_dirname(self, key):
+        """ Returns the path of the directory storing the cache entry with the given key written by `store_arrays()`. """
+
+        return os.path.join(self.cache_dir, key)
+
+
+    def load_arrays(self, key):
+        """ Loads a cache entry written by `store_arrays()`.
+
+        Returns: dictionary mapping names to memory-mapped read-only numpy arrays or `None` if the entry does not exist or cannot be read.
+        """
+
+        if not self.enabled:
+            return None
+        dirname = self.array_dirname(key)
+        try:
+            value = { os.path.splitext(fn)[0] : np.load(os.path.join(dirname, fn), mmap_mode = 'r') for fn in os.listdir(dirname) if fn.endswith('.npy') }
+        except (OSError, ValueError):
+            value = None
+        if not value:
+            value = None
+        if self.verbose:
+            sys.stderr.write('Embedding cache {}: {}\n'.format('hit' if value is not None else 'miss', key))
+        return value
+
+
+    def store_arrays(self, key, arrays):
+        """ Writes a cache entry consisting of numpy arrays, which can be memory-mapped when loading them using `load_arrays()`.
+
+        An existing entry with the same key will be replaced. The entry is written to a temporary directory first, so that
+        concurrent readers will never see partially written arrays. Failures are reported on stderr but otherwise ignored.
+
+        arrays - Dictionary mapping names to numpy arrays. Arrays must not contain Python objects.
+        """
+
+        if not self.enabled:
+            return
+        try:
+            os.makedirs(self.cache_dir, exist_ok = True)
+            tmp_dirname = tempfile.mkdtemp(dir = self.cache_dir, prefix = '.' + key, suffix = '.tmp')
+            try:
+                for name, arr in arrays.items():
+                    np.save(os.path.join(tmp_dirname, name + '.npy'), arr, allow_pickle = False)
+                if os.path.isdir(self.array_dirname(key)):
+                    shutil.rmtree(self.array_dirname(key))
+                os.replace(tmp_dirname, self.array_dirname(key))
+            except:
+                shutil.rmtree(tmp_dirname, ignore_errors = True)
+                raise
+        except (OSError, ValueError) as e:
+            sys.stderr.write('Could not write to embedding cache: {}\n'.format(e))
+
+
+    def get(self, key, compute):
+        """ Loads a cache entry or computes it by calling `compute()` and stores the result if it is not cached yet. """
+
+        value = self.load(key)
+        if value is None:
+            value = compute()
+            self.store(key, value)
+        return value
+
+
+    def hierarchy(self, hierarchy_file, is_a = False, id_type = int):
+        """ Loads a `ClassHierarchy` from a file. The parsed hierarchy is cached and instances are shared within the same process. """
+
+        key = self.key('hierarchy', hierarchy_file, is_a, id_type)
+        if key not in self._hierarchies:
+            self._hierarchies[key] = self.get(key, lambda: ClassHierarchy.from_file(hierarchy_file, is_a_relations = is_a, id_type = id_type))
+        return self._hierarchies[key]
+
+
+    def subset(self, hierarchy_file, labels, is_a = False, id_type = int, collapse_unary = True):
+        """ Loads the hierarchy induced by a subset of classes as computed by `ClassHierarchy.subset()`.
+
+        The pruned hierarchy is cached independently of the order of `labels` and instances are shared within the same process.
+        """
+
+        labels = sorted(set(labels), key = str)
+        key = self.key('subset', hierarchy_file, is_a, id_type, labels, collapse_unary = bool(collapse_unary))
+        if key not in self._hierarchies:
+            self._hierarchies[key] = self.get(key, lambda: self.hierarchy(hierarchy_file, is_a, id_type).subset(labels, collapse_unary, precompute_tables = False))
+        return self._hierarchies[key]
+
+
+    def _hierarchy_for(self, hierarchy_file, labels, is_a, id_type, prune):
+        """ Returns either the full hierarchy or the sub-hierarchy induced by `labels` if `prune` is `True`. """
+
+        return self.subset(hierarchy_file, labels, is_a, id_type) if prune else self.hierarchy(hierarchy_file, is_a, id_type)
+
+
+    def class_distances(self, hierarchy_file, labels, is_a = False, id_type = int, prune = False):
+        """ Computes the matrix of pairwise class distances as done by `compute_class_embedding.compute_class_distances()`.
+
+        If `prune` is `True`, distances will be computed on the sub-hierarchy induced by `labels` (see `ClassHierarchy.subset()`).
+        """
+
+        from compute_class_embedding import compute_class_distances
+
+        labels = list(labels)
+        key = self.key('class_dist', hierarchy_file, is_a, id_type, labels, **({ 'prune' : True } if prune else {}))
+        return self.get(key, lambda: compute_class_distances(self._hierarchy_for(hierarchy_file, labels, is_a, id_type, prune), labels))
+
+
+    def embedding(self, hierarchy_file, labels, method = 'unitsphere', num_dim = None, norm = False, is_a = False, id_type = int, prune = False, **kwargs):
+        """ Computes class embeddings as done by `compute_class_embedding.py`.
+
+        hierarchy_file - Path to a file containing parent-child or is-a relationships.
+        labels - List of classes to be embedded. The order of classes determines the order of embeddings.
+        method - Embedding method (see `compute_class_embedding.embed_classes()`).
+        num_dim - Number of embedding dimensions for the 'mds' and 'approx_sim' methods.
+        norm - Whether to L2-normalize the embeddings.
+        is_a - Whether `hierarchy_file` contains is-a instead of parent-child relationships.
+        id_type - Data type of class IDs.
+        prune - Whether to compute the embeddings on the sub-hierarchy induced by `labels` (see `ClassHierarchy.subset()`).
+        kwargs - Further arguments passed to `compute_class_embedding.embed_classes()`.
+
+        Returns: dictionary with the items "embedding", "ind2label", and "label2ind", like the pickle dumps written by `compute_class_embedding.py`.
+        """
+
+        from compute_class_embedding import embed_classes
+
+        def compute():
+            embedding = embed_classes(self.class_distances(hierarchy_file, labels, is_a, id_type, prune), method, num_dim, **kwargs)[0]
+            if (num_dim is not None) and (num_dim < embedding.shape[1]):
+                embedding = embedding[:,-num_dim:] if method == 'approx_sim' else embedding[:,:num_dim]
+            if norm:
+                embedding = embedding / np.maximum(np.linalg.norm(embedding, axis = -1, keepdims = True), 1e-12)
+            return embedding
+
+        labels = list(labels)
+        if prune:
+            kwargs['prune'] = True
+        key = self.key('embedding', hierarchy_file, is_a, id_type, labels, method = method, num_dim = num_dim, norm = bool(norm), **kwargs)
+        kwargs.pop('prune', None)
+        return {
+            'ind2label' : labels,
+            'label2ind' : { lbl : i for i, lbl in enumerate(labels) },
+            'embedding' : self.get(key, compute)
+        }
+
+
+    def pair_tables(self, hierarchy_file, labels, is_a = False, id_type = int, prune = False):
+        """ Loads a `ClassHierarchy` whose LCS and WUP caches are filled for all pairs of the given classes.
+
+        This speeds up `ClassHierarchy.lcs_height()`, `ClassHierarchy.wup_similarity()`, and `ClassHierarchy.hierarchical_precision()`
+        for these classes. If `prune` is `True`, the sub-hierarchy induced by `labels` will be returned instead of the full one
+        (see `ClassHierarchy.subset()`).
+
+        Returns: `ClassHierarchy` instance
+        """
+
+        labels = sorted(set(labels), key = str)
+        hierarchy = self._hierarchy_for(hierarchy_file, labels, is_a, id_type, prune)
+        key = self.key('pair_tables', hierarchy_file, is_a, id_type, labels, **({ 'prune' : True } if prune else {}))
+        hierarchy.load_pair_tables(self.get(key, lambda: hierarchy.pair_tables(labels)))
+        return hierarchy
+
+
+    def ranking(self, feat_file, compute, normalize = False, top_k = None, store_complete = False):
+        """ Loads or computes the nearest neighbors of all images given by a feature file.
+
+        Rankings are keyed by the contents of the feature file and the `normalize` flag. Cached rankings are re-used
+        if they contain at least `top_k` neighbors of each image.
+
+        feat_file - Path to a pickle file containing features of images.
+        compute - Function taking `top_k` as argument and returning a dictionary with the item 'ranking'
+                  (`n-by-k` matrix with the indices of the nearest neighbors of each image) and optionally 'ids'
+                  (vector mapping indices to image IDs).
+        normalize - Whether the features are L2-normalized before computing distances.
+        top_k - Number of neighbors required for each image. If `None`, complete rankings are required.
+        store_complete - Complete rankings take `4 * n^2` bytes and are hence only stored in the cache if this is set to `True`.
+                         Rankings truncated to `top_k` neighbors are always stored.
+
+        Returns: dictionary with the same items as returned by `compute`, truncated to `top_k` neighbors. Arrays loaded from the cache are memory-mapped.
+        """
+
+        key = self.key('ranking', None, features = self.file_hash(feat_file), normalize = bool(normalize), metric = 'cosine' if normalize else 'euclidean')
+        value = self.load_arrays(key)
+        if (value is None) or ('ranking' not in value) or (value['ranking'].shape[1] < (top_k if top_k is not None else len(value['ranking']))):
+            value = compute(top_k)
+            value['ranking'] = value['ranking'].astype(np.int32, copy = False)
+            if store_complete or (value['ranking'].shape[1] < len(value['ranking'])):
+                self.store_arrays(key, value)
+        elif (top_k is not None) and (top_k < value['ranking'].shape[1]):
+            value['ranking'] = value['ranking'][:,:top_k]
+        return value
+
+
+    def retrieval_index(self, feat_file, normalize = False):
+        """ Loads or builds a `RetrievalIndex` of the images given by a feature file.
+
+        feat_file - Path to a pickle file containing features of database images.
+        normalize - Whether to L2-normalize the features.
+
+        Returns: `RetrievalIndex` instance, whose features are memory-mapped if loaded from the cache.
+        """
+
+        from retrieval_index import RetrievalIndex
+
+        key = self.key('retrieval_index', None, features = self.file_hash(feat_file), normalize = bool(normalize))
+        arrays = self.load_arrays(key)
+        if arrays is None:
+            index = RetrievalIndex(feat_file, normalize = normalize)
+            self.store_arrays(key, index.arrays())
+            return index
+        return RetrievalIndex.from_arrays(arrays)
+
+
+
+def add_cache_arguments(parser):
+    """ Adds command-line arguments for controlling the embedding cache to a given `argparse.ArgumentParser`.
+
+    Returns: the argument group, to which further cache-related arguments can be added.
+    """
+
+    arggroup = parser.add_argument_group('Cache parameters')
+    arggroup.add_argument('--cache_dir', type = str, default = DEFAULT_CACHE_DIR, help = 'Directory for caching parsed hierarchies, class distances, class embeddings, LCS tables, retrieval rankings, and retrieval indexes. Can also be set using the environment variable SEMANTIC_EMBEDDINGS_CACHE.')
+    arggroup.add_argument('--no_cache', action = 'store_true', default = False, help = 'Neither read from nor write to the cache.')
+    return arggroup
+
+
+def add_embedding_arguments(parser):
+    """ Adds command-line arguments for computing class embeddings from a hierarchy on the fly to a given `argparse.ArgumentParser`. """
+
+    arggroup = parser.add_argument_group('Class embedding parameters (used if no pickle dump of embeddings is given)')
+    arggroup.add_argument('--hierarchy', type = str, default = None, help = 'Path to a file containing parent-child or is-a relationships (one per line).')
+    arggroup.add_argument('--is_a', action = 'store_true', default = False, help = 'If given, --hierarchy is assumed to contain is-a instead of parent-child relationships.')
+    arggroup.add_argument('--str_ids', action = 'store_true', default = False, help = 'If given, class IDs are treated as strings instead of integers.')
+    arggroup.add_argument('--embedding_method', type = str, default = 'unitsphere', choices = ['unitsphere', 'approx_sim', 'spheres', 'mds'], help = 'Method for computing class embeddings. See compute_class_embedding.py.')
+    arggroup.add_argument('--embedding_dim', type = int, default = None, help = 'Number of embedding dimensions when using the "mds" or "approx_sim" method.')
+    arggroup.add_argument('--embedding_norm', action = 'store_true', default = False, help = 'L2-normalize computed class embeddings.')
+    arggroup.add_argument('--prune_hierarchy', action = 'store_true', default = False, help = 'Compute embeddings on the sub-hierarchy induced by the classes of the dataset instead of the full hierarchy.')
+    add_cache_arguments(parser)
+
+
+def embedding_from_args(args, labels):
+    """ Computes class embeddings for a given list of classes based on command-line arguments added by `add_embedding_arguments()`.
+
+    Returns: dictionary with the items "embedding", "ind2label", and "label2ind".
+    """
+
+    return EmbeddingCache.from_args(args).embedding(
+        args.hierarchy, labels, args.embedding_method, args.embedding_dim, args.embedding_norm,
+        is_a = args.is_a, id_type = str if args.str_ids else int, prune = args.prune_hierarchy
+    )
@@ -1,55 +1,160 @@
 import numpy as np
 from sklearn.svm import LinearSVC
-from scipy.spatial.distance import cdist
 import keras
 
-import sys, argparse, pickle, os.path
+import sys, argparse, pickle, os.path, csv, itertools, tempfile, contextlib
 from collections import OrderedDict
 
 import utils
 from datasets import get_data_generator
-from class_hierarchy import ClassHierarchy
+from datasets.common import num_tta_views
+from embedding_cache import EmbeddingCache, add_cache_arguments
+from linear_classifier import SGDLinearClassifier
 from learn_labelembedding import labelembed_loss
 
+try:
+    from tqdm import tqdm
+except ImportError:
+    def tqdm(it, **kwargs):
+        return it
 
 
-METRICS = ['Accuracy', 'Top-5 Accuracy', 'Avg. Accuracy', 'Hierarchical Accuracy']
 
+METRICS = ['Accuracy', 'Top-5 Accuracy', 'Avg. Accuracy', 'Hierarchical Accuracy', 'Hierarchical Top-5 Accuracy']
 
 
-def train_and_predict(data, model, layer = None, normalize = False, augmentation_epochs = 1, C = 1.0, custom_objects = {}, batch_size = 1):
-    """ Extracts image features, trains a linear SVM for classification, and returns predictions on the test data. """
+
+def top_k_predictions(features, k = 5, weights = None, bias = None, batch_size = 8192):
+    """ Determines the classes with the highest scores for each sample.
+    
+    Scores are computed block-wise as `features * weights^T + bias` (or taken from `features` directly if `weights` is `None`),
+    so that memory consumption is bounded by `batch_size` times the number of classes, regardless of the number of samples.
+    Within each block, the top `k` classes are selected using a partial sort.
+    
+    features - `n-by-d` matrix of samples.
+    k - Number of top classes to be returned for each sample.
+    weights - Optionally, a `c-by-d` matrix of class weights, where `c` is the number of classes.
+    bias - Optionally, a vector of length `c` with class biases.
+    batch_size - Number of samples processed at once.
+    
+    Returns: `n-by-k` matrix with class indices sorted by decreasing score.
+    """
+    
+    if weights is not None:
+        weights = np.asarray(weights, dtype = np.float32).T
+        bias = np.asarray(bias, dtype = np.float32) if bias is not None else None
+    num_classes = weights.shape[1] if weights is not None else features.shape[1]
+    k = min(k, num_classes)
+    
+    top_k = np.empty((len(features), k), dtype = np.int64)
+    for start in range(0, len(features), batch_size):
+        scores = np.asarray(features[start:start+batch_size], dtype = np.float32)
+        if weights is not None:
+            scores = np.dot(scores, weights)
+            if bias is not None:
+                scores += bias
+        if k < num_classes:
+            ind = np.argpartition(-scores, k - 1, axis = -1)[:,:k]
+        else:
+            ind = np.broadcast_to(np.arange(num_classes), scores.shape)
+        order = np.argsort(-np.take_along_axis(scores, ind, axis = -1), axis = -1, kind = 'stable')
+        top_k[start:start+batch_size] = np.take_along_axis(ind, order, axis = -1)
+    return top_k
+
+
+def extract_train_features(data, model, augmentation_epochs = 1, batch_size = 32, read_workers = 0, filename = None, tta = None):
+    """ Extracts image features for all training images batch by batch.
+    
+    data - The data generator.
+    model - The Keras model used for extracting features.
+    augmentation_epochs - Number of passes over the training data. Data augmentation will be applied if this is greater than 1.
+    batch_size - Number of images per batch.
+    read_workers - Number of threads loading and pre-processing images in the background.
+    filename - Optionally, the path of a .npy file to which features will be written instead of keeping them in memory.
+    tta - Optionally, a dictionary with options for test-time augmentation (see `FileDatasetGenerator.compose_batch`).
+          If given, all views of each image will be used as training samples instead of random augmentations.
+    
+    Returns: tuple with an `augmentation_epochs * num_views * num_train`-by-`d` array of features (memory-mapped if `filename` is given)
+             and the vector of corresponding labels.
+    """
+    
+    num_views = num_tta_views(**tta) if tta is not None else 1
+    num_batches = int(np.ceil(data.num_train / batch_size))
+    train_flow = data.flow_train(batch_size, False, shuffle = False, augment = (augmentation_epochs > 1) and (tta is None), workers = read_workers, tta = tta)
+    X_train = None
+    offs = 0
+    for X_batch in tqdm(itertools.islice(train_flow, augmentation_epochs * num_batches), total = augmentation_epochs * num_batches):
+        feat = model.predict_on_batch(X_batch)
+        if X_train is None:
+            shape = (augmentation_epochs * num_views * data.num_train, feat.shape[1])
+            X_train = np.lib.format.open_memmap(filename, 'w+', np.float32, shape) if filename else np.empty(shape, dtype = np.float32)
+        X_train[offs:offs+len(feat)] = feat
+        offs += len(feat)
+    utils.report_input_stats(train_flow)
+    return X_train, np.tile(np.repeat(data.labels_train, num_views), augmentation_epochs)
+
+
+def train_and_predict(data, model, layer = None, normalize = False, augmentation_epochs = 1, C = 1.0, custom_objects = {}, batch_size = 32, read_workers = 0, k = 5,
+                      classifier = 'svm', sgd_epochs = 10, feature_store = None, tta = None, tta_aggregate = 'mean', train_tta = None):
+    """ Extracts image features, trains a linear classifier, and returns the top `k` predictions on the test data.
+    
+    If `classifier` is 'svm', `sklearn.svm.LinearSVC` will be used. If it is 'sgd', the same objective will be optimized
+    for `sgd_epochs` epochs using `linear_classifier.SGDLinearClassifier`, which is much faster for large datasets.
+    If `feature_store` is given, training features will be stored in a temporary memory-mapped file in that directory
+    instead of being kept in memory, which is only useful in combination with the 'sgd' classifier.
+    
+    If `tta` is given, features of test images will be aggregated over several views (see `utils.extract_features`).
+    If `train_tta` is given, the views of training images specified by these options (see `FileDatasetGenerator.compose_batch`)
+    will be used as training samples instead of `augmentation_epochs` random augmentations, independently of `tta`.
+    """
     
     # Load model
     if isinstance(model, str):
         model = keras.models.load_model(model, custom_objects = custom_objects, compile = False)
+    data.uint8_batches = utils.expects_uint8_input(model)
     if layer is not None:
         model = keras.models.Model(model.inputs[0], model.layers[layer].output if isinstance(layer, int) else model.get_layer(layer).output)
     
-    # Extract features
-    sys.stderr.write('Extracting features...\n')
-    X_train = model.predict_generator(data.flow_train(10, False, shuffle = False, augment = augmentation_epochs > 1), augmentation_epochs * (data.num_train // 10), verbose = 1)
-    X_test = model.predict_generator(data.flow_test(batch_size, False, shuffle = False, augment = False), data.num_test // batch_size, verbose = 1)
-    if normalize:
-        X_train /= np.linalg.norm(X_train, axis = -1, keepdims = True)
-        X_test /= np.linalg.norm(X_test, axis = -1, keepdims = True)
-    else:
-        X_max = np.abs(X_train).max(axis = 0, keepdims = True)
-        X_train /= np.maximum(1e-8, X_max)
-        X_test /= np.maximum(1e-8, X_max)
-    
-    # Train SVM
-    sys.stderr.write('Training SVM...\n')
-    svm = LinearSVC(C = C, verbose = 1)
-    svm.fit(X_train, np.tile(data.labels_train, augmentation_epochs))
+    with tempfile.TemporaryDirectory(dir = feature_store) if feature_store else contextlib.suppress() as store_dir:
+        
+        # Extract features
+        sys.stderr.write('Extracting features...\n')
+        X_train, y_train = extract_train_features(
+            data, model, augmentation_epochs if train_tta is None else 1, batch_size, read_workers,
+            os.path.join(store_dir, 'train_features.npy') if store_dir else None, train_tta
+        )
+        X_test = utils.extract_features(model, data, batch_size, read_workers, tta = tta, tta_aggregate = tta_aggregate)
+        
+        # Normalize features chunk by chunk
+        chunk_size = 65536
+        if not normalize:
+            X_max = np.maximum(1e-8, np.max([np.abs(X_train[offs:offs+chunk_size]).max(axis = 0) for offs in range(0, len(X_train), chunk_size)], axis = 0))
+        for X in (X_train, X_test):
+            for offs in range(0, len(X), chunk_size):
+                if normalize:
+                    X[offs:offs+chunk_size] /= np.linalg.norm(X[offs:offs+chunk_size], axis = -1, keepdims = True)
+                else:
+                    X[offs:offs+chunk_size] /= X_max
+        
+        # Train classifier
+        sys.stderr.write('Training {}...\n'.format(classifier.upper()))
+        if classifier == 'sgd':
+            clf = SGDLinearClassifier(C = C, epochs = sgd_epochs, verbose = True)
+        else:
+            clf = LinearSVC(C = C, verbose = 1)
+        clf.fit(X_train, y_train)
+        del X_train
     
     # Predict test classes
     sys.stderr.write('\nPredicting and evaluating...\n')
-    return svm.decision_function(X_test).argsort(axis = -1)[:,::-1]
+    return clf.classes_[top_k_predictions(X_test, k, clf.coef_, clf.intercept_)]
 
 
-def nn_classification(data, centroids, model, layer = None, custom_objects = {}, batch_size = 1):
-    """ Extracts image embeddings and performs classification by assigning samples to the class of the nearest embedding. """
+def nn_classification(data, centroids, model, layer = None, custom_objects = {}, batch_size = 32, read_workers = 0, k = 5, tta = None, tta_aggregate = 'mean'):
+    """ Extracts image embeddings and performs classification by assigning samples to the class of the nearest embedding.
+    
+    Returns: indices of the `k` nearest classes for each test sample, sorted by increasing distance.
+    """
     
     # Load class centroids
     if isinstance(centroids, str):
@@ -59,52 +164,101 @@ def nn_classification(data, centroids, model, layer = None, custom_objects = {},
     # Load model
     if isinstance(model, str):
         model = keras.models.load_model(model, custom_objects = custom_objects, compile = False)
+    data.uint8_batches = utils.expects_uint8_input(model)
     if layer is not None:
         model = keras.models.Model(model.inputs[0], model.layers[layer].output if isinstance(layer, int) else model.get_layer(layer).output)
     
     # Extract features
     sys.stderr.write('Extracting features...\n')
-    feat = model.predict_generator(data.flow_test(batch_size, False, shuffle = False, augment = False), data.num_test // batch_size, verbose = 1)
+    feat = utils.extract_features(model, data, batch_size, read_workers, tta = tta, tta_aggregate = tta_aggregate)
     
     # Classify
+    # (||x - c||^2 = ||x||^2 - 2 * <x, c> + ||c||^2, where the first term is the same for all classes)
     sys.stderr.write('Searching for nearest class centroids...\n')
-    return cdist(feat, centroids, 'sqeuclidean').argsort(axis = -1)
+    return top_k_predictions(feat, k, 2 * centroids, -np.sum(centroids * centroids, axis = -1))
 
 
-def extract_predictions(data, model, layer = None, custom_objects = {}, batch_size = 1):
-    """ Extracts class predictions. """
+def extract_predictions(data, model, layer = None, custom_objects = {}, batch_size = 32, read_workers = 0, k = 5, tta = None, tta_aggregate = 'mean'):
+    """ Extracts class predictions and returns the indices of the `k` classes with the highest scores for each test sample. """
     
     # Load model
     if isinstance(model, str):
         model = keras.models.load_model(model, custom_objects = custom_objects, compile = False)
+    data.uint8_batches = utils.expects_uint8_input(model)
     if layer is not None:
         model = keras.models.Model(model.inputs[0], model.layers[layer].output if isinstance(layer, int) else model.get_layer(layer).output)
     
     # Extract predictions
     sys.stderr.write('Predicting and evaluating...\n')
-    return model.predict_generator(data.flow_test(batch_size, False, shuffle = False, augment = False), data.num_test // batch_size, verbose = 1).argsort(axis = -1)[:,::-1]
+    pred = utils.extract_features(model, data, batch_size, read_workers, tta = tta, tta_aggregate = tta_aggregate)
+    return top_k_predictions(pred, k)
 
 
-def evaluate(y_pred, data_generator, hierarchy):
+def evaluate(y_pred, data_generator, hierarchy, k = 5, per_class = False):
+    """ Computes flat, balanced, and hierarchical accuracy of class predictions.
+    
+    All metrics are derived from a confusion matrix and a matrix of similarities between all pairs of classes,
+    so that the cost of the hierarchical metrics does not depend on the number of test samples.
+    
+    y_pred - Either a vector of predicted class indices or a matrix with class indices sorted by decreasing confidence for each sample.
+    data_generator - Dataset providing `labels_test` and `classes`.
+    hierarchy - `ClassHierarchy` used for computing hierarchical accuracy. May be `None`.
+    k - Number of top predictions considered by the top-k metrics.
+    per_class - If set to `True`, metrics will also be broken down by class.
+    
+    Returns: ordered dictionary mapping metric names to values. If `per_class` is `True`, a tuple will be returned,
+             whose second component is an ordered dictionary mapping metric names to vectors of per-class values.
+    """
     
     perf = OrderedDict()
-    y_true = np.asarray(data_generator.labels_test)
+    class_perf = OrderedDict()
+    y_true = np.asarray(data_generator.labels_test, dtype = np.int64)
+    y_pred = np.asarray(y_pred, dtype = np.int64)
+    num_classes = len(data_generator.classes)
+    class_freq = np.bincount(y_true, minlength = num_classes)
+    top_k = None
     if y_pred.ndim == 2:
-        perf['Top-5 Accuracy'] = np.mean(np.any(y_pred[:,:5] == y_true[:,None], axis = -1))
+        top_k = y_pred[:,:k]
         y_pred = y_pred[:,0]
     
-    perf['Accuracy'] = np.mean(y_pred == y_true)
-
-    class_freq = np.bincount(y_true)
-    perf['Avg. Accuracy'] = ((y_pred == y_true).astype(np.float) / class_freq[y_true]).sum() / len(class_freq)
+    confusion = np.bincount(y_true * num_classes + y_pred, minlength = num_classes * num_classes).reshape(num_classes, num_classes)
+    class_perf['Accuracy'] = np.diag(confusion) / np.maximum(class_freq, 1)
+    
+    perf['Accuracy'] = np.trace(confusion) / len(y_true)
+    perf['Avg. Accuracy'] = class_perf['Accuracy'].sum() / (int(y_true.max()) + 1)
+    if top_k is not None:
+        top_k_correct = np.any(top_k == y_true[:,None], axis = -1)
+        perf['Top-{} Accuracy'.format(k)] = np.mean(top_k_correct)
+        class_perf['Top-{} Accuracy'.format(k)] = np.bincount(y_true, top_k_correct, minlength = num_classes) / np.maximum(class_freq, 1)
     
     if hierarchy is not None:
-        perf['Hierarchical Accuracy'] = 0.0
-        for yp, yt in zip(y_pred, y_true):
-            perf['Hierarchical Accuracy'] += 1.0 - hierarchy.lcs_height(data_generator.classes[int(yp)], data_generator.classes[int(yt)])
-        perf['Hierarchical Accuracy'] /= len(y_true)
+        class_sim = hierarchy.similarity_matrix(data_generator.classes, 'lcs')
+        class_perf['Hierarchical Accuracy'] = (confusion * class_sim).sum(axis = -1) / np.maximum(class_freq, 1)
+        perf['Hierarchical Accuracy'] = (confusion * class_sim).sum() / len(y_true)
+        if top_k is not None:
+            # Similarity of the most similar class among the top k predictions
+            top_k_sim = class_sim[y_true[:,None], top_k].max(axis = -1)
+            perf['Hierarchical Top-{} Accuracy'.format(k)] = np.mean(top_k_sim)
+            class_perf['Hierarchical Top-{} Accuracy'.format(k)] = np.bincount(y_true, top_k_sim, minlength = num_classes) / np.maximum(class_freq, 1)
+    
+    return (perf, class_perf) if per_class else perf
+
+
+def write_per_class_csv(filename, class_perf, classes):
+    """ Writes per-class metrics as returned by `evaluate()` for several models to a CSV file.
+    
+    filename - Path of the CSV file.
+    class_perf - Dictionary mapping model names to dictionaries mapping metric names to vectors of per-class values.
+    classes - List of class labels.
+    """
     
-    return perf
+    with open(filename, 'w', newline = '') as f:
+        metrics = [metric for metric in METRICS if any(metric in perf for perf in class_perf.values())]
+        writer = csv.writer(f)
+        writer.writerow(['Model', 'Class'] + metrics)
+        for model_name, perf in class_perf.items():
+            for i, lbl in enumerate(classes):
+                writer.writerow([model_name, lbl] + ['{:.4f}'.format(perf[metric][i]) if metric in perf else '' for metric in metrics])
 
 
 def print_performance(perf, metrics = METRICS):
@@ -143,10 +297,19 @@ if __name__ == '__main__':
     arggroup.add_argument('--hierarchy', type = str, default = None, help = 'Path to a file containing parent-child relationships (one per line). Used for evaluating hierarchical accuracy.')
     arggroup.add_argument('--is_a', action = 'store_true', default = False, help = 'If given, --hierarchy is assumed to contain is-a instead of parent-child relationships.')
     arggroup.add_argument('--str_ids', action = 'store_true', default = False, help = 'If given, class IDs are treated as strings instead of integers.')
+    arggroup.add_argument('--prune_hierarchy', action = 'store_true', default = False, help = 'Evaluate on the sub-hierarchy induced by the classes of the dataset instead of the full hierarchy. This changes the height of the hierarchy and hence the resulting similarities.')
     arggroup.add_argument('--classes_from', type = str, default = None, help = 'Optionally, a path to a pickle dump containing a dictionary with item "ind2label" specifying the classes to be considered. These should be in the same order as the classes predicted by the model.')
     arggroup.add_argument('--augmentation_epochs', type = int, default = 1, help = 'Number of training image augmentations when training an SVM on top of embeddings.')
     arggroup.add_argument('--C', type = float, default = 0.1, help = 'Weight of the error in SVM loss.')
-    arggroup.add_argument('--batch_size', type = int, default = 1, help = 'Batch size for feature extraction. Must divide the number of test images evenly.')
+    arggroup.add_argument('--classifier', type = str, default = 'svm', choices = ['svm', 'sgd'], help = 'Linear classifier trained on top of embeddings: "svm" uses LinearSVC, "sgd" optimizes the same objective using mini-batch SGD, which scales to large datasets.')
+    arggroup.add_argument('--sgd_epochs', type = int, default = 10, help = 'Number of training epochs of the "sgd" classifier.')
+    arggroup.add_argument('--feature_store', type = str, default = None, help = 'Directory where training features are stored in a temporary memory-mapped file instead of being kept in memory. Should be used with --classifier sgd.')
+    arggroup.add_argument('--batch_size', type = int, default = 32, help = 'Batch size for feature extraction.')
+    arggroup.add_argument('--read_workers', type = int, default = 0, help = 'Number of threads loading and pre-processing images in the background during feature extraction.')
+    arggroup.add_argument('--tta', action = 'store_true', default = False, help = 'Test-time augmentation: aggregate features over the center and corner crops of each test image and their horizontally flipped versions.')
+    arggroup.add_argument('--tta_scales', type = int, nargs = '+', default = None, help = 'Sizes of the smaller image side used for test-time augmentation. Defaults to the default size of the dataset.')
+    arggroup.add_argument('--tta_aggregate', type = str, default = 'mean', choices = ['mean', 'max'], help = 'Aggregation of features over test-time augmentation views.')
+    arggroup.add_argument('--train_tta', action = 'store_true', default = False, help = 'Use the test-time augmentation views of training images as training samples instead of --augmentation_epochs random augmentations. Does not enable test-time augmentation for test images, which requires --tta.')
     arggroup = parser.add_argument_group('Features')
     arggroup.add_argument('--architecture', type = str, default = 'simple', choices = utils.ARCHITECTURES, help = 'Type of network architecture.')
     arggroup.add_argument('--model', type = str, action = 'append', required = True, help = 'Path to a keras model dump used for extracting image features.')
@@ -155,6 +318,9 @@ if __name__ == '__main__':
     arggroup.add_argument('--norm', type = str2bool, action = 'append', help = 'Whether to L2-normalize the corresponding features or not (defaults to False).')
     arggroup.add_argument('--prob_features', type = str2bool, action = 'append', help = 'Whether to use the extracted features as class probabilities instead of training an SVM.')
     arggroup.add_argument('--centroids', type = str, action = 'append', help = 'Optionally, a pickle dump containing a dictionary with an item "embedding" referring to a numpy array of class centroids for performing nearest-neighbor classification.')
+    arggroup = parser.add_argument_group('Output')
+    arggroup.add_argument('--per_class_csv', type = str, default = None, help = 'Optionally, path to a CSV file where the performance of all models broken down by class will be written to.')
+    add_cache_arguments(parser)
     args = parser.parse_args()
     
     # Load dataset
@@ -167,12 +333,16 @@ if __name__ == '__main__':
     
     # Load class hierarchy
     id_type = str if args.str_ids else int
-    hierarchy = ClassHierarchy.from_file(args.hierarchy, is_a_relations = args.is_a, id_type = id_type) if args.hierarchy else None
+    hierarchy = EmbeddingCache.from_args(args).pair_tables(args.hierarchy, data_generator.classes, args.is_a, id_type, args.prune_hierarchy) if args.hierarchy else None
     
     # Learn SVM classifier on training data and evaluate on test data
+    tta_views = { 'scales' : args.tta_scales, 'corners' : True, 'flips' : True }
+    tta = tta_views if args.tta else None
+    train_tta = tta_views if args.train_tta else None
     custom_objects = utils.get_custom_objects(args.architecture)
     custom_objects['labelembed_loss'] = labelembed_loss
     perf = OrderedDict()
+    class_perf = OrderedDict()
     for i, model in enumerate(args.model):
         model_name = args.label[i] if (args.label is not None) and (i < len(args.label)) else os.path.splitext(os.path.basename(model))[0]
         if (args.layer is not None) and (i < len(args.layer)):
@@ -187,12 +357,16 @@ if __name__ == '__main__':
         centroids = args.centroids[i] if (args.centroids is not None) and (i < len(args.centroids)) else ''
         sys.stderr.write('-- {} --\n'.format(model_name))
         if prob_features:
-            pred = extract_predictions(data_generator, model, layer, custom_objects, args.batch_size)
+            pred = extract_predictions(data_generator, model, layer, custom_objects, args.batch_size, args.read_workers, tta = tta, tta_aggregate = args.tta_aggregate)
         elif centroids:
-            pred = nn_classification(data_generator, centroids, model, layer, custom_objects, args.batch_size)
+            pred = nn_classification(data_generator, centroids, model, layer, custom_objects, args.batch_size, args.read_workers, tta = tta, tta_aggregate = args.tta_aggregate)
         else:
-            pred = train_and_predict(data_generator, model, layer, normalize, args.augmentation_epochs, args.C, custom_objects, args.batch_size)
-        perf[model_name] = evaluate(pred, data_generator, hierarchy)
+            pred = train_and_predict(data_generator, model, layer, normalize, args.augmentation_epochs, args.C, custom_objects, args.batch_size, args.read_workers,
+                                     classifier = args.classifier, sgd_epochs = args.sgd_epochs, feature_store = args.feature_store,
+                                     tta = tta, tta_aggregate = args.tta_aggregate, train_tta = train_tta)
+        perf[model_name], class_perf[model_name] = evaluate(pred, data_generator, hierarchy, per_class = True)
     
     # Show results
-    print_performance(perf)
\ No newline at end of file
+    print_performance(perf)
+    if args.per_class_csv:
+        write_per_class_csv(args.per_class_csv, class_perf, data_generator.classes)
\ No newline at end of file
@@ -1,11 +1,13 @@
 import numpy as np
 import numexpr as ne
 
-import argparse, pickle, os.path
+import sys, argparse, pickle, os.path
+import multiprocessing
 from collections import OrderedDict
 
 from datasets import get_data_generator
-from class_hierarchy import ClassHierarchy
+from embedding_cache import EmbeddingCache, add_cache_arguments
+from retrieval_index import RetrievalIndex, load_features
 
 try:
     from tqdm import tqdm
@@ -19,39 +21,39 @@ METRICS = ['P@1 (WUP)', 'P@10 (WUP)', 'P@50 (WUP)', 'P@100 (WUP)', 'AHP (WUP)',
 
 
 
-def pairwise_retrieval(features, normalize = False, return_generator = True):
-    """ Uses each image as query and retrieves its nearest neighbors.
+def pairwise_ranking(features, normalize = False, top_k = None, cache = None, cache_complete = False):
+    """ Uses each image as query and ranks all images by their distance to the query.
     
     # Arguments:
 
-    - features: Features for all images. Can be provided in the following ways:
-                - 2-d numpy array with each row corresponding to a sample.
-                - Dictionary mapping image IDs to feature vectors.
-                - Path to a pickle file containing such a dictionary.
+    - features: Features for all images (see `pairwise_retrieval`).
     
     - normalize: Whether to L2-normalize the features.
 
-    - return_generator: If True, a generator will be returned instead of a dictionary.
+    - top_k: Optionally, the number of nearest neighbors to be retrieved for each image. Defaults to all images.
+
+    - cache: Optionally, an `EmbeddingCache` for storing and re-using rankings if `features` is the path of a file.
+
+    - cache_complete: Whether to store complete rankings in the cache, which takes `4 * n^2` bytes.
+                      Rankings truncated to `top_k` neighbors are always stored.
 
     # Returns:
-        If return_generator is True, a generator will be returned that yields tuples consisting
-        of an image ID and an ordered list with the IDs of this image's nearest neighbors.
-        If return_generator is False, a dictionary mapping IDs to such lists will be returned.
+        tuple with 2 items:
+        1. array mapping row indices to image IDs or None if `features` is a numpy array.
+        2. `n-by-k` matrix whose rows contain the row indices of the nearest neighbors of each image.
+        Rankings loaded from the cache are memory-mapped.
     """
     
-    # Convert feature list to numpy array
-    if isinstance(features, str):
-        with open(features, 'rb') as feat_dump:
-            features = pickle.load(feat_dump)
-    if isinstance(features, dict):
-        if 'feat' in features:
-            features = features['feat']
-        ind2id = np.array(list(features.keys()))
-        features = np.stack(list(features.values()))
-        if features.ndim > 2:
-            raise ValueError('Feature matrix must be 2-dimensional. Actual shape: {}'.format(features.shape))
+    if (cache is not None) and isinstance(features, str):
+        result = cache.ranking(features, lambda k: _compute_ranking(features, normalize, k), normalize, top_k, cache_complete)
     else:
-        ind2id = None
+        result = _compute_ranking(features, normalize, top_k)
+    return result.get('ids'), result['ranking']
+
+
+def _compute_ranking(features, normalize = False, top_k = None):
+    
+    ind2id, features = load_features(features)
     
     # Compute pairwise distances
     if normalize:
@@ -64,8 +66,48 @@ def pairwise_retrieval(features, normalize = False, return_generator = True):
     del features
     
     # Rank images
-    ranking = np.argsort(pdist, axis = -1)
+    if (top_k is not None) and (top_k < len(pdist)):
+        ranking = np.argpartition(pdist, top_k - 1, axis = -1)[:,:top_k]
+        order = np.argsort(np.take_along_axis(pdist, ranking, axis = -1), axis = -1, kind = 'stable')
+        ranking = np.take_along_axis(ranking, order, axis = -1)
+        del order
+    else:
+        ranking = np.argsort(pdist, axis = -1)
     del pdist
+    
+    result = { 'ranking' : ranking }
+    if ind2id is not None:
+        result['ids'] = ind2id
+    return result
+
+
+def pairwise_retrieval(features, normalize = False, return_generator = True, top_k = None, cache = None, cache_complete = False):
+    """ Uses each image as query and retrieves its nearest neighbors.
+    
+    # Arguments:
+
+    - features: Features for all images. Can be provided in the following ways:
+                - 2-d numpy array with each row corresponding to a sample.
+                - Dictionary mapping image IDs to feature vectors.
+                - Path to a pickle file containing such a dictionary.
+    
+    - normalize: Whether to L2-normalize the features.
+
+    - return_generator: If True, a generator will be returned instead of a dictionary.
+
+    - top_k: Optionally, the number of nearest neighbors to be retrieved for each image. Defaults to all images.
+
+    - cache: Optionally, an `EmbeddingCache` for storing and re-using rankings if `features` is the path of a file.
+
+    - cache_complete: Whether to store complete rankings in the cache (see `pairwise_ranking`).
+
+    # Returns:
+        If return_generator is True, a generator will be returned that yields tuples consisting
+        of an image ID and an ordered list with the IDs of this image's nearest neighbors.
+        If return_generator is False, a dictionary mapping IDs to such lists will be returned.
+    """
+    
+    ind2id, ranking = pairwise_ranking(features, normalize, top_k, cache, cache_complete)
     if ind2id is not None:
         gen = ((ind2id[i], ind2id[ret].tolist()) for i, ret in enumerate(ranking))
     else:
@@ -73,6 +115,89 @@ def pairwise_retrieval(features, normalize = False, return_generator = True):
     return gen if return_generator else dict(gen)
 
 
+def evaluate_features(feat_dump, normalize, hierarchy, labels, ks, compute_ahp = True, reference = None, top_k = None, cache = None, db_feat = None, db_labels = None, cache_complete = False):
+    """ Performs image retrieval using given features and computes hierarchical precision.
+
+    By default, each image is used as query against all other images. If `db_feat` is given, the images given by
+    `feat_dump` are used as queries against a database of different images instead.
+
+    # Arguments:
+
+    - feat_dump: Features for all images (see `pairwise_retrieval`).
+
+    - normalize: Whether to L2-normalize the features.
+
+    - hierarchy: The ClassHierarchy.
+
+    - labels: List with the class labels of all images.
+
+    - ks: Cut-off points at which hierarchical precision is to be computed.
+
+    - compute_ahp: See `ClassHierarchy.hierarchical_precision`.
+
+    - reference: Optionally, class similarities and optimal rankings for `labels` as returned by `ClassHierarchy.precision_reference`.
+
+    - top_k: Optionally, the number of nearest neighbors to be retrieved for each image. Defaults to all images.
+
+    - cache: Optionally, an `EmbeddingCache` for storing and re-using rankings and database indexes.
+
+    - db_feat: Optionally, features of the database images (see `retrieval_index.load_features`).
+
+    - db_labels: List with the class labels of all database images. Required if `db_feat` is given.
+                 `reference` must then have been computed for `db_labels` with `labels` as `query_classes`.
+
+    - cache_complete: Whether to store complete rankings in the cache (see `pairwise_ranking`).
+
+    # Returns:
+        dictionary mapping metric names to their average over all queries.
+    """
+    
+    if db_feat is not None:
+        if (cache is not None) and isinstance(db_feat, str):
+            index = cache.retrieval_index(db_feat, normalize)
+        else:
+            index = RetrievalIndex(db_feat, normalize = normalize)
+        return hierarchy.hierarchical_precision(
+            index.retrieve(feat_dump, top_k), db_labels, ks,
+            compute_ahp = compute_ahp, compute_ap = True, reference = reference, query_labels = labels
+        )[0]
+    
+    return hierarchy.hierarchical_precision(
+        pairwise_retrieval(feat_dump, normalize, top_k = top_k, cache = cache, cache_complete = cache_complete), labels, ks,
+        compute_ahp = compute_ahp, compute_ap = True, all_ids = list(range(len(labels))), reference = reference
+    )[0]
+
+
+# Shared state inherited by worker processes, which avoids pickling the hierarchy and the reference for every task.
+_shared = {}
+
+def _evaluate_shared(task):
+    
+    feat_dump, normalize, db_feat = task
+    perf = evaluate_features(
+        feat_dump, normalize, _shared['hierarchy'], _shared['labels'], _shared['ks'], _shared['compute_ahp'], _shared['reference'],
+        _shared['top_k'], _shared['cache'], db_feat, _shared['db_labels'], _shared['cache_complete']
+    )
+    return perf, peak_memory()
+
+
+def peak_memory():
+    """ Returns the peak resident memory of the current process in bytes or None if it cannot be determined. """
+    
+    try:
+        import resource
+    except ImportError:
+        return None
+    usage = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return usage if sys.platform == 'darwin' else usage * 1024
+
+
+def reference_size(reference):
+    """ Returns the number of bytes occupied by the arrays of a reference returned by `ClassHierarchy.precision_reference`. """
+    
+    return sum(value.nbytes for value in reference.values() if isinstance(value, np.ndarray))
+
+
 def print_performance(perf, metrics = METRICS):
     
     print()
@@ -161,17 +286,27 @@ if __name__ == '__main__':
     arggroup.add_argument('--hierarchy', type = str, required = True, help = 'Path to a file containing parent-child relationships (one per line).')
     arggroup.add_argument('--is_a', action = 'store_true', default = False, help = 'If given, --hierarchy is assumed to contain is-a instead of parent-child relationships.')
     arggroup.add_argument('--str_ids', action = 'store_true', default = False, help = 'If given, class IDs are treated as strings instead of integers.')
+    arggroup.add_argument('--prune_hierarchy', action = 'store_true', default = False, help = 'Evaluate on the sub-hierarchy induced by the classes of the dataset instead of the full hierarchy. This changes the height of the hierarchy and hence the resulting similarities.')
     arggroup.add_argument('--classes_from', type = str, default = None, help = 'Optionally, a path to a pickle dump containing a dictionary with item "ind2label" specifying the classes to be considered.')
     arggroup = parser.add_argument_group('Features')
     arggroup.add_argument('--feat', type = str, action = 'append', required = True, help = 'Pickle file containing a dictionary mapping image IDs to features.')
     arggroup.add_argument('--label', type = str, action = 'append', help = 'Label for the corresponding features.')
     arggroup.add_argument('--norm', type = str2bool, action = 'append', help = 'Whether to L2-normalize the corresponding features or not (defaults to False).')
+    arggroup.add_argument('--top_k', type = int, default = None, help = 'Only retrieve this number of nearest neighbors for each image, which requires --clip_ahp. The remaining images are appended to rankings in arbitrary order, which affects AP. With --db_feat, AP is computed over the retrieved images only.')
+    arggroup.add_argument('--db_feat', type = str, action = 'append', help = 'Pickle file containing a dictionary mapping IDs of training images to features. If given once for each --feat, test images are used as queries against a database of these training images instead of against each other. Database indexes are cached.')
+    arggroup.add_argument('--workers', type = int, default = None, help = 'Number of processes evaluating different features concurrently. Each feature is evaluated in a new process. Defaults to the number of features, but at most the number of CPUs.')
     arggroup = parser.add_argument_group('Output')
     arggroup.add_argument('--plot_max', type = int, default = 250, help = 'Plot hierarchical precision up to this number of retrieved images. Set this to 0 to disable plotting.')
     arggroup.add_argument('--prec_type', type = str, default = 'LCS_HEIGHT', choices = ['WUP', 'LCS_HEIGHT'], help = 'Measure for semantic similarity between classes to be used.')
     arggroup.add_argument('--clip_ahp', type = int, default = None, help = 'If given, clip ranking at this position for computing AHP.')
     arggroup.add_argument('--csv', type = str, default = None, help = 'Name of a CSV file where performance metrics will be written to.')
+    arggroup = add_cache_arguments(parser)
+    arggroup.add_argument('--cache_rankings', action = 'store_true', default = False, help = 'Also cache complete rankings, which take 4*n^2 bytes for n test images. Rankings truncated by --top_k are always cached.')
     args = parser.parse_args()
+    if (args.top_k is not None) and ((not args.clip_ahp) or (args.top_k <= max(args.plot_max, args.clip_ahp, 100))):
+        parser.error('--top_k requires --clip_ahp and must be larger than --plot_max, --clip_ahp, and 100.')
+    if (args.db_feat is not None) and (len(args.db_feat) != len(args.feat)):
+        parser.error('--db_feat must be given once for each --feat.')
     
     # Load dataset
     if args.classes_from:
@@ -181,21 +316,57 @@ if __name__ == '__main__':
         embed_labels = None
     data_generator = get_data_generator(args.dataset, args.data_root, classes = embed_labels)
     labels_test = [embed_labels[lbl] for lbl in data_generator.labels_test] if embed_labels is not None else data_generator.labels_test
+    if args.db_feat is not None:
+        labels_db = [embed_labels[lbl] for lbl in data_generator.labels_train] if embed_labels is not None else data_generator.labels_train
+    else:
+        labels_db = None
     
-    # Load class hierarchy
+    # Load class hierarchy along with pre-computed LCS and WUP tables
     id_type = str if args.str_ids else int
-    hierarchy = ClassHierarchy.from_file(args.hierarchy, is_a_relations = args.is_a, id_type = id_type)
+    cache = EmbeddingCache.from_args(args)
+    hierarchy = cache.pair_tables(args.hierarchy, list(labels_test) + list(labels_db or []), args.is_a, id_type, args.prune_hierarchy)
     
-    # Perform image retrieval using all images in the dataset as queries
+    # Perform image retrieval using all test images as queries
     ks = list(range(1, args.plot_max + 1))
     for k in [1, 10, 50, 100]:
         if (len(ks) == 0) or (ks[-1] < k):
             ks.append(k)
+    # Class similarities and optimal rankings are computed once and shared by all features
+    compute_ahp = args.clip_ahp if args.clip_ahp else True
+    kmax = max(ks + [args.clip_ahp]) if args.clip_ahp else None
+    if labels_db is not None:
+        reference = hierarchy.precision_reference(labels_db, kmax, labels_test)
+    else:
+        reference = hierarchy.precision_reference(labels_test, kmax)
+    _shared.update(
+        hierarchy = hierarchy, labels = labels_test, reference = reference, ks = ks, compute_ahp = compute_ahp,
+        top_k = args.top_k, cache = cache, db_labels = labels_db, cache_complete = args.cache_rankings
+    )
+    sys.stderr.write('Reference rankings: {:.1f} MiB\n'.format(reference_size(reference) / 2**20))
+    
+    feat_names = [
+        args.label[i] if (args.label is not None) and (i < len(args.label)) else os.path.splitext(os.path.basename(feat_dump))[0]
+        for i, feat_dump in enumerate(args.feat)
+    ]
+    tasks = [
+        (feat_dump, args.norm[i] if (args.norm is not None) and (i < len(args.norm)) else False, args.db_feat[i] if args.db_feat is not None else None)
+        for i, feat_dump in enumerate(args.feat)
+    ]
+    # Each evaluation runs in a fresh process, so that its peak memory can be reported individually
+    workers = args.workers if args.workers is not None else min(len(tasks), multiprocessing.cpu_count())
+    if 'fork' in multiprocessing.get_all_start_methods():
+        with multiprocessing.get_context('fork').Pool(max(1, min(workers, len(tasks))), maxtasksperchild = 1) as pool:
+            results = list(tqdm(pool.imap(_evaluate_shared, tasks), total = len(tasks)))
+        mem_desc = 'peak memory'
+    else:
+        results = [_evaluate_shared(task) for task in tqdm(tasks)]
+        mem_desc = 'peak memory of the process so far'
+    
     perf = OrderedDict()
-    for i, feat_dump in tqdm(enumerate(args.feat), total = len(args.feat)):
-        feat_name = args.label[i] if (args.label is not None) and (i < len(args.label)) else os.path.splitext(os.path.basename(feat_dump))[0]
-        normalize = args.norm[i] if (args.norm is not None) and (i < len(args.norm)) else False
-        perf[feat_name] = hierarchy.hierarchical_precision(pairwise_retrieval(feat_dump, normalize), labels_test, ks, compute_ahp = args.clip_ahp if args.clip_ahp else True, compute_ap = True, all_ids = list(range(data_generator.num_test)))[0]
+    for feat_name, (feat_perf, mem) in zip(feat_names, results):
+        perf[feat_name] = feat_perf
+        if mem is not None:
+            sys.stderr.write('{}: {} {:.1f} MiB\n'.format(feat_name, mem_desc, mem / 2**20))
     
     # Show results
     if args.clip_ahp:
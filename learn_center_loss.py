@@ -11,6 +11,7 @@ from keras import backend as K
 
 import utils
 from datasets import get_data_generator
+from embedding_cache import add_embedding_arguments, embedding_from_args
 
 
 
@@ -57,7 +58,7 @@ if __name__ == '__main__':
     arggroup.add_argument('--class_list', type = str, default = None, help = 'Path to a file containing the IDs of the subset of classes to be used (as first words per line).')
     arggroup = parser.add_argument_group('Center loss parameters')
     arggroup.add_argument('--embed_dim', type = int, default = 100, help = 'Dimensionality of learned image embeddings.')
-    arggroup.add_argument('--centroids', type = str, default = None, help = 'Path to a pickle dump of embeddings generated by compute_class_embeddings.py. If given, this fixed set of class centroids will be used instead of learning centroids.')
+    arggroup.add_argument('--centroids', type = str, default = None, help = 'Path to a pickle dump of embeddings generated by compute_class_embeddings.py. If given, this fixed set of class centroids will be used instead of learning centroids. Alternatively, fixed centroids can be computed from --hierarchy.')
     arggroup.add_argument('--center_loss_weight', type = float, default = 0.1, help = 'Weight of the center loss (softmax loss has fixed weight 1.0).')
     arggroup = parser.add_argument_group('Training parameters')
     arggroup.add_argument('--architecture', type = str, default = 'simple', choices = utils.ARCHITECTURES, help = 'Type of network architecture.')
@@ -73,6 +74,7 @@ if __name__ == '__main__':
     arggroup.add_argument('--gpus', type = int, default = 1, help = 'Number of GPUs to be used.')
     arggroup.add_argument('--read_workers', type = int, default = 8, help = 'Number of parallel data pre-processing processes.')
     arggroup.add_argument('--queue_size', type = int, default = 100, help = 'Maximum size of data queue.')
+    arggroup.add_argument('--uint8_batches', action = 'store_true', default = False, help = 'Transfer unnormalized uint8 images from the data loaders and normalize them in the model, which reduces inter-process communication and queue memory by a factor of 4.')
     arggroup.add_argument('--gpu_merge', action = 'store_true', default = False, help = 'Merge weights on the GPU.')
     arggroup = parser.add_argument_group('Output parameters')
     arggroup.add_argument('--model_dump', type = str, default = None, help = 'Filename where the learned model definition and weights should be written to.')
@@ -81,6 +83,7 @@ if __name__ == '__main__':
     arggroup.add_argument('--log_dir', type = str, default = None, help = 'Tensorboard log directory.')
     arggroup.add_argument('--no_progress', action = 'store_true', default = False, help = 'Do not display training progress, but just the final performance.')
     utils.add_lr_schedule_arguments(parser)
+    add_embedding_arguments(parser)
     
     args = parser.parse_args()
     
@@ -109,15 +112,23 @@ if __name__ == '__main__':
 
     # Load dataset
     data_generator = get_data_generator(args.dataset, args.data_root, classes = class_list)
+    if (centroids is None) and args.hierarchy:
+        centroids = embedding_from_args(args, list(data_generator.classes))['embedding']
+        embed_dim = centroids.shape[1]
+    if args.uint8_batches:
+        data_generator.uint8_batches = True
+        input_normalization = data_generator.input_normalization()
+    else:
+        input_normalization = None
 
     # Construct and train model
     if (args.gpus <= 1) or args.gpu_merge:
-        embed_model = utils.build_network(embed_dim, args.architecture)
+        embed_model = utils.build_network(embed_dim, args.architecture, input_normalization = input_normalization)
         model = center_loss_model(embed_model, centroids if centroids is not None else data_generator.num_classes)
         par_model = model if args.gpus <= 1 else keras.utils.multi_gpu_model(model, gpus = args.gpus, cpu_merge = False)
     else:
         with K.tf.device('/cpu:0'):
-            embed_model = utils.build_network(embed_dim, args.architecture)
+            embed_model = utils.build_network(embed_dim, args.architecture, input_normalization = input_normalization)
             model = center_loss_model(embed_model, centroids if centroids is not None else data_generator.num_classes)
         par_model = keras.utils.multi_gpu_model(model, gpus = args.gpus)
     if not args.no_progress:
@@ -193,6 +204,6 @@ if __name__ == '__main__':
 
     # Save test image embeddings
     if args.feature_dump:
-        pred_features = embed_model.predict_generator(data_generator.flow_test(1, False), data_generator.num_test)
+        pred_features = utils.extract_features(embed_model, data_generator, args.val_batch_size)
         with open(args.feature_dump,'wb') as dump_file:
             pickle.dump({ 'feat' : dict(enumerate(pred_features)) }, dump_file)
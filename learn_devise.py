@@ -10,6 +10,7 @@ from keras import backend as K
 
 import utils
 from datasets import get_data_generator
+from embedding_cache import add_embedding_arguments, embedding_from_args
 
 
 
@@ -26,7 +27,7 @@ if __name__ == '__main__':
     arggroup = parser.add_argument_group('Data parameters')
     arggroup.add_argument('--dataset', type = str, required = True, help = 'Training dataset. See README.md for a list of available datasets.')
     arggroup.add_argument('--data_root', type = str, required = True, help = 'Root directory of the dataset.')
-    arggroup.add_argument('--embedding', type = str, required = True, help = 'Path to a pickle dump of embeddings in the same format as used by compute_class_embeddings.py.')
+    arggroup.add_argument('--embedding', type = str, default = None, help = 'Path to a pickle dump of embeddings in the same format as used by compute_class_embeddings.py. If not given, embeddings will be computed from --hierarchy or loaded from the embedding cache.')
     arggroup = parser.add_argument_group('Training parameters')
     arggroup.add_argument('--architecture', type = str, default = 'simple', choices = utils.ARCHITECTURES, help = 'Type of network architecture.')
     arggroup.add_argument('--init_weights', type = str, default = None, help = 'Path to a weights file to initialize the model with.')
@@ -46,7 +47,10 @@ if __name__ == '__main__':
     arggroup.add_argument('--feature_dump', type = str, default = None, help = 'Filename where learned embeddings for test images should be written to.')
     arggroup.add_argument('--log_dir', type = str, default = None, help = 'Tensorboard log directory.')
     arggroup.add_argument('--no_progress', action = 'store_true', default = False, help = 'Do not display training progress, but just the final performance.')
+    add_embedding_arguments(parser)
     args = parser.parse_args()
+    if (args.embedding is None) and (args.hierarchy is None):
+        parser.error('Either --embedding or --hierarchy must be given.')
     
     if args.val_batch_size is None:
         args.val_batch_size = args.batch_size
@@ -55,14 +59,19 @@ if __name__ == '__main__':
     K.set_session(K.tf.Session(config = K.tf.ConfigProto(gpu_options = { 'allow_growth' : True })))
 
     # Load and L2-normalize class embeddings
-    with open(args.embedding, 'rb') as pf:
-        embedding = pickle.load(pf)
-        embed_labels = embedding['ind2label']
-        embedding = embedding['embedding']
-    embedding /= np.linalg.norm(embedding, axis = -1, keepdims = True)
+    if args.embedding:
+        with open(args.embedding, 'rb') as pf:
+            embedding = pickle.load(pf)
+            embed_labels = embedding['ind2label']
+            embedding = embedding['embedding']
+    else:
+        embed_labels = embedding = None
 
     # Load dataset
     data_generator = get_data_generator(args.dataset, args.data_root, classes = embed_labels)
+    if embedding is None:
+        embedding = embedding_from_args(args, list(data_generator.classes))['embedding']
+    embedding = embedding / np.linalg.norm(embedding, axis = -1, keepdims = True)
 
     # Construct and train model
     if args.init_weights:
@@ -139,6 +148,6 @@ if __name__ == '__main__':
 
     # Save test image embeddings
     if args.feature_dump:
-        pred_features = model.predict_generator(data_generator.flow_test(1, False), data_generator.num_test)
+        pred_features = utils.extract_features(model, data_generator, args.val_batch_size)
         with open(args.feature_dump,'wb') as dump_file:
             pickle.dump({ 'feat' : dict(enumerate(pred_features)) }, dump_file)
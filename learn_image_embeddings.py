@@ -10,6 +10,7 @@ from keras import backend as K
 
 import utils
 from datasets import get_data_generator
+from embedding_cache import add_embedding_arguments, embedding_from_args
 
 
 
@@ -58,9 +59,10 @@ if __name__ == '__main__':
     arggroup = parser.add_argument_group('Data parameters')
     arggroup.add_argument('--dataset', type = str, required = True, help = 'Training dataset. See README.md for a list of available datasets.')
     arggroup.add_argument('--data_root', type = str, required = True, help = 'Root directory of the dataset.')
-    arggroup.add_argument('--embedding', type = str, required = True,
+    arggroup.add_argument('--embedding', type = str, default = None,
                           help = 'Path to a pickle dump of embeddings generated by compute_class_embeddings.py. '
-                                 'The special value "onehot" may be used to generate one-hot embeddings on the fly.')
+                                 'The special value "onehot" may be used to generate one-hot embeddings on the fly. '
+                                 'If not given, embeddings will be computed from --hierarchy or loaded from the embedding cache.')
     arggroup = parser.add_argument_group('Training parameters')
     arggroup.add_argument('--architecture', type = str, default = 'simple', choices = utils.ARCHITECTURES, help = 'Type of network architecture.')
     arggroup.add_argument('--loss', type = str, default = 'inv_corr', choices = ['mse', 'inv_corr', 'unnorm_corr', 'softmax_corr'],
@@ -83,6 +85,7 @@ if __name__ == '__main__':
     arggroup.add_argument('--gpus', type = int, default = 1, help = 'Number of GPUs to be used.')
     arggroup.add_argument('--read_workers', type = int, default = 8, help = 'Number of parallel data pre-processing processes.')
     arggroup.add_argument('--queue_size', type = int, default = 100, help = 'Maximum size of data queue.')
+    arggroup.add_argument('--uint8_batches', action = 'store_true', default = False, help = 'Transfer unnormalized uint8 images from the data loaders and normalize them in the model, which reduces inter-process communication and queue memory by a factor of 4.')
     arggroup.add_argument('--gpu_merge', action = 'store_true', default = False, help = 'Merge weights on the GPU.')
     arggroup = parser.add_argument_group('Output parameters')
     arggroup.add_argument('--model_dump', type = str, default = None, help = 'Filename where the learned model definition and weights should be written to.')
@@ -92,8 +95,11 @@ if __name__ == '__main__':
     arggroup.add_argument('--no_progress', action = 'store_true', default = False, help = 'Do not display training progress, but just the final performance.')
     arggroup.add_argument('--top_k_acc', type = int, nargs = '+', default = [], help = 'If given, top k accuracy will be reported in addition to top 1 accuracy.')
     utils.add_lr_schedule_arguments(parser)
+    add_embedding_arguments(parser)
 
     args = parser.parse_args()
+    if (args.embedding is None) and (args.hierarchy is None):
+        parser.error('Either --embedding or --hierarchy must be given.')
     
     if args.val_batch_size is None:
         args.val_batch_size = args.batch_size
@@ -102,7 +108,7 @@ if __name__ == '__main__':
     K.set_session(K.tf.Session(config = K.tf.ConfigProto(gpu_options = { 'allow_growth' : True })))
 
     # Load class embeddings
-    if args.embedding == 'onehot':
+    if (args.embedding is None) or (args.embedding == 'onehot'):
         embed_labels = None
         embedding = None
     else:
@@ -113,8 +119,15 @@ if __name__ == '__main__':
 
     # Load dataset
     data_generator = get_data_generator(args.dataset, args.data_root, classes = embed_labels)
-    if embedding is None:
+    if args.embedding == 'onehot':
         embedding = np.eye(data_generator.num_classes)
+    elif embedding is None:
+        embedding = embedding_from_args(args, list(data_generator.classes))['embedding']
+    if args.uint8_batches:
+        data_generator.uint8_batches = True
+        input_normalization = data_generator.input_normalization()
+    else:
+        input_normalization = None
 
     # Construct and train model
     if (args.gpus <= 1) or args.gpu_merge:
@@ -122,7 +135,7 @@ if __name__ == '__main__':
             print('Resuming from snapshot {}'.format(args.snapshot))
             model = keras.models.load_model(args.snapshot, custom_objects = utils.get_custom_objects(args.architecture), compile = False)
         else:
-            embed_model = utils.build_network(embedding.shape[1], args.architecture, input_channels=data_generator.num_channels)
+            embed_model = utils.build_network(embedding.shape[1], args.architecture, input_channels=data_generator.num_channels, input_normalization = input_normalization)
             model = embed_model
             if args.loss == 'inv_corr':
                 model = keras.models.Model(model.inputs, keras.layers.Lambda(utils.l2norm, name = 'l2norm')(model.output))
@@ -137,7 +150,7 @@ if __name__ == '__main__':
                 print('Resuming from snapshot {}'.format(args.snapshot))
                 model = keras.models.load_model(args.snapshot, custom_objects = utils.get_custom_objects(args.architecture), compile = False)
             else:
-                embed_model = utils.build_network(embedding.shape[1], args.architecture, input_channels=data_generator.num_channels)
+                embed_model = utils.build_network(embedding.shape[1], args.architecture, input_channels=data_generator.num_channels, input_normalization = input_normalization)
                 model = embed_model
                 if args.loss == 'inv_corr':
                     model = keras.models.Model(model.inputs, keras.layers.Lambda(utils.l2norm, name = 'l2norm')(model.output))
@@ -268,7 +281,7 @@ if __name__ == '__main__':
 
     # Save test image embeddings
     if args.feature_dump:
-        pred_features = par_model.predict_generator(data_generator.flow_test(1, False), data_generator.num_test)
+        pred_features = utils.extract_features(par_model, data_generator, args.val_batch_size)
         if args.cls_weight > 0:
             pred_features = pred_features[0]
         with open(args.feature_dump,'wb') as dump_file:
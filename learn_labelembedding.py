@@ -89,6 +89,7 @@ if __name__ == '__main__':
     arggroup.add_argument('--gpus', type = int, default = 1, help = 'Number of GPUs to be used.')
     arggroup.add_argument('--read_workers', type = int, default = 8, help = 'Number of parallel data pre-processing processes.')
     arggroup.add_argument('--queue_size', type = int, default = 100, help = 'Maximum size of data queue.')
+    arggroup.add_argument('--uint8_batches', action = 'store_true', default = False, help = 'Transfer unnormalized uint8 images from the data loaders and normalize them in the model, which reduces inter-process communication and queue memory by a factor of 4.')
     arggroup.add_argument('--gpu_merge', action = 'store_true', default = False, help = 'Merge weights on the GPU.')
     arggroup = parser.add_argument_group('Output parameters')
     arggroup.add_argument('--model_dump', type = str, default = None, help = 'Filename where the learned model definition and weights should be written to.')
@@ -117,15 +118,20 @@ if __name__ == '__main__':
     else:
         class_list = None
     data_generator = get_data_generator(args.dataset, args.data_root, classes = class_list)
+    if args.uint8_batches:
+        data_generator.uint8_batches = True
+        input_normalization = data_generator.input_normalization()
+    else:
+        input_normalization = None
 
     # Construct and train model
     if (args.gpus <= 1) or args.gpu_merge:
-        embed_model = utils.build_network(args.embed_dim, args.architecture)
+        embed_model = utils.build_network(args.embed_dim, args.architecture, input_normalization = input_normalization)
         model = labelembed_model(embed_model, data_generator.num_classes, tau = args.tau, alpha = args.alpha, beta = args.beta)
         par_model = model if args.gpus <= 1 else keras.utils.multi_gpu_model(model, gpus = args.gpus, cpu_merge = False)
     else:
         with K.tf.device('/cpu:0'):
-            embed_model = utils.build_network(args.embed_dim, args.architecture)
+            embed_model = utils.build_network(args.embed_dim, args.architecture, input_normalization = input_normalization)
             model = labelembed_model(embed_model, data_generator.num_classes, tau = args.tau, alpha = args.alpha, beta = args.beta)
         par_model = keras.utils.multi_gpu_model(model, gpus = args.gpus)
     if not args.no_progress:
@@ -203,6 +209,6 @@ if __name__ == '__main__':
 
     # Save test image embeddings
     if args.feature_dump:
-        pred_features = embed_model.predict_generator(data_generator.flow_test(1, False), data_generator.num_test)
+        pred_features = utils.extract_features(embed_model, data_generator, args.val_batch_size)
         with open(args.feature_dump,'wb') as dump_file:
             pickle.dump({ 'feat' : dict(enumerate(pred_features)) }, dump_file)
@@ -0,0 +1,118 @@
+import numpy as np
+
+import sys
+
+
+
+class SGDLinearClassifier(object):
+    """ One-vs-rest linear classifier trained with mini-batch stochastic gradient descent.
+
+    The objective is the same as that of `sklearn.svm.LinearSVC` with default parameters, i.e., the squared hinge loss
+    with L2 regularization, but training only needs a small part of the data in memory at a time. Thus, the training
+    data can be a memory-mapped array (e.g., created by `numpy.lib.format.open_memmap`) that does not fit into RAM.
+    In each epoch, the samples are shuffled globally and loaded in chunks of randomly chosen rows, which are read
+    in ascending order to keep accesses to memory-mapped files local. All computations are performed using matrix
+    products in single precision, which make use of multi-threaded BLAS.
+
+    After training, the attributes `coef_`, `intercept_`, and `classes_` are available like for scikit-learn classifiers.
+    """
+
+    def __init__(self, C = 1.0, epochs = 10, batch_size = 256, lr = 0.1, momentum = 0.9, chunk_size = 65536, verbose = False, random_state = None):
+        """ Initializes a new classifier.
+
+        C - Weight of the loss compared with the regularizer (as for `LinearSVC`).
+        epochs - Number of passes over the training data.
+        batch_size - Number of samples per SGD step.
+        lr - Initial learning rate, which is annealed to 0 following a cosine schedule.
+        momentum - Nesterov momentum.
+        chunk_size - Number of randomly chosen samples loaded into memory at once and split into mini-batches.
+        verbose - If set to True, the average loss will be printed on stderr after each epoch.
+        random_state - Seed or `numpy.random.RandomState` used for shuffling.
+        """
+
+        object.__init__(self)
+        self.C = C
+        self.epochs = epochs
+        self.batch_size = batch_size
+        self.lr = lr
+        self.momentum = momentum
+        self.chunk_size = chunk_size
+        self.verbose = verbose
+        self.random_state = random_state
+
+
+    def fit(self, X, y):
+        """ Trains the classifier.
+
+        X - `n-by-d` array (or memory-mapped array) of training samples.
+        y - Vector of `n` class labels.
+
+        Returns: self
+        """
+
+        rs = self.random_state if isinstance(self.random_state, np.random.RandomState) else np.random.RandomState(self.random_state)
+        self.classes_, y = np.unique(np.asarray(y), return_inverse = True)
+        num_samples, num_classes = len(y), len(self.classes_)
+
+        W = np.zeros((X.shape[1], num_classes), dtype = np.float32)
+        b = np.zeros(num_classes, dtype = np.float32)
+        vW, vb = np.zeros_like(W), np.zeros_like(b)
+        reg = np.float32(1. / (self.C * num_samples))
+
+        num_steps = self.epochs * sum(int(np.ceil(min(self.chunk_size, num_samples - offs) / self.batch_size)) for offs in range(0, num_samples, self.chunk_size))
+        step = 0
+        for epoch in range(self.epochs):
+            loss = 0.0
+            sample_perm = rs.permutation(num_samples)
+            for chunk_start in range(0, num_samples, self.chunk_size):
+                chunk_ind = np.sort(sample_perm[chunk_start:chunk_start+self.chunk_size])
+                X_chunk = np.asarray(X[chunk_ind], dtype = np.float32)
+                y_chunk = y[chunk_ind]
+                perm = rs.permutation(len(X_chunk))
+                for batch_start in range(0, len(perm), self.batch_size):
+                    batch_ind = perm[batch_start:batch_start+self.batch_size]
+                    X_batch = X_chunk[batch_ind]
+
+                    # Squared hinge loss with targets +1 for the true class and -1 for all other classes
+                    # (evaluated at the look-ahead point of Nesterov momentum)
+                    W_ahead, b_ahead = W + self.momentum * vW, b + self.momentum * vb
+                    targets = np.full((len(batch_ind), num_classes), -1, dtype = np.float32)
+                    targets[np.arange(len(batch_ind)), y_chunk[batch_ind]] = 1
+                    residuals = np.maximum(0, 1 - targets * (np.dot(X_batch, W_ahead) + b_ahead))
+                    loss += np.sum(residuals * residuals)
+
+                    # Gradient step
+                    grad_scores = (-2. / len(batch_ind)) * targets * residuals
+                    lr = np.float32(0.5 * self.lr * (1 + np.cos(np.pi * step / num_steps)))
+                    vW *= self.momentum
+                    vW -= lr * (np.dot(X_batch.T, grad_scores) + reg * W_ahead)
+                    vb *= self.momentum
+                    vb -= lr * grad_scores.sum(axis = 0)
+                    W += vW
+                    b += vb
+                    step += 1
+
+            if self.verbose:
+                sys.stderr.write('Epoch {}/{}: loss = {:.4f}\n'.format(epoch + 1, self.epochs, loss / num_samples + 0.5 * reg * np.sum(W * W)))
+
+        self.coef_ = W.T
+        self.intercept_ = b
+        return self
+
+
+    def decision_function(self, X, batch_size = 65536):
+        """ Computes the scores of all classes for given samples.
+
+        Returns: `n-by-c` matrix of scores, where `c` is the number of classes.
+        """
+
+        return np.concatenate([
+            np.dot(np.asarray(X[offs:offs+batch_size], dtype = np.float32), self.coef_.T) + self.intercept_
+            for offs in range(0, len(X), batch_size)
+        ] + [np.zeros((0, len(self.classes_)), dtype = np.float32)])
+
+
+    def predict(self, X):
+        """ Predicts the labels of given samples. """
+
+        return self.classes_[self.decision_function(X).argmax(axis = -1)]
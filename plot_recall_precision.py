@@ -1,12 +1,13 @@
 import numpy as np
-from sklearn.metrics import average_precision_score
 import matplotlib.pyplot as plt
 
 import argparse, pickle, os.path
 from collections import OrderedDict
 
 from datasets import get_data_generator
-from evaluate_retrieval import pairwise_retrieval, str2bool
+from evaluate_retrieval import pairwise_ranking, str2bool
+from embedding_cache import EmbeddingCache, add_cache_arguments
+from retrieval_metrics import recall_precision
 
 try:
     from tqdm import tqdm
@@ -29,7 +30,10 @@ if __name__ == '__main__':
     arggroup.add_argument('--norm', type = str2bool, action = 'append', help = 'Whether to L2-normalize the corresponding features or not (defaults to False).')
     arggroup = parser.add_argument_group('Plot')
     arggroup.add_argument('--bins', type = int, default = None, help = 'Optional, number of recall levels to be distinguished.')
+    arggroup = add_cache_arguments(parser)
+    arggroup.add_argument('--cache_rankings', action = 'store_true', default = False, help = 'Cache the rankings, which take 4*n^2 bytes for n test images.')
     args = parser.parse_args()
+    cache = EmbeddingCache.from_args(args)
     
     # Load dataset
     if args.classes_from:
@@ -53,31 +57,12 @@ if __name__ == '__main__':
         
         feat_name = args.label[i] if (args.label is not None) and (i < len(args.label)) else os.path.splitext(os.path.basename(feat_dump))[0]
         normalize = args.norm[i] if (args.norm is not None) and (i < len(args.norm)) else False
-        recprec = {}
-        aps = []
-
-        for qid, retrieved in tqdm(pairwise_retrieval(feat_dump, normalize, True), total = data_generator.num_test):
-            
-            rp = {}
-            
-            correct = np.asarray([labels_test[r] == labels_test[qid] for r in retrieved if r != qid])
-            aps.append(average_precision_score(correct, -np.arange(len(correct))))
-            
-            tp = correct.astype(np.float).cumsum()
-            recall = tp / tp[-1]
-            precision = tp / np.arange(1, len(tp) + 1)
-            for r, p in zip(recall, precision):
-                if args.bins:
-                    r = int(r * args.bins) / args.bins + 1/(2*args.bins)
-                rp[r] = max(rp[r], p) if r in rp else p
-            for r, p in rp.items():
-                if r in recprec:
-                    recprec[r].append(p)
-                else:
-                    recprec[r] = [p]
+        ind2id, ranking = pairwise_ranking(feat_dump, normalize, cache = cache, cache_complete = args.cache_rankings)
+        labels = np.asarray(labels_test if ind2id is None else [labels_test[id] for id in ind2id])
+        levels, precision, aps = recall_precision(ranking, labels, labels, np.arange(len(ranking)), bins = args.bins)
+        del ranking
         
-        levels = sorted(recprec.keys())
-        plt.plot(levels, [np.mean(recprec[r]) for r in levels], label = '{} (mAP: {:.2%})'.format(feat_name, np.mean(aps)))
+        plt.plot(levels, precision, label = '{} (mAP: {:.2%})'.format(feat_name, np.mean(aps)))
     
     # Show figure
     plt.legend(fontsize = 'x-small')
@@ -0,0 +1,162 @@
+import numpy as np
+
+import pickle
+
+
+
+def load_features(features):
+    """ Loads image features.
+
+    # Arguments:
+
+    - features: Features for all images. Can be provided in the following ways:
+                - 2-d numpy array with each row corresponding to a sample.
+                - Dictionary mapping image IDs to feature vectors.
+                - Path to a pickle file containing such a dictionary.
+
+    # Returns:
+        tuple with 2 items:
+        1. array mapping row indices to image IDs or None if `features` is a numpy array.
+        2. 2-d numpy array of features.
+    """
+
+    if isinstance(features, str):
+        with open(features, 'rb') as feat_dump:
+            features = pickle.load(feat_dump)
+    if isinstance(features, dict):
+        if 'feat' in features:
+            features = features['feat']
+        ind2id = np.array(list(features.keys()))
+        features = np.stack(list(features.values()))
+        if features.ndim > 2:
+            raise ValueError('Feature matrix must be 2-dimensional. Actual shape: {}'.format(features.shape))
+    else:
+        ind2id = None
+    return ind2id, features
+
+
+
+class RetrievalIndex(object):
+    """ Database of image features answering nearest neighbor queries for new images.
+
+    Distances are squared Euclidean distances or, if features are L2-normalized, negative cosine similarities,
+    as for `evaluate_retrieval.pairwise_ranking`. Queries are processed in batches using matrix products in single precision.
+
+    The index can be stored using `save()` and loaded using `load()` or be cached using `EmbeddingCache.retrieval_index()`,
+    so that it only has to be built once from the features of the database images.
+    """
+
+    def __init__(self, features, ids = None, normalize = False):
+        """ Builds an index from database features.
+
+        features - Features of the database images (see `load_features`).
+        ids - Optionally, a vector with the IDs of the database images. Defaults to their indices
+              if `features` is a numpy array and to the keys of the dictionary otherwise.
+        normalize - Whether to L2-normalize the features of database images and queries.
+        """
+
+        object.__init__(self)
+        ind2id, features = load_features(features)
+        self.ids = np.asarray(ids) if ids is not None else (ind2id if ind2id is not None else np.arange(len(features)))
+        self.normalize = normalize
+        self.features = np.asarray(features, dtype = np.float32)
+        if normalize:
+            self.features = self.features / np.maximum(np.linalg.norm(self.features, axis = -1, keepdims = True), 1e-12)
+            self.sqnorms = None
+        else:
+            self.sqnorms = np.sum(self.features ** 2, axis = -1)
+
+
+    def __len__(self):
+
+        return len(self.features)
+
+
+    def query(self, features, k = 100, batch_size = 1024):
+        """ Retrieves the nearest neighbors of query images from the database.
+
+        features - `q-by-d` matrix of query features.
+        k - Number of neighbors to be retrieved for each query. If `None`, all database images will be ranked.
+        batch_size - Number of queries processed at once. Memory consumption is linear in `batch_size * len(self)`.
+
+        Returns: tuple with a `q-by-k` matrix of indices of the nearest neighbors in the database (not their IDs)
+                 and a `q-by-k` matrix with their distances, both in ascending order of distance.
+        """
+
+        k = len(self) if k is None else min(k, len(self))
+        ranking = np.empty((len(features), k), dtype = np.int32)
+        distances = np.empty((len(features), k), dtype = np.float32)
+        for start in range(0, len(features), batch_size):
+            dist = self._distances(features[start:start+batch_size])
+            if k < len(self):
+                ind = np.argpartition(dist, k - 1, axis = -1)[:,:k]
+                ind = np.take_along_axis(ind, np.argsort(np.take_along_axis(dist, ind, axis = -1), axis = -1, kind = 'stable'), axis = -1)
+            else:
+                ind = np.argsort(dist, axis = -1)
+            ranking[start:start+len(ind)] = ind
+            distances[start:start+len(ind)] = np.take_along_axis(dist, ind, axis = -1)
+        return ranking, distances
+
+
+    def retrieve(self, features, k = 100, batch_size = 1024):
+        """ Retrieves the nearest neighbors of query images from the database.
+
+        features - Features of the query images (see `load_features`).
+        k - Number of neighbors to be retrieved for each query. If `None`, all database images will be ranked.
+        batch_size - Number of queries processed at once.
+
+        Returns: a generator yielding tuples consisting of a query image ID and a list with the IDs of its nearest neighbors
+                 in the database, which can be passed to `ClassHierarchy.hierarchical_precision()`.
+        """
+
+        query_ids, features = load_features(features)
+        if query_ids is None:
+            query_ids = np.arange(len(features))
+        for start in range(0, len(features), batch_size):
+            ranking, _ = self.query(features[start:start+batch_size], k, batch_size)
+            for qid, ret in zip(query_ids[start:start+batch_size].tolist(), ranking):
+                yield qid, self.ids[ret].tolist()
+
+
+    def _distances(self, features):
+        """ Computes the distances between a batch of queries and all database images. """
+
+        features = np.asarray(features, dtype = np.float32)
+        if self.normalize:
+            features = features / np.maximum(np.linalg.norm(features, axis = -1, keepdims = True), 1e-12)
+            return -np.dot(features, self.features.T)
+        else:
+            return np.sum(features ** 2, axis = -1)[:,None] + self.sqnorms[None,:] - 2 * np.dot(features, self.features.T)
+
+
+    def arrays(self):
+        """ Returns a dictionary with the arrays making up this index, which can be passed to `from_arrays()`. """
+
+        return { 'features' : self.features, 'ids' : self.ids, 'normalize' : np.array(self.normalize) }
+
+
+    @classmethod
+    def from_arrays(cls, arrays):
+        """ Re-creates an index from arrays returned by `arrays()` without copying the features, which may be memory-mapped. """
+
+        index = cls.__new__(cls)
+        object.__init__(index)
+        index.features = arrays['features']
+        index.ids = np.asarray(arrays['ids'])
+        index.normalize = bool(arrays['normalize'])
+        index.sqnorms = None if index.normalize else np.sum(np.square(index.features, dtype = np.float32), axis = -1)
+        return index
+
+
+    def save(self, filename):
+        """ Writes the index to a numpy .npz file, which can be loaded using `load()`. """
+
+        np.savez(filename, **self.arrays())
+
+
+    @classmethod
+    def load(cls, filename):
+        """ Loads an index written by `save()`. """
+
+        with np.load(filename, allow_pickle = False) as arrays:
+            return cls.from_arrays({ key : arrays[key] for key in arrays.files })
@@ -0,0 +1,118 @@
+import numpy as np
+
+
+
+def hit_blocks(ranking, labels, query_labels, query_ind = None, batch_size = 1000):
+    """ Determines which retrieved items are relevant for blocks of queries.
+
+    # Arguments:
+
+    - ranking: `q-by-n` array with the indices of the retrieved items for each query, ordered by decreasing relevance.
+
+    - labels: Vector with the class labels of all items in the database.
+
+    - query_labels: Vector with the class labels of the `q` queries. An item is considered relevant for a query if both have the same label.
+
+    - query_ind: Optionally, a vector with the indices of the queries in the database. The query itself will then be ignored in its ranking.
+
+    - batch_size: Number of queries processed at once. Memory consumption is linear in `batch_size * n`.
+
+    # Returns:
+        a generator yielding tuples consisting of the index of the first query in the block, a boolean matrix indicating
+        relevant items, and a matrix with the positions of the items in the ranking (starting at 1, not counting ignored items).
+    """
+
+    labels = np.asarray(labels)
+    query_labels = np.asarray(query_labels)
+    positions = np.arange(1, ranking.shape[1] + 1)[None,:]
+    for start in range(0, len(ranking), batch_size):
+        block = np.asarray(ranking[start:start+batch_size])
+        hits = (labels[block] == query_labels[start:start+batch_size,None])
+        if query_ind is not None:
+            valid = (block != np.asarray(query_ind[start:start+batch_size])[:,None])
+            hits &= valid
+            yield start, hits, np.cumsum(valid, axis = -1)
+        else:
+            yield start, hits, positions
+
+
+def average_precision(ranking, labels, query_labels, query_ind = None, batch_size = 1000):
+    """ Computes the average precision of the rankings for several queries.
+
+    Average precision is the mean of the precision at the positions of all relevant items, which is 0 for queries without relevant items.
+    See `hit_blocks` for a description of the arguments.
+
+    # Returns:
+        vector with the average precision for each query.
+    """
+
+    ap = np.zeros(len(ranking))
+    for start, hits, positions in hit_blocks(ranking, labels, query_labels, query_ind, batch_size):
+        tp = np.cumsum(hits, axis = -1)
+        ap[start:start+len(hits)] = np.sum(np.where(hits, tp / np.maximum(positions, 1), 0), axis = -1) / np.maximum(tp[:,-1], 1)
+    return ap
+
+
+def recall_precision(ranking, labels, query_labels, query_ind = None, bins = None, batch_size = 1000):
+    """ Computes the average recall-precision curve and the average precision of the rankings for several queries.
+
+    For each query, the maximum precision at each recall level is determined. These are averaged over all queries
+    reaching that recall level. Queries without relevant items are ignored for the curve.
+
+    # Arguments:
+
+    - bins: Optionally, the number of recall levels to be distinguished. Recall levels will then be represented by
+            the centers of the bins. If not given, all recall levels occurring in any ranking will be distinguished.
+
+    See `hit_blocks` for a description of the remaining arguments.
+
+    # Returns:
+        tuple with 3 items:
+        1. vector with recall levels in ascending order
+        2. vector with the average precision at each recall level
+        3. vector with the average precision for each query
+    """
+
+    ap = np.zeros(len(ranking))
+    if bins:
+        levels = np.arange(bins + 1) / bins + 1/(2*bins)
+        prec_sum, prec_count = np.zeros(bins + 1), np.zeros(bins + 1)
+    else:
+        level_list, sum_list, count_list = [], [], []
+
+    for start, hits, positions in hit_blocks(ranking, labels, query_labels, query_ind, batch_size):
+
+        tp = np.cumsum(hits, axis = -1)
+        num_relevant = tp[:,-1]
+        ap[start:start+len(hits)] = np.sum(np.where(hits, tp / np.maximum(positions, 1), 0), axis = -1) / np.maximum(num_relevant, 1)
+
+        # Precision is maximal at the positions of relevant items, except for recall 0, where it is 0
+        # if the first item is not relevant.
+        positions = np.broadcast_to(positions, hits.shape)
+        q, pos = np.nonzero(hits)
+        rec = tp[q, pos] / num_relevant[q]
+        prec = tp[q, pos] / positions[q, pos]
+        zero_rec = np.flatnonzero((num_relevant > 0) & (positions[np.arange(len(hits)), np.argmax(hits, axis = -1)] > 1))
+        q = np.concatenate((q, zero_rec))
+        rec = np.concatenate((rec, np.zeros(len(zero_rec))))
+        prec = np.concatenate((prec, np.zeros(len(zero_rec))))
+
+        if bins:
+            max_prec = np.full((len(hits), bins + 1), -1.0)
+            np.maximum.at(max_prec, (q, (rec * bins).astype(int)), prec)
+            prec_sum += np.sum(np.maximum(max_prec, 0), axis = 0)
+            prec_count += np.sum(max_prec >= 0, axis = 0)
+        else:
+            block_levels, level_ind = np.unique(rec, return_inverse = True)
+            level_list.append(block_levels)
+            sum_list.append(np.bincount(level_ind, weights = prec, minlength = len(block_levels)))
+            count_list.append(np.bincount(level_ind, minlength = len(block_levels)))
+
+    if bins:
+        present = (prec_count > 0)
+        return levels[present], prec_sum[present] / prec_count[present], ap
+    else:
+        levels, level_ind = np.unique(np.concatenate(level_list + [np.zeros(0)]), return_inverse = True)
+        prec_sum = np.bincount(level_ind, weights = np.concatenate(sum_list + [np.zeros(0)]), minlength = len(levels))
+        prec_count = np.bincount(level_ind, weights = np.concatenate(count_list + [np.zeros(0)]), minlength = len(levels))
+        return levels, prec_sum / prec_count, ap
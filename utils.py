@@ -127,7 +127,153 @@ def l2norm(x):
     return K.tf.nn.l2_normalize(x, -1)
 
 
-def build_network(num_outputs, architecture, classification = False, no_softmax = False, input_channels = None, name = None):
+class InputNormalization(keras.layers.Layer):
+    """ Casts unnormalized images (e.g., uint8) to floats and normalizes them channel-wise.
+
+    # Arguments:
+
+    - mean: Channel-wise mean to be subtracted from the images.
+
+    - std: Channel-wise standard deviation the images will be divided by.
+
+    - data_format: The image data format (either 'channels_first' or 'channels_last'). Set to None for the default value.
+    """
+
+    def __init__(self, mean, std, data_format = None, **kwargs):
+        super(InputNormalization, self).__init__(**kwargs)
+        self.mean = [float(m) for m in np.ravel(mean)]
+        self.std = [float(s) for s in np.ravel(std)]
+        self.data_format = data_format if data_format is not None else K.image_data_format()
+
+    def compute_output_shape(self, input_shape):
+        return input_shape
+
+    def call(self, inputs):
+        shape = (1, -1, 1, 1) if self.data_format == 'channels_first' else (1, 1, 1, -1)
+        mean = K.constant(np.reshape(self.mean, shape), dtype = K.floatx())
+        std = K.constant(np.reshape(self.std, shape), dtype = K.floatx())
+        return (K.cast(inputs, K.floatx()) - mean) / std
+
+    def get_config(self):
+        config = { 'mean' : self.mean, 'std' : self.std, 'data_format' : self.data_format }
+        base_config = super(InputNormalization, self).get_config()
+        return dict(list(base_config.items()) + list(config.items()))
+
+
+def add_input_normalization(model, mean, std, input_dtype = 'uint8'):
+    """ Prepends an `InputNormalization` layer to a model, so that it can be fed with unnormalized images.
+
+    The layers of the given model will be re-created with freshly initialized weights.
+
+    # Arguments:
+
+    - model: keras.models.Model
+
+    - mean: Channel-wise mean to be subtracted from the images.
+
+    - std: Channel-wise standard deviation the images will be divided by.
+
+    - input_dtype: Data type of the images fed into the model.
+
+    # Returns:
+        keras.models.Model
+    """
+
+    input_ = keras.layers.Input(model.input_shape[1:], dtype = input_dtype)
+    x = InputNormalization(mean, std, name = 'input_normalization')(input_)
+    normalized_model = keras.models.clone_model(model, input_tensors = x)
+    return keras.models.Model(input_, normalized_model.outputs, name = model.name)
+
+
+def expects_uint8_input(model):
+    """ Checks whether a model expects unnormalized uint8 images as input (see `add_input_normalization`). """
+
+    return K.dtype(model.inputs[0]) == 'uint8'
+
+
+def report_input_stats(flow):
+    """ Prints statistics about the input pipeline if `flow` provides them (see `datasets.common.PrefetchIterator`). """
+
+    if hasattr(flow, 'stats'):
+        stats = flow.stats
+        sys.stderr.write('Input pipeline: {} batches, {:.1f} batches ready on average, waited for {} batches ({:.1f} s in total).\n'.format(
+            stats['batches'], stats['avg_queue_depth'], stats['stalls'], stats['stall_time']
+        ))
+        flow.close()
+
+
+def extract_features(model, data_generator, batch_size = 32, read_workers = 0, verbose = 1, tta = None, tta_aggregate = 'mean'):
+    """ Computes the outputs of a model for all test images of a dataset in batches.
+
+    If the data generator crops test images to the median size of each batch instead of a fixed size, only images of the
+    same size are grouped into a batch (see `FileDatasetGenerator.test_batch_indices`). Thus, the result is the same as
+    when processing each image on its own, but much faster.
+
+    # Arguments:
+
+    - model: The Keras model.
+
+    - data_generator: The data generator providing the test images.
+
+    - batch_size: Maximum number of images per batch.
+
+    - read_workers: Number of threads loading and pre-processing images in the background.
+
+    - verbose: Verbosity mode passed to `predict_generator`.
+
+    - tta: Optionally, a dictionary with options for test-time augmentation (see `FileDatasetGenerator.compose_batch`).
+           Each batch will then contain `batch_size` times the number of views per image.
+
+    - tta_aggregate: How the outputs for the views of each image are aggregated if `tta` is given: 'mean', 'max', or None.
+                     If None, the outputs for all views of an image will be returned in consecutive rows.
+
+    # Returns:
+        numpy array with one row per test image in the original order, or a list of such arrays for models with multiple outputs.
+    """
+
+    if hasattr(data_generator, 'test_batch_indices'):
+        batches = data_generator.test_batch_indices(batch_size)
+        flow = data_generator.flow_test(include_labels = False, batch_indices = batches, workers = read_workers, tta = tta)
+    elif tta is not None:
+        raise ValueError('Test-time augmentation is not supported by {}.'.format(type(data_generator).__name__))
+    else:
+        batches = [np.arange(offs, min(offs + batch_size, data_generator.num_test)) for offs in range(0, data_generator.num_test, batch_size)]
+        flow = data_generator.flow_test(batch_size, False, shuffle = False, workers = read_workers)
+
+    if tta is None:
+        pred = model.predict_generator(flow, len(batches), verbose = verbose)
+    else:
+        # Aggregate the outputs for all views of each image batch by batch
+        from datasets.common import num_tta_views
+        num_views = num_tta_views(**tta)
+        progbar = keras.utils.Progbar(len(batches)) if verbose else None
+        pred = []
+        for i, (batch_ind, X) in enumerate(zip(batches, flow)):
+            batch_pred = model.predict_on_batch(X)
+            batch_pred = [p.reshape(len(batch_ind), num_views, *p.shape[1:]) for p in (batch_pred if isinstance(batch_pred, list) else [batch_pred])]
+            if tta_aggregate == 'mean':
+                batch_pred = [p.mean(axis = 1) for p in batch_pred]
+            elif tta_aggregate == 'max':
+                batch_pred = [p.max(axis = 1) for p in batch_pred]
+            pred.append(batch_pred)
+            if progbar is not None:
+                progbar.update(i + 1)
+        pred = [np.concatenate(p) for p in zip(*pred)]
+        if len(pred) == 1:
+            pred = pred[0]
+    report_input_stats(flow)
+
+    # Restore the original order of images
+    order = np.concatenate(batches)
+    if np.any(order[1:] < order[:-1]):
+        inv_order = np.argsort(order)
+        pred = [p[inv_order] for p in pred] if isinstance(pred, list) else pred[inv_order]
+    if (tta is not None) and (tta_aggregate is None):
+        pred = [p.reshape(-1, *p.shape[2:]) for p in pred] if isinstance(pred, list) else pred.reshape(-1, *pred.shape[2:])
+    return pred
+
+
+def build_network(num_outputs, architecture, classification = False, no_softmax = False, input_channels = None, name = None, input_normalization = None):
     """ Constructs a CNN.
     
     # Arguments:
@@ -144,10 +290,17 @@ def build_network(num_outputs, architecture, classification = False, no_softmax
     - input_channels: Number of input channels.
     
     - name: The name of the network.
+
+    - input_normalization: Optionally, a tuple with channel-wise mean and standard deviation. If given, the network will
+                           expect unnormalized uint8 images and normalize them itself using an `InputNormalization` layer.
     
     # Returns:
         keras.models.Model
     """
+
+    if input_normalization is not None:
+        model = build_network(num_outputs, architecture, classification, no_softmax, input_channels, name)
+        return add_input_normalization(model, *input_normalization)
     
     if architecture.lower().endswith('-selu'):
         activation = 'selu'
@@ -279,10 +432,10 @@ def build_network(num_outputs, architecture, classification = False, no_softmax
 def get_custom_objects(architecture):
     """ Provides a dictionary with custom objects required for loading a certain model architecture using `keras.models.load_model`. """
     
+    custom_objects = { 'InputNormalization' : InputNormalization }
     if architecture in ('resnet-32', 'resnet-110', 'resnet-110-fc', 'resnet-110-wfc', 'pyramidnet-272-200', 'pyramidnet-110-270'):
-        return { 'ChannelPadding' : cifar_resnet.ChannelPadding }
-    else:
-        return {}
+        custom_objects['ChannelPadding'] = cifar_resnet.ChannelPadding
+    return custom_objects
 
 
 def get_lr_schedule(schedule, num_samples, batch_size, schedule_args = {}):